@@ -0,0 +1,65 @@
+import numpy as np
+
+# Frame names are formatted by the capture as %Y-%m-%d_%H-%M-%S.jpg
+_NAME_LENGTH = 19
+_SEPARATORS = {4: b"-", 7: b"-", 10: b"_", 13: b"-", 16: b"-"}
+_DIGITS = [idx for idx in range(_NAME_LENGTH) if idx not in _SEPARATORS]
+
+
+def parse_frame_timestamps(names):
+    """
+    Parse the frame names in bulk
+    names: list of the frame names (%Y-%m-%d_%H-%M-%S with any extension)
+    return an int64 array of the UTC timestamps in seconds
+    """
+    if len(names) == 0:
+        return np.zeros(0, dtype=np.int64)
+    chars = np.array([name[:_NAME_LENGTH] for name in names], dtype="S" + str(_NAME_LENGTH))
+    chars = chars.view(np.uint8).reshape(len(names), _NAME_LENGTH)
+    valid = np.ones(len(names), dtype=bool)
+    for idx, separator in _SEPARATORS.items():
+        valid &= chars[:, idx] == ord(separator)
+    digits = chars[:, _DIGITS].astype(np.int64) - ord("0")
+    valid &= ((digits >= 0) & (digits <= 9)).all(axis=1)
+    if not valid.all():
+        raise ValueError("Invalid frame name: " + repr(names[int(np.argmin(valid))]))
+
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    day = digits[:, 6] * 10 + digits[:, 7]
+    hour = digits[:, 8] * 10 + digits[:, 9]
+    minute = digits[:, 10] * 10 + digits[:, 11]
+    second = digits[:, 12] * 10 + digits[:, 13]
+    months = (year - 1970) * 12 + month - 1
+    days = months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64) + day - 1
+    return days * 86400 + hour * 3600 + minute * 60 + second
+
+def align_track(frame_timestamps, track_timestamps, track_latitudes, track_longitudes):
+    """
+    Interpolate the GPS track at the frame timestamps
+    Frames before the first fix or after the last one take the position of that fix
+    frame_timestamps: int64 array of the frame timestamps
+    track_timestamps: sorted int64 array of the fix timestamps, in the same unit
+    track_latitudes: latitude of each fix
+    track_longitudes: longitude of each fix
+    return the contiguous float64 (latitudes, longitudes) arrays of the frames
+    """
+    frame_timestamps = np.asarray(frame_timestamps, dtype=np.int64)
+    track_timestamps = np.asarray(track_timestamps, dtype=np.int64)
+    track_latitudes = np.asarray(track_latitudes, dtype=np.float64)
+    track_longitudes = np.asarray(track_longitudes, dtype=np.float64)
+    if len(track_timestamps) == 0:
+        raise ValueError("The GPS track is empty")
+    if len(track_timestamps) == 1:
+        return (np.full(len(frame_timestamps), track_latitudes[0]),
+                np.full(len(frame_timestamps), track_longitudes[0]))
+
+    after = np.clip(np.searchsorted(track_timestamps, frame_timestamps, side="right"), 1, len(track_timestamps) - 1)
+    before = after - 1
+    span = (track_timestamps[after] - track_timestamps[before]).astype(np.float64)
+    weight = np.divide(frame_timestamps - track_timestamps[before], span,
+                       out=np.zeros(len(frame_timestamps)), where=span > 0)
+    np.clip(weight, 0.0, 1.0, out=weight)
+    latitudes = track_latitudes[before] + weight * (track_latitudes[after] - track_latitudes[before])
+    longitudes = track_longitudes[before] + weight * (track_longitudes[after] - track_longitudes[before])
+    return np.ascontiguousarray(latitudes), np.ascontiguousarray(longitudes)
@@ -1,14 +1,36 @@
 import os
 import shutil
+import logging
 import numpy as np
-import pandas as pd
-from datetime import datetime, timedelta
-from influxdb import DataFrameClient
+from influxdb import InfluxDBClient
 from typing import List
 import cv2
 import tilemapbase
-import matplotlib.pyplot as plt
+from path_files import path_to_tile_store, path_to_gps_tracks
+from tile_store import TileStore, StoredTiles
+from gps_track import TRACK_DTYPE, read_tracks
+from alignment import align_track
+from map_render import MapRenderer, InsetCache, plan_degree_ranges
+from frame_selection import frame_speeds
+from route_layer import RouteLayer
+from compositor import Compositor
+from manifest import RenderManifest
 
+# Masks and inset placement are cached across the frames of every timelapse
+_compositor = Compositor(offset=20, radius_ratio=0.2) # 20% of the min frame size
+# logging.basicConfig arguments of this process, the processes started from the forkserver do not inherit the
+# handlers and are configured with them
+log_config = {}
+
+
+def configure_logging(config):
+    """
+    Configure the logging of this process and keep the configuration for the processes it starts
+    config: logging.basicConfig arguments, the logging is left as is if empty
+    """
+    if config:
+        log_config.update(config)
+        logging.basicConfig(**config)
 
 def get_timelapse_to_process(timelapse_tmp_path, timelapse_generated_path)->List[str]:
     """
@@ -21,7 +43,9 @@ def get_timelapse_to_process(timelapse_tmp_path, timelapse_generated_path)->List
         os.mkdir(timelapse_tmp_path)
     for timelapse_to_process in os.listdir(timelapse_tmp_path):
         path = os.path.join(timelapse_tmp_path, timelapse_to_process)
-        if len(os.listdir(path)) != 0 and timelapse_to_process not in os.listdir(timelapse_generated_path):
+        result_folder = os.path.join(timelapse_generated_path, timelapse_to_process)
+        # Also resume the timelapses whose render was interrupted
+        if len(os.listdir(path)) != 0 and (not os.path.exists(result_folder) or RenderManifest.is_unfinished(result_folder)):
             return_list.append(path)
     return return_list
 
@@ -33,104 +57,192 @@ def clear_timelapse_to_process(timelapse_tmp_path, timelapse_generated_path):
     for timelapse_to_process in os.listdir(timelapse_tmp_path):
         path = os.path.join(timelapse_tmp_path, timelapse_to_process)
         # TODO remove depending on a duration policy
-        if len(os.listdir(path)) == 0 or timelapse_to_process in os.listdir(timelapse_generated_path):
+        result_folder = os.path.join(timelapse_generated_path, timelapse_to_process)
+        if len(os.listdir(path)) == 0 or (os.path.exists(result_folder) and not RenderManifest.is_unfinished(result_folder)):
             shutil.rmtree(path)
 
-def retrieve_lat_lon(timestamps: List[datetime],  influxdb_client: DataFrameClient) -> pd.DataFrame():
+# InfluxDB clients kept for the life of the process, by connection parameters
+_influxdb_clients = {}
+
+def get_influxdb_client(conf) -> InfluxDBClient:
     """
-    timestamps: This is a list of the timestamps to retrieve the latlon positions in the iso format
+    Return the pooled InfluxDB client described in the configuration, created on the first call
+    conf: app configuration
+    """
+    influxdb_conf = conf["influxdb"]
+    key = (influxdb_conf["url"], influxdb_conf["port"], influxdb_conf["user"], influxdb_conf["database"])
+    if key not in _influxdb_clients:
+        _influxdb_clients[key] = InfluxDBClient(influxdb_conf["url"], influxdb_conf["port"], influxdb_conf["user"],
+                                                influxdb_conf["pass"], influxdb_conf["database"])
+    return _influxdb_clients[key]
+
+def retrieve_gps_track(start_ms, end_ms, influxdb_client: InfluxDBClient, chunk_size=10000) -> np.ndarray:
+    """
+    Retrieve the GPS fixes between two timestamps from the influxdb database
+    start_ms: UTC start timestamp in milliseconds
+    end_ms: UTC end timestamp in milliseconds
     influxdb_client: influxbd client to connect to
-    return a Pandas DataFrame; warn: it can be empty if no latlon is found
-    """
-
-    start = (datetime.fromisoformat(timestamps[0]) + timedelta(seconds=-5)).isoformat()
-    end = (datetime.fromisoformat(timestamps[-1]) + timedelta(seconds=5)).isoformat()
-
-    # Query the lat and lon values inside of the first and last + margin timestamps
-    result = influxdb_client.query("SELECT * FROM \"autogen\".\"mqtt_consumer\" WHERE (\"topic\"\
-         = 'router/gps/latitude') AND time >= '"+start+"Z' AND time <= '"+end+"Z'")
-    latitude = pd.DataFrame()
-    if result:
-        latitude = result["mqtt_consumer"]
-    result = influxdb_client.query("SELECT * FROM \"autogen\".\"mqtt_consumer\" WHERE (\"topic\"\
-         = 'router/gps/longitude') AND time >= '"+start+"Z' AND time <= '"+end+"Z'")
-    longitude = pd.DataFrame()
-    if result:
-        longitude = result["mqtt_consumer"]
+    chunk_size: number of points streamed per chunk by the database
+    return a structured array of TRACK_DTYPE records; warn: it can be empty if no latlon is found
+    """
+    start = str(np.datetime64(int(start_ms), "ms").astype("datetime64[s]"))
+    end = str(np.datetime64(int(end_ms), "ms").astype("datetime64[s]"))
+
+    # Query only the lat and lon values inside of the time range, in one pass grouped by topic
+    # The response is streamed in chunks, a topic series can be split over several chunks
+    chunks = influxdb_client.query("SELECT \"value\" FROM \"autogen\".\"mqtt_consumer\" WHERE (\"topic\"\
+         = 'router/gps/latitude' OR \"topic\" = 'router/gps/longitude') AND time >= '"+start+"Z' AND time <= '"+end+"Z'\
+         GROUP BY \"topic\"", epoch="ms", chunked=True, chunk_size=chunk_size)
+    fixes = {"latitude": [], "longitude": []}
+    for chunk in chunks:
+        for field, values in fixes.items():
+            values.extend((point["time"], point["value"]) for point in
+                          chunk.get_points(measurement="mqtt_consumer", tags={"topic": "router/gps/" + field}))
+    latitude = np.array(fixes["latitude"], dtype=np.float64).reshape(-1, 2)
+    longitude = np.array(fixes["longitude"], dtype=np.float64).reshape(-1, 2)
     # Check the values
-    if latitude.empty or longitude.empty:
-        return pd.DataFrame()
-    # Clean, resample 1s just to be sure, add the values to one specific DataFrame
-    latitude.drop(["host", "topic"], axis=1, inplace=True)
-    longitude.drop(["host", "topic"], axis=1, inplace=True)
-    latitude = latitude.resample('1S').first()
-    longitude = longitude.resample('1S').first()
-    gps_coords = pd.DataFrame()
-    gps_coords = latitude.copy()
-    gps_coords["longitude"] = longitude["value"]
-    gps_coords.columns = ["latitude", "longitude"]
-    # Fill NaN cells
-    gps_coords = gps_coords.fillna(method="ffill")
-    # Filter out only on timestamps from the images
-    mask = (gps_coords.index >= timestamps[0]) & (gps_coords.index <= timestamps[-1])
-    gps_coords = gps_coords.loc[mask]
-    return gps_coords
-
-def retrieve_save_map(lat, lon, tiles, output_title, output_path):
+    if len(latitude) == 0 or len(longitude) == 0:
+        return np.zeros(0, dtype=TRACK_DTYPE)
+    # Interpolate the longitude at each latitude fix, both are published together
+    track = np.zeros(len(latitude), dtype=TRACK_DTYPE)
+    track["timestamp"] = latitude[:, 0].astype(np.int64)
+    track["latitude"] = latitude[:, 1]
+    track["longitude"] = np.interp(latitude[:, 0], longitude[:, 0], longitude[:, 1])
+    return track
+
+def retrieve_frame_positions(frame_timestamps, conf, use_database=True):
+    """
+    Interpolate the position of every frame from the local GPS tracks, or else from the influxdb database
+    frame_timestamps: int64 array of the frame UTC timestamps in seconds
+    conf: app configuration
+    use_database: query the influxdb database if no local GPS track covers the frames
+    return the (latitudes, longitudes) arrays of the frames, (None, None) if the positions are not found
+    """
+    start_ms, end_ms = (int(frame_timestamps[0]) - 5) * 1000, (int(frame_timestamps[-1]) + 5) * 1000
+    track = read_tracks(conf.get("gps_track", {}).get("path", path_to_gps_tracks), start_ms, end_ms)
+    if len(track) == 0 and use_database:
+        logging.info("No local GPS track for this timelapse, query the influxdb database")
+        track = retrieve_gps_track(start_ms, end_ms, get_influxdb_client(conf), conf["influxdb"].get("chunk_size", 10000))
+    if len(track) == 0:
+        logging.warning("The gps coordinates corresponding are not retrieved. The timelapse generate continues without the map")
+        return None, None
+    latitudes, longitudes = align_track(frame_timestamps * 1000, track["timestamp"], track["latitude"], track["longitude"])
+    if np.isnan(latitudes).any() or np.isnan(longitudes).any(): # Got NaN values
+        logging.warning("The gps coordinates corresponding are still null. The timelapse generation continues frames without the map")
+        return None, None
+    return latitudes, longitudes
+
+def open_tile_store(conf) -> TileStore:
+    """
+    Open the persistent tile store described in the configuration
+    conf: app configuration
+    """
+    tile_store_conf = conf.get("tile_store", {})
+    return TileStore(tile_store_conf.get("path", path_to_tile_store), tile_store_conf.get("max_size_mb", 512))
+
+def build_map_renderer(conf, tile_store: TileStore, offline=False) -> MapRenderer:
+    """
+    Build the map renderer reading the tiles through the tile store
+    conf: app configuration
+    tile_store: persistent tile store
+    offline: never download the tiles missing from the store, they are drawn blank
+    """
+    if conf["map_generation_mean"] == "local":
+        tiles = tilemapbase.tiles.Tiles(conf["map_generation"]["url"], conf["map_generation"]["tile_name"], headers={"User-Agent":"TileMapBase"})
+    else:
+        tiles = tilemapbase.tiles.build_OSM()
+    cache_conf = conf["map_generation"].get("inset_cache", {})
+    inset_cache = None
+    if cache_conf.get("max_mb", 64) > 0:
+        inset_cache = InsetCache(cache_conf.get("max_mb", 64), cache_conf.get("grid_px", 4), cache_conf.get("scale_step", 0.01))
+    route = None
+    if conf["map_generation"].get("route", False):
+        route = RouteLayer(tiles.tilesize, conf["map_generation"].get("route_color", (0, 0, 255)),
+                           conf["map_generation"].get("route_thickness", 3), version_px=cache_conf.get("grid_px", 4))
+    stored_tiles = StoredTiles(tiles, tile_store, offline, conf["map_generation"].get("prefetch_concurrency", 4))
+    return MapRenderer(stored_tiles, width=500, degree_range=conf["map_generation"].get("zoom", {}).get("min_degree_range", 0.005),
+                       route=route, inset_cache=inset_cache)
+
+def plan_map_zoom(conf, frame_timestamps, latitudes, longitudes):
+    """
+    Plan the map extent of every frame from the speed of the car
+    conf: app configuration
+    frame_timestamps: int64 array of the frame UTC timestamps in seconds
+    latitudes: latitude of each frame
+    longitudes: longitude of each frame
+    return the half size of the map extent of each frame in degrees
+    """
+    zoom_conf = conf["map_generation"].get("zoom", {})
+    return plan_degree_ranges(frame_speeds(frame_timestamps, latitudes, longitudes),
+                              zoom_conf.get("min_degree_range", 0.005), zoom_conf.get("max_degree_range", 0.1),
+                              zoom_conf.get("max_speed_kmh", 130), zoom_conf.get("smoothing_frames", 30))
+
+def prefetches_tiles(conf):
+    """
+    Return True if the tiles of a trip are downloaded at once before the render
+    Only the local tile server is prefetched from: the tile usage policy of tile.openstreetmap.org forbids bulk
+    downloads, its tiles are downloaded on demand during the render
+    conf: app configuration
+    """
+    return conf["map_generation_mean"] == "local"
+
+def prefetch_map_tiles(conf, tile_store: TileStore, latitudes, longitudes, degree_ranges):
+    """
+    Download at once every tile the maps of a trip need, so the render never waits for the tile server
+    Only used with the local tile server, see prefetches_tiles
+    conf: app configuration
+    tile_store: persistent tile store the tiles are stored in
+    latitudes: latitude of each frame
+    longitudes: longitude of each frame
+    degree_ranges: half size of the map extent of each frame in degrees
+    return the number of tiles (requested, downloaded, failed)
+    """
+    renderer = build_map_renderer(conf, tile_store)
+    return renderer.tiles.prefetch(renderer.plan_tiles(latitudes, longitudes, degree_ranges),
+                                   conf["map_generation"].get("prefetch_concurrency", 4))
+
+def retrieve_save_map(lat, lon, renderer: MapRenderer, output_title, output_path, degree_range=None):
     """
     Retrieve and save the map corresponding on the lat lon coordinates
-    gps_coords: gps coordinates
-    tiles: tilemapbase instance
+    lat: latitudes driven so far, the map is centered on the last one
+    lon: longitudes driven so far
+    renderer: map renderer stitching the tiles
     output_title: output title
     output_path: folder name to save the map to
+    degree_range: half size of the map extent in degrees, the default one of the renderer if None
     """
-    degree_range = 0.005 # 0.005 min -> 0.1 max, TODO make it variable depending on the vehicle speed
-    extent = tilemapbase.Extent.from_lonlat(
-        lon[-1] - degree_range, lon[-1] + degree_range, lat[-1] - degree_range, lat[-1] + degree_range)
-    extent = extent.to_aspect(1.0)
-    plotter = tilemapbase.Plotter(extent, tiles, width=500)
-    plotter.as_one_image(True).save(output_path+"/"+output_title+".png")
+    if renderer.route is not None:
+        renderer.route.add_point(lat[-1], lon[-1])
+    map_image = renderer.render(lat[-1], lon[-1], degree_range)
+    cv2.imwrite(output_path+"/"+output_title+".png", map_image)
 
-def combine(map_path, frame_path, timestamp, latitude, longitude):
+def read_image(image):
+    """
+    Return the image as a BGR ndarray
+    image: BGR ndarray, returned as is, or path to the image file to read
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    return cv2.imread(image)
+
+def combine(map_image, frame, timestamp, latitude, longitude):
     """
     Combine the timelapse frame and the map to display
-    map_path: folder path to the map
+    map_image: map as a BGR ndarray or path to the map file
     timestamp: timestamp
     latitude: latitude
     longitude: longitude
-    frame_path: folder path to the timelapse frame
+    frame: timelapse frame as a BGR ndarray or path to the frame file
     """
     # Read images
-    map_image = cv2.imread(map_path)
-    frame = cv2.imread(frame_path)
-    x_offset = y_offset = 20
+    map_image = read_image(map_image)
+    frame = read_image(frame)
 
     if frame is None:
         return  # Skip if the frame is empty
 
-    # Create a circle mask
-    mask = np.zeros(frame.shape[:2], dtype="uint8")
-    circle_radius = int(min(frame.shape[0], frame.shape[1])*0.2) # 20% of the min frame size
-    circle_center = (frame.shape[1] - circle_radius - y_offset, frame.shape[0] - circle_radius - x_offset)
-    cv2.circle(mask, circle_center, circle_radius, 255, -1)
-    mask_inv = cv2.bitwise_not(mask)
-    frame_masked = cv2.bitwise_and(frame, frame, mask=mask_inv)
-
-    # Resize the map image to the shape of the mask circle
-    min_shape = circle_radius*2
-    if min(map_image.shape[0:2]) == map_image.shape[0]:
-        resize = (int(min_shape), int(min_shape * map_image.shape[0]/map_image.shape[1]))
-    else:
-        resize = (int(min_shape * map_image.shape[0]/map_image.shape[0]), int(min_shape))
-
-    map_image = cv2.resize(map_image, resize)
-
-    # Incrust the map mask onto the frame
-    frame[frame.shape[0] - map_image.shape[0] - y_offset : frame.shape[0] - y_offset,
-          frame.shape[1] - map_image.shape[1] - x_offset : frame.shape[1] - x_offset] = map_image
-    map_masked = cv2.bitwise_and(frame, frame, mask=mask)
-    dst = cv2.add(frame_masked, map_masked)
-    frame[0:frame.shape[0], 0:frame.shape[1]] = dst
+    # Incrust the map inside of the circle mask (only the inset region is written)
+    _compositor.apply(frame, map_image)
 
     # Diplay metadata
     date = timestamp
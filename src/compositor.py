@@ -0,0 +1,61 @@
+import numpy as np
+import cv2
+
+
+class Compositor:
+    """
+    Blend the circular map inset into the bottom right corner of the frames
+    The circle mask, the inset placement and the resize target are computed once per
+    (frame size, inset size) and only the inset region of interest of the frame is written
+    offset: distance in pixels between the inset and the frame borders
+    radius_ratio: radius of the inset circle relatively to the min frame size
+    """
+    def __init__(self, offset=20, radius_ratio=0.2):
+        self.offset = offset
+        self.radius_ratio = radius_ratio
+        self._layouts = {}
+
+    def layout(self, frame_shape, map_shape):
+        """
+        Return the cached (resize, rows, cols, mask) layout of the inset
+        frame_shape: shape of the frame
+        map_shape: shape of the map image
+        """
+        key = (frame_shape[:2], map_shape[:2])
+        layout = self._layouts.get(key)
+        if layout is None:
+            layout = self._compute_layout(frame_shape, map_shape)
+            self._layouts[key] = layout
+        return layout
+
+    def _compute_layout(self, frame_shape, map_shape):
+        height, width = frame_shape[:2]
+        circle_radius = int(min(height, width)*self.radius_ratio)
+        circle_center = (width - circle_radius - self.offset, height - circle_radius - self.offset)
+
+        # Resize the map image to the shape of the mask circle
+        min_shape = circle_radius*2
+        if min(map_shape[0:2]) == map_shape[0]:
+            resize = (int(min_shape), int(min_shape * map_shape[0]/map_shape[1]))
+        else:
+            resize = (int(min_shape), int(min_shape))
+
+        # Region of interest of the inset and circle mask inside of it
+        rows = slice(height - resize[1] - self.offset, height - self.offset)
+        cols = slice(width - resize[0] - self.offset, width - self.offset)
+        mask = np.zeros((resize[1], resize[0]), dtype="uint8")
+        cv2.circle(mask, (circle_center[0] - cols.start, circle_center[1] - rows.start), circle_radius, 255, -1)
+        return resize, rows, cols, mask
+
+    def apply(self, frame, map_image):
+        """
+        Incrust the map inside of the frame circle, in place
+        frame: BGR frame
+        map_image: BGR map image
+        return the frame
+        """
+        resize, rows, cols, mask = self.layout(frame.shape, map_image.shape)
+        if map_image.shape[1] != resize[0] or map_image.shape[0] != resize[1]:
+            map_image = cv2.resize(map_image, resize)
+        cv2.copyTo(map_image, mask, frame[rows, cols])
+        return frame
@@ -0,0 +1,330 @@
+import shutil
+import logging
+import subprocess
+import numpy as np
+import cv2
+from PIL import Image, GifImagePlugin
+
+
+class Encoder:
+    """
+    Base class of the video encoders; frames are BGR ndarrays of the video frame size
+    output_path: path to the video file to write
+    frame_size: (width, height) of the video
+    fps: video frame rate
+    """
+    def __init__(self, output_path, frame_size, fps):
+        self.output_path = output_path
+        self.frame_size = tuple(frame_size)
+        self.fps = fps
+
+    def write(self, frame):
+        raise NotImplementedError()
+
+    def release(self):
+        raise NotImplementedError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class OpenCVEncoder(Encoder):
+    """
+    Encode the video with cv2.VideoWriter
+    fourcc: four character code of the codec
+    """
+    def __init__(self, output_path, frame_size, fps, fourcc="mp4v"):
+        super().__init__(output_path, frame_size, fps)
+        self._writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps, self.frame_size)
+
+    def write(self, frame):
+        self._writer.write(frame)
+
+    def release(self):
+        self._writer.release()
+
+
+class FFmpegEncoder(Encoder):
+    """
+    Encode the video by streaming the raw BGR frames to a local ffmpeg process
+    codec: ffmpeg video codec (libx264, libx265)
+    preset: encoder preset
+    crf: constant rate factor
+    threads: number of encoding threads, 0 to let ffmpeg decide
+    """
+    def __init__(self, output_path, frame_size, fps, codec="libx264", preset="veryfast", crf=23, threads=0):
+        super().__init__(output_path, frame_size, fps)
+        args = ["ffmpeg", "-y", "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", "{}x{}".format(*self.frame_size), "-r", str(fps), "-i", "-",
+                "-c:v", codec, "-preset", preset, "-crf", str(crf), "-threads", str(threads),
+                "-pix_fmt", "yuv420p", "-movflags", "+faststart", output_path]
+        logging.debug("Start encoder: " + " ".join(args))
+        self._process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def write(self, frame):
+        if (frame.shape[1], frame.shape[0]) != self.frame_size:
+            logging.warning("Skip frame of size " + repr(frame.shape) + ", the video size is " + repr(self.frame_size))
+            return
+        self._process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        if self._process.returncode is not None:
+            return
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass  # ffmpeg exited early (broken pipe), its error is read below
+        error = self._process.stderr.read().decode("utf-8", "replace")
+        if self._process.wait() != 0:
+            raise RuntimeError("ffmpeg failed to encode " + self.output_path + ": " + error)
+
+
+class WebPEncoder(FFmpegEncoder):
+    """
+    Encode an animated WebP by streaming the raw BGR frames to a local ffmpeg process (libwebp_anim)
+    quality: WebP quality between 0 and 100
+    loop: number of loops, 0 to loop forever
+    """
+    def __init__(self, output_path, frame_size, fps, quality=75, loop=0):
+        Encoder.__init__(self, output_path, frame_size, fps)
+        args = ["ffmpeg", "-y", "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", "{}x{}".format(*self.frame_size), "-r", str(fps), "-i", "-",
+                "-c:v", "libwebp_anim", "-quality", str(quality), "-loop", str(loop), output_path]
+        logging.debug("Start encoder: " + " ".join(args))
+        self._process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def sample_palette(frames, colors=256):
+    """
+    Build a palette shared by the frames of an animation from a sample of them
+    frames: list of BGR frames
+    colors: number of colors of the palette
+    return a "P" mode PIL image holding the palette
+    """
+    mosaic = cv2.cvtColor(np.vstack(frames), cv2.COLOR_BGR2RGB)
+    return Image.fromarray(mosaic).quantize(colors, method=Image.Quantize.MEDIANCUT)
+
+
+class GifEncoder(Encoder):
+    """
+    Encode an animated GIF frame by frame with one global palette, so only the current frame is held in memory
+    palette: "P" mode PIL image holding the palette (see sample_palette), built from the first frame if None
+    loop: number of loops, 0 to loop forever
+    dither: dither the frames with the palette (better gradients, larger files)
+    """
+    def __init__(self, output_path, frame_size, fps, palette=None, loop=0, dither=False):
+        super().__init__(output_path, frame_size, fps)
+        self.palette = palette
+        self.loop = loop
+        self.dither = Image.Dither.FLOYDSTEINBERG if dither else Image.Dither.NONE
+        self._file = open(output_path, "wb")
+        self._header_written = False
+
+    def write(self, frame):
+        if (frame.shape[1], frame.shape[0]) != self.frame_size:
+            logging.warning("Skip frame of size " + repr(frame.shape) + ", the animation size is " + repr(self.frame_size))
+            return
+        if self.palette is None:
+            self.palette = sample_palette([frame])
+        image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)).quantize(palette=self.palette, dither=self.dither)
+        if not self._header_written:
+            header, _ = GifImagePlugin.getheader(image, info={"loop": self.loop, "optimize": False})
+            self._file.write(b"".join(header))
+            self._header_written = True
+        # GIF delays are in hundredths of second
+        for data in GifImagePlugin.getdata(image, duration=round(1000 / self.fps)):
+            self._file.write(data)
+
+    def release(self):
+        if self._file.closed:
+            return
+        self._file.write(b";")  # GIF trailer
+        self._file.close()
+
+
+def write_preview(video_path, output_path, width=480, fps=10, frame_step=1, palette_samples=16, quality=75):
+    """
+    Write a downscaled GIF or animated WebP preview of a video, reading it one frame at a time
+    The GIF palette is built beforehand from a sample of frames spread over the video
+    video_path: path to the video to preview
+    output_path: path to the .gif or .webp preview
+    width: width of the preview, the height keeps the aspect ratio
+    fps: frame rate of the preview
+    frame_step: keep one frame out of frame_step
+    palette_samples: number of frames sampled to build the GIF palette
+    quality: WebP quality
+    return the number of frames written
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise IOError("Cannot read the video " + video_path)
+    video_width, video_height = capture.get(cv2.CAP_PROP_FRAME_WIDTH), capture.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    size = (width, max(2, int(round(video_height * width / video_width / 2)) * 2))
+
+    def downscale(frame):
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    if output_path.lower().endswith(".webp"):
+        preview = WebPEncoder(output_path, size, fps, quality)
+    else:
+        samples = []
+        count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        for idx in np.unique(np.linspace(0, max(count - 1, 0), palette_samples).astype(int)):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, int(idx))
+            ok, frame = capture.read()
+            if ok:
+                samples.append(downscale(frame))
+        capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        preview = GifEncoder(output_path, size, fps, sample_palette(samples) if samples else None)
+    written = 0
+    try:
+        idx = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            if idx % frame_step == 0:
+                preview.write(downscale(frame))
+                written += 1
+            idx += 1
+    finally:
+        capture.release()
+        preview.release()
+    return written
+
+
+class ContactSheetEncoder(Encoder):
+    """
+    Contact sheet of thumbnails evenly spread over the video, written as one image on release
+    When the video is rendered in segments each segment writes its own cells, merged with merge_contact_sheets
+    frame_size: (width, height) of a thumbnail
+    frame_total: number of frames of the whole video
+    columns: number of thumbnails per row
+    rows: maximum number of rows
+    frame_offset: index in the whole video of the first frame of the segment
+    """
+    scales_frames = True  # Only the picked frames are resized
+
+    def __init__(self, output_path, frame_size, fps, frame_total, columns=6, rows=8, frame_offset=0):
+        super().__init__(output_path, frame_size, fps)
+        picks = np.unique(np.linspace(0, max(frame_total - 1, 0), min(columns * rows, max(frame_total, 1))).round().astype(int))
+        self._cells = {int(idx): cell for cell, idx in enumerate(picks)}
+        self.columns = columns
+        width, height = self.frame_size
+        self._sheet = np.zeros((-(-len(picks) // columns) * height, columns * width, 3), np.uint8)
+        self.frame_offset = frame_offset
+        self._index = frame_offset
+
+    def write(self, frame, index=None):
+        """
+        Write a frame, kept if it is one of the picked frames
+        frame: BGR frame
+        index: index of the frame in the segment, the frames skipped by the render do not shift the cells;
+        if None the frame follows the previous one
+        """
+        if index is not None:
+            self._index = self.frame_offset + index
+        cell = self._cells.get(self._index)
+        self._index += 1
+        if cell is None:
+            return
+        width, height = self.frame_size
+        row, col = divmod(cell, self.columns)
+        self._sheet[row * height:(row + 1) * height, col * width:(col + 1) * width] = \
+            cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+
+    def release(self):
+        if self._sheet is None:
+            return
+        cv2.imwrite(self.output_path, self._sheet)
+        self._sheet = None
+
+
+def merge_contact_sheets(sheet_paths, output_path):
+    """
+    Merge the contact sheets written by the segments of a video, each one holding its own cells
+    sheet_paths: paths to the segment contact sheets (lossless images)
+    output_path: path to the merged contact sheet
+    """
+    sheet = None
+    for sheet_path in sheet_paths:
+        image = cv2.imread(sheet_path)
+        sheet = image if sheet is None else np.maximum(sheet, image, out=sheet)
+    cv2.imwrite(output_path, sheet)
+
+
+class FanOutEncoder(Encoder):
+    """
+    Write each composited frame to several encoders (sinks) of different sizes and codecs
+    A frame is resized once per sink size; the contact sheets resize the frames they keep themselves
+    sinks: list of Encoder, the first one is the main output
+    """
+    def __init__(self, sinks):
+        super().__init__(sinks[0].output_path, sinks[0].frame_size, sinks[0].fps)
+        self.sinks = sinks
+
+    def write(self, frame, index=None):
+        """
+        Write a frame to every sink
+        frame: BGR frame
+        index: optional index of the frame in the segment, given to the sinks picking frames (contact sheets)
+        """
+        size = (frame.shape[1], frame.shape[0])
+        resized = {size: frame}
+        for sink in self.sinks:
+            if getattr(sink, "scales_frames", False):
+                sink.write(frame, index)
+                continue
+            if sink.frame_size not in resized:
+                resized[sink.frame_size] = cv2.resize(frame, sink.frame_size, interpolation=cv2.INTER_AREA)
+            sink.write(resized[sink.frame_size])
+
+    def release(self):
+        errors = []
+        for sink in self.sinks:
+            try:
+                sink.release()
+            except (RuntimeError, OSError) as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+
+def build_output_encoder(conf, output, output_path, fps, frame_total=0, frame_offset=0) -> Encoder:
+    """
+    Build the encoder of an extra output described in the configuration
+    conf: app configuration
+    output: output configuration, "type" is "video" (the default) or "contact_sheet"; the video outputs
+    can override the encoder configuration keys (backend, codec, preset, crf, ...)
+    output_path: path to the file to write
+    fps: video frame rate
+    frame_total: number of frames of the whole video, for the contact sheets
+    frame_offset: index of the first frame written in the whole video, for the contact sheets
+    """
+    if output.get("type", "video") == "contact_sheet":
+        return ContactSheetEncoder(output_path, (output.get("width", 320), output.get("height", 180)), fps, frame_total,
+                                   output.get("columns", 6), output.get("rows", 8), frame_offset)
+    return build_encoder({"encoder": dict(conf.get("encoder", {}), **output)}, output_path,
+                         (output["width"], output["height"]), fps)
+
+
+def build_encoder(conf, output_path, frame_size, fps) -> Encoder:
+    """
+    Build the video encoder described in the configuration, falling back to OpenCV if ffmpeg is not installed
+    conf: app configuration
+    output_path: path to the video file to write
+    frame_size: (width, height) of the video
+    fps: video frame rate
+    """
+    encoder_conf = conf.get("encoder", {})
+    backend = encoder_conf.get("backend", "opencv")
+    if backend == "ffmpeg":
+        if shutil.which("ffmpeg"):
+            return FFmpegEncoder(output_path, frame_size, fps, encoder_conf.get("codec", "libx264"),
+                                 encoder_conf.get("preset", "veryfast"), encoder_conf.get("crf", 23),
+                                 encoder_conf.get("threads", 0))
+        logging.warning("ffmpeg is not installed, fall back to the OpenCV encoder")
+    return OpenCVEncoder(output_path, frame_size, fps, encoder_conf.get("fourcc", "mp4v"))
@@ -0,0 +1,187 @@
+import os
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+import logging
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+_EVENT = struct.Struct("iIII")
+
+# Kind of the reported events
+FOLDER = "folder"  # a trip folder was created
+FRAME = "frame"  # a frame was written in a trip folder
+REMOVED = "removed"  # a trip folder was removed
+RESCAN = "rescan"  # events were lost, the folders must be listed again
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError:
+        return None
+    # Missing on non Linux systems
+    return libc if hasattr(libc, "inotify_init1") else None
+
+
+class FolderWatcher:
+    """
+    Watch a folder of trip folders for the new trip folders and the frames written in them
+    Built on Linux inotify, it falls back to listing the folders periodically when inotify is not available
+    The watcher can be woken from another thread or process (created before the fork) with wake()
+    path: folder of the trip folders, created if it does not exist
+    suffix: file name suffix of the frames
+    poll_period: period in seconds of the fallback polling
+    use_inotify: set False to force the polling
+    """
+    def __init__(self, path, suffix=".jpg", poll_period=1.0, use_inotify=True):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.suffix = suffix
+        self.poll_period = poll_period
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+        self._fd = None
+        self._watches = {}
+        self._snapshot = None
+        libc = _load_libc() if use_inotify else None
+        if libc is not None:
+            fd = libc.inotify_init1(IN_NONBLOCK)
+            if fd >= 0:
+                self._libc = libc
+                self._fd = fd
+                self._add_watch(path, IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_ONLYDIR)
+                for name in os.listdir(path):
+                    if os.path.isdir(os.path.join(path, name)):
+                        self._add_watch(os.path.join(path, name), IN_CLOSE_WRITE | IN_MOVED_TO | IN_ONLYDIR)
+            else:
+                logging.warning("inotify is not available (" + os.strerror(ctypes.get_errno()) + "), poll the folders")
+        if self._fd is None:
+            self._snapshot = self._list()
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def _add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            # The folder may be removed in the meantime
+            if ctypes.get_errno() != errno.ENOENT:
+                logging.warning("Cannot watch " + path + ": " + os.strerror(ctypes.get_errno()))
+            return
+        self._watches[wd] = path
+
+    def _list(self):
+        snapshot = {}
+        for name in os.listdir(self.path):
+            folder = os.path.join(self.path, name)
+            if os.path.isdir(folder):
+                try:
+                    snapshot[folder] = {frame for frame in os.listdir(folder) if frame.endswith(self.suffix)}
+                except FileNotFoundError:
+                    pass
+        return snapshot
+
+    def wake(self):
+        """
+        Make the current or next wait() return immediately
+        """
+        try:
+            os.write(self._wake_write, b"\0")
+        except BlockingIOError:
+            pass  # Already woken
+
+    def wait(self, timeout=None):
+        """
+        Wait for the next events
+        timeout: maximum wait in seconds, None to wait forever
+        return the list of (kind, path) events, empty on timeout or wake()
+        """
+        if self._fd is None:
+            return self._poll(timeout)
+        readable, _, _ = select.select([self._fd, self._wake_read], [], [], timeout)
+        if self._wake_read in readable:
+            self._drain_wake()
+        if self._fd not in readable:
+            return []
+        return self._read_events()
+
+    def _drain_wake(self):
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _read_events(self):
+        events = []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return events
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b"\0"))
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                events.append((RESCAN, self.path))
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            folder = self._watches.get(wd)
+            if folder is None:
+                continue
+            path = os.path.join(folder, name)
+            if folder == self.path:
+                if not mask & IN_ISDIR:
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_watch(path, IN_CLOSE_WRITE | IN_MOVED_TO | IN_ONLYDIR)
+                    events.append((FOLDER, path))
+                else:
+                    events.append((REMOVED, path))
+            elif not mask & IN_ISDIR and name.endswith(self.suffix):
+                events.append((FRAME, path))
+        return events
+
+    def _poll(self, timeout):
+        waited = 0.0
+        while True:
+            period = self.poll_period if timeout is None else min(self.poll_period, timeout - waited)
+            readable, _, _ = select.select([self._wake_read], [], [], max(period, 0))
+            if readable:
+                self._drain_wake()
+            snapshot = self._list()
+            events = [(FOLDER, folder) for folder in snapshot if folder not in self._snapshot]
+            events += [(REMOVED, folder) for folder in self._snapshot if folder not in snapshot]
+            for folder, frames in snapshot.items():
+                events += [(FRAME, os.path.join(folder, frame))
+                           for frame in sorted(frames - self._snapshot.get(folder, set()))]
+            self._snapshot = snapshot
+            waited += period
+            if events or readable or (timeout is not None and waited >= timeout):
+                return events
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        for fd in (self._wake_read, self._wake_write):
+            os.close(fd)
+        self._wake_read = self._wake_write = -1
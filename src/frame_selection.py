@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def frame_signatures(paths, width=32, threads=2):
+    """
+    Decode every frame as a tiny grayscale thumbnail, cheap enough to be run on the whole trip before the render
+    The JPEG frames are decoded scaled down by 8 (DCT scaling) then averaged down to the signature width
+    paths: list of the frame paths
+    width: width of the signatures, the height follows the aspect ratio of the frames
+    threads: number of decoding threads
+    return a float32 (frames, pixels) array of the signatures in [0, 1], NaN rows for the unreadable frames
+    """
+    size = None
+
+    def signature(path):
+        image = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if image is None:
+            return None
+        nonlocal size
+        if size is None:
+            size = (width, max(1, round(width * image.shape[0] / image.shape[1])))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    with ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="frame_selection") as executor:
+        thumbnails = list(executor.map(signature, paths))
+    pixels = size[0] * size[1] if size else 1
+    signatures = np.full((len(paths), pixels), np.nan, np.float32)
+    for idx, thumbnail in enumerate(thumbnails):
+        if thumbnail is not None and thumbnail.size == pixels:
+            signatures[idx] = thumbnail.reshape(-1)
+    signatures /= 255
+    return signatures
+
+def difference_scores(signatures):
+    """
+    Return the mean absolute difference of every frame with the previous one
+    The first frame and the frames next to an unreadable one score inf so they are never redundant
+    signatures: (frames, pixels) array returned by frame_signatures
+    """
+    scores = np.full(len(signatures), np.inf)
+    if len(signatures) > 1:
+        differences = np.abs(np.diff(signatures, axis=0)).mean(axis=1)
+        scores[1:] = np.where(np.isnan(differences), np.inf, differences)
+    return scores
+
+def frame_speeds(timestamps, latitudes, longitudes):
+    """
+    Return the speed of the car at every frame in km/h, from the distance to the previous frame
+    timestamps: int64 array of the frame timestamps in seconds
+    latitudes: latitude of each frame
+    longitudes: longitude of each frame
+    """
+    speeds = np.zeros(len(timestamps))
+    if len(timestamps) < 2:
+        return speeds
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+    # Haversine distance between consecutive frames
+    a = (np.sin(np.diff(latitudes) / 2) ** 2
+         + np.cos(latitudes[:-1]) * np.cos(latitudes[1:]) * np.sin(np.diff(longitudes) / 2) ** 2)
+    distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    durations = np.diff(np.asarray(timestamps, dtype=np.float64)) / 3600
+    speeds[1:] = np.divide(distances, durations, out=np.full(len(distances), np.inf), where=durations > 0)
+    speeds[0] = speeds[1]
+    return speeds
+
+def select_frames(scores, speeds=None, threshold=0.005, min_speed_kmh=3, keep_every=10):
+    """
+    Return the indices of the frames to render, the redundant frames are thinned out
+    A frame is redundant if it barely differs from the previous one and, when the speed is known,
+    the car is (nearly) stopped; one redundant frame out of keep_every is kept so the stops stay visible
+    scores: difference score of each frame, see difference_scores
+    speeds: optional speed of each frame in km/h, see frame_speeds
+    threshold: score below which a frame is considered identical to the previous one
+    min_speed_kmh: speed below which the car is considered stopped
+    keep_every: keep one redundant frame out of keep_every, 0 to drop them all
+    """
+    redundant = np.asarray(scores) < threshold
+    if speeds is not None:
+        redundant &= np.asarray(speeds) < min_speed_kmh
+    if len(redundant):
+        redundant[0] = redundant[-1] = False  # Keep the trip start and end
+    if keep_every > 0:
+        # Rank of each frame in its run of redundant frames, starting at 1
+        starts = np.flatnonzero(np.diff(redundant.astype(np.int8), prepend=0) == 1)
+        run_start = np.zeros(len(redundant), np.int64)
+        run_start[starts] = starts
+        run_start = np.maximum.accumulate(run_start)
+        rank = np.arange(len(redundant)) - run_start + 1
+        redundant &= rank % keep_every != 0
+    return np.flatnonzero(~redundant)
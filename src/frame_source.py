@@ -0,0 +1,64 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+
+class PrefetchFrameSource:
+    """
+    Decode the frames ahead of time on background threads and yield them in order
+    The read-ahead is bounded by a number of frames and by the memory used by the decoded frames
+    paths: list of the frame paths, in timestamp order
+    depth: maximum number of frames decoded ahead
+    max_memory_mb: maximum memory used by the frames decoded ahead, in megabytes
+    threads: number of decoding threads
+    flags: cv2.imread flags
+    """
+    def __init__(self, paths, depth=8, max_memory_mb=256, threads=2, flags=cv2.IMREAD_COLOR):
+        self.paths = paths
+        self.depth = max(1, depth)
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self.threads = max(1, threads)
+        self.flags = flags
+        self.queue_depth = 0
+
+    def __len__(self):
+        return len(self.paths)
+
+    def read(self, path):
+        """
+        Decode one frame, None if it can not be read
+        path: frame path
+        """
+        return cv2.imread(path, self.flags)
+
+    def __iter__(self):
+        window = self.depth
+        pending = deque()
+        next_idx = 0
+        executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="frame_source")
+        try:
+            while next_idx < len(self.paths) or pending:
+                while next_idx < len(self.paths) and len(pending) < window:
+                    pending.append(executor.submit(self.read, self.paths[next_idx]))
+                    next_idx += 1
+                self.queue_depth = len(pending)
+                frame = pending.popleft().result()
+                if frame is not None:
+                    # Shrink the read-ahead window to respect the memory cap
+                    window = max(1, min(self.depth, self.max_memory // max(frame.nbytes, 1)))
+                yield frame
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def reduced_read_flags(frame_width, target_width):
+    """
+    Return the cv2.imread flags decoding the frames at the smallest size still at least as wide as the target,
+    JPEG frames are then scaled down while decoded (DCT scaling) at a fraction of the full decode cost
+    frame_width: width of the frames
+    target_width: width of the largest output
+    """
+    for factor, flags in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if frame_width // factor >= target_width:
+            return flags
+    return cv2.IMREAD_COLOR
@@ -0,0 +1,136 @@
+import os
+import time
+import threading
+import numpy as np
+
+# Fixed size record of the binary track files: UTC timestamp in milliseconds, latitude, longitude
+TRACK_DTYPE = np.dtype([("timestamp", "<i8"), ("latitude", "<f8"), ("longitude", "<f8")])
+TRACK_EXTENSION = ".track"
+
+
+class GpsTrackRecorder:
+    """
+    Record the GPS fixes received during a trip in a binary track file of fixed size records
+    The latitude and longitude are received separately; a record is appended once both are received
+    folder: folder of the track files
+    flush_every: number of records buffered before they are flushed to the file
+    max_age_days: the track files not written for more than max_age_days are deleted when a recording starts,
+    0 to keep them forever
+    """
+    def __init__(self, folder, flush_every=10, max_age_days=30):
+        self.folder = folder
+        self.flush_every = flush_every
+        self.max_age_days = max_age_days
+        self._lock = threading.Lock()
+        self._file = None
+        self._pending = {}
+        self._unflushed = 0
+
+    @property
+    def recording(self):
+        return self._file is not None
+
+    def start(self, name):
+        """
+        Start recording the fixes in a new track file
+        name: name of the track, usually the trip start date
+        """
+        with self._lock:
+            self._close()
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+            prune_tracks(self.folder, self.max_age_days)
+            self._file = open(os.path.join(self.folder, name + TRACK_EXTENSION), "ab")
+            self._pending = {}
+
+    def stop(self):
+        """
+        Stop recording and close the track file
+        """
+        with self._lock:
+            self._close()
+
+    def update(self, field, value, timestamp=None):
+        """
+        Update the latitude or longitude of the current fix; ignored when not recording
+        field: "latitude" or "longitude"
+        value: value in degrees
+        timestamp: UTC timestamp in seconds, now if None
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            self._pending[field] = value
+            if "latitude" in self._pending and "longitude" in self._pending:
+                record = np.array([(int((timestamp or time.time()) * 1000), self._pending["latitude"],
+                                    self._pending["longitude"])], dtype=TRACK_DTYPE)
+                self._file.write(record.tobytes())
+                self._pending = {}
+                self._unflushed += 1
+                if self._unflushed >= self.flush_every:
+                    self._file.flush()
+                    self._unflushed = 0
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._unflushed = 0
+
+
+def read_track(path):
+    """
+    Memory map a track file
+    path: path to the track file
+    return a structured array of TRACK_DTYPE records
+    """
+    # Ignore a partially written last record
+    count = os.path.getsize(path) // TRACK_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=TRACK_DTYPE)
+    return np.memmap(path, dtype=TRACK_DTYPE, mode="r", shape=(count,))
+
+def prune_tracks(folder, max_age_days):
+    """
+    Delete the track files not written for more than max_age_days
+    folder: folder of the track files
+    max_age_days: retention of the track files in days, 0 to keep them forever
+    return the number of deleted track files
+    """
+    if max_age_days <= 0 or not os.path.exists(folder):
+        return 0
+    deleted = 0
+    oldest = time.time() - max_age_days * 86400
+    for track_name in os.listdir(folder):
+        path = os.path.join(folder, track_name)
+        if track_name.endswith(TRACK_EXTENSION) and os.path.getmtime(path) < oldest:
+            os.remove(path)
+            deleted += 1
+    return deleted
+
+def read_tracks(folder, start_ms, end_ms):
+    """
+    Read the fixes of every track file between two timestamps
+    folder: folder of the track files
+    start_ms: UTC start timestamp in milliseconds
+    end_ms: UTC end timestamp in milliseconds
+    return a structured array of TRACK_DTYPE records sorted by timestamp
+    """
+    tracks = []
+    if os.path.exists(folder):
+        for track_name in os.listdir(folder):
+            if not track_name.endswith(TRACK_EXTENSION):
+                continue
+            path = os.path.join(folder, track_name)
+            # The fixes are written after they are received, a track last written before the start has none to read
+            if os.path.getmtime(path) * 1000 < start_ms:
+                continue
+            track = read_track(path)
+            if len(track) == 0 or track["timestamp"][0] > end_ms or track["timestamp"][-1] < start_ms:
+                continue
+            mask = (track["timestamp"] >= start_ms) & (track["timestamp"] <= end_ms)
+            tracks.append(np.array(track[mask]))
+    if not tracks:
+        return np.zeros(0, dtype=TRACK_DTYPE)
+    track = np.concatenate(tracks)
+    return track[np.argsort(track["timestamp"], kind="stable")]
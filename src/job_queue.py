@@ -0,0 +1,129 @@
+import os
+import time
+import sqlite3
+import threading
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueue:
+    """
+    Durable queue of the timelapses to render backed by a single SQLite file
+    Jobs are claimed by decreasing priority then in creation order; a failed job is retried
+    with an exponential backoff until it runs out of attempts
+    path: path to the SQLite file, created if it does not exist
+    max_attempts: number of attempts before a job is marked failed
+    backoff_s: delay before the first retry, doubled at each attempt
+    """
+    def __init__(self, path, max_attempts=3, backoff_s=60):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff_s
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT,\
+             folder TEXT NOT NULL UNIQUE, state TEXT NOT NULL, priority INTEGER NOT NULL, attempts INTEGER NOT NULL,\
+             not_before REAL NOT NULL, created REAL NOT NULL, updated REAL NOT NULL, error TEXT)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority, id)")
+        self._connection.commit()
+
+    def enqueue(self, folder, priority=0):
+        """
+        Add a timelapse to render, a folder already queued is left as is
+        folder: path to the timelapse frames folder
+        priority: jobs of higher priority are rendered first
+        return True if the job was added
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT OR IGNORE INTO jobs (folder, state, priority, attempts, not_before, created, updated)\
+                 VALUES (?, ?, ?, 0, ?, ?, ?)", (folder, PENDING, priority, now, now, now))
+            self._connection.commit()
+            return cursor.rowcount == 1
+
+    def claim(self):
+        """
+        Mark the next pending job running and return it as a dict, None if no job is ready
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT * FROM jobs WHERE state = ? AND not_before <= ? ORDER BY priority DESC, id LIMIT 1",
+                (PENDING, now)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                                     (RUNNING, now, row["id"]))
+            self._connection.commit()
+            job = dict(row)
+            job["state"] = RUNNING
+            job["attempts"] += 1
+            return job
+
+    def complete(self, job_id):
+        """
+        Mark a job done
+        job_id: id of the job
+        """
+        with self._lock:
+            self._connection.execute("UPDATE jobs SET state = ?, error = NULL, updated = ? WHERE id = ?",
+                                     (DONE, time.time(), job_id))
+            self._connection.commit()
+
+    def fail(self, job_id, error):
+        """
+        Schedule a retry of a failed job, or mark it failed once it ran out of attempts
+        job_id: id of the job
+        error: description of the failure
+        return the new state of the job
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            attempts = row["attempts"] if row else self.max_attempts
+            if attempts < self.max_attempts:
+                state, not_before = PENDING, now + self.backoff * 2 ** (attempts - 1)
+            else:
+                state, not_before = FAILED, now
+            self._connection.execute("UPDATE jobs SET state = ?, not_before = ?, error = ?, updated = ? WHERE id = ?",
+                                     (state, not_before, str(error), now, job_id))
+            self._connection.commit()
+            return state
+
+    def recover(self):
+        """
+        Put back the jobs left running by a previous process in the pending state; the jobs that ran out of
+        attempts are marked failed so a job killing the process is not claimed again at every restart
+        return the number of recovered jobs
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute("UPDATE jobs SET state = ?, error = ?, updated = ? WHERE state = ? AND attempts >= ?",
+                                     (FAILED, "Interrupted on its last attempt", now, RUNNING, self.max_attempts))
+            cursor = self._connection.execute("UPDATE jobs SET state = ?, updated = ? WHERE state = ?",
+                                              (PENDING, now, RUNNING))
+            self._connection.commit()
+            return cursor.rowcount
+
+    def counts(self):
+        """
+        Return the number of jobs in each state
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        counts = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        counts.update({state: count for state, count in rows})
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
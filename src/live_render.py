@@ -0,0 +1,187 @@
+import os
+import shutil
+import logging
+import threading
+import subprocess
+import multiprocessing
+import numpy as np
+from alignment import parse_frame_timestamps
+from common import retrieve_frame_positions, configure_logging, log_config
+from render import render_segment, concat_segments
+from manifest import RenderManifest
+from folder_watcher import FolderWatcher, FRAME, RESCAN
+
+
+def live_render(timelapse_tmp_path, timelapse_generated_path, known_folders, conf, stop_event, logging_config):
+    """
+    Render the timelapse in fixed length chunks while the frames are still captured
+    Run in a low priority process; when the capture stops only the last chunk is rendered and
+    the segments are joined without re-encoding
+    timelapse_tmp_path: capture temporary folder
+    timelapse_generated_path: path to result folder
+    known_folders: timelapse folders existing before the capture started
+    conf: app configuration
+    stop_event: event set when the capture stops
+    logging_config: logging configuration of the daemon, see configure_logging
+    """
+    configure_logging(logging_config)
+    # Never delay the capture
+    os.nice(conf.get("live_render", {}).get("nice", 19))
+    if shutil.which("ionice"):
+        subprocess.run(["ionice", "-c", "3", "-p", str(os.getpid())], check=False)
+    watcher = FolderWatcher(timelapse_tmp_path)
+
+    def wake_on_stop():
+        stop_event.wait()
+        watcher.wake()
+
+    # Wake the render as soon as the capture stops
+    waker = threading.Thread(target=wake_on_stop, name="live_render_stop", daemon=True)
+    waker.start()
+    try:
+        render_capture(timelapse_tmp_path, timelapse_generated_path, known_folders, conf, stop_event, watcher)
+    finally:
+        stop_event.set()
+        waker.join()
+        watcher.close()
+
+def render_capture(timelapse_tmp_path, timelapse_generated_path, known_folders, conf, stop_event, watcher):
+    """
+    Render the chunks of the capture, see live_render
+    watcher: FolderWatcher of the capture temporary folder, woken when the capture stops
+    """
+    live_conf = conf.get("live_render", {})
+    chunk_frames = live_conf.get("chunk_frames", 300)
+    poll_period = live_conf.get("poll_period_s", 10)
+    min_frames = live_conf.get("min_frames", 300)
+    frame_size = (conf.get("encoder", {}).get("width", 2304), conf.get("encoder", {}).get("height", 1296))
+    fps = conf.get("encoder", {}).get("fps", 10)
+
+    # Wait for the capture to create its timelapse folder
+    timelapse_folder = None
+    while timelapse_folder is None:
+        new_folders = sorted(set(os.listdir(timelapse_tmp_path)) - set(known_folders)) if os.path.exists(timelapse_tmp_path) else []
+        if new_folders:
+            timelapse_folder = os.path.join(timelapse_tmp_path, new_folders[-1])
+        elif stop_event.is_set():
+            return
+        else:
+            watcher.wait(poll_period)
+    result_folder = os.path.join(timelapse_generated_path, os.path.basename(timelapse_folder))
+    # Apart from the segments of a post-trip render of the same timelapse
+    segment_folder = os.path.join(result_folder, "live_segments")
+    os.makedirs(segment_folder, exist_ok=True)
+    # Unfinished until the segments are joined, so an interrupted live render is rendered again after the trip
+    RenderManifest(result_folder, []).save()
+    logging.info("Start live render of " + timelapse_folder)
+
+    segment_paths = []
+    rendered = 0
+    # Number of frames written since the last listing, the folder is listed only once a chunk is complete
+    new_frames = chunk_frames
+    history_latitudes, history_longitudes = np.zeros(0), np.zeros(0)
+    try:
+        while True:
+            stopping = stop_event.is_set()
+            if stopping or new_frames >= chunk_frames:
+                images_sorted = sorted(image for image in os.listdir(timelapse_folder) if image.endswith(".jpg"))
+                # The last frame may still be written by the capture
+                complete = images_sorted if stopping else images_sorted[:-1]
+                while len(complete) - rendered >= chunk_frames or (stopping and len(complete) > rendered):
+                    chunk = complete[rendered:rendered + chunk_frames]
+                    latitudes, longitudes = retrieve_frame_positions(parse_frame_timestamps(chunk), conf, use_database=False)
+                    segment_path = os.path.join(segment_folder, "segment_{:04d}.mp4".format(len(segment_paths)))
+                    render_segment(segment_path, [os.path.join(timelapse_folder, image) for image in chunk],
+                                   [os.path.splitext(image)[0] for image in chunk], latitudes, longitudes, None,
+                                   conf, frame_size, fps, None, (history_latitudes, history_longitudes))
+                    if latitudes is not None:
+                        history_latitudes = np.concatenate([history_latitudes, latitudes])
+                        history_longitudes = np.concatenate([history_longitudes, longitudes])
+                    segment_paths.append(segment_path)
+                    rendered += len(chunk)
+                    logging.info("Live render: " + str(rendered) + " frames rendered")
+                new_frames = len(complete) - rendered
+            if stopping:
+                break
+            for kind, path in watcher.wait(poll_period):
+                if kind == RESCAN:
+                    new_frames = chunk_frames
+                elif kind == FRAME and os.path.dirname(path) == timelapse_folder:
+                    new_frames += 1
+
+        if rendered < min_frames:
+            logging.warning("The timelapse is too short (" + str(rendered) + " images). The live render is dropped")
+            shutil.rmtree(result_folder)
+            return
+        concat_segments(segment_paths, os.path.join(result_folder, "video.mp4"))
+        shutil.rmtree(segment_folder)
+        RenderManifest(result_folder, complete[:rendered]).mark_done()
+        logging.info("Timelapse saved: " + result_folder + "/video.mp4")
+    except Exception:
+        # Let the post-trip render generate this timelapse
+        logging.exception("Live render of " + timelapse_folder + " failed")
+        shutil.rmtree(result_folder, ignore_errors=True)
+
+
+class LiveRenderer:
+    """
+    Low priority process rendering the current capture while driving
+    timelapse_tmp_path: capture temporary folder
+    timelapse_generated_path: path to result folder
+    conf: app configuration
+    """
+    def __init__(self, timelapse_tmp_path, timelapse_generated_path, conf):
+        self.timelapse_tmp_path = timelapse_tmp_path
+        self.timelapse_generated_path = timelapse_generated_path
+        self.conf = conf
+        # Started from the forkserver, a fork of the multi-threaded daemon could inherit a held lock
+        context = multiprocessing.get_context("forkserver")
+        self._stop_event = context.Event()
+        os.makedirs(timelapse_tmp_path, exist_ok=True)
+        self._known_folders = set(os.listdir(timelapse_tmp_path))
+        self._process = context.Process(target=live_render, name="live_render", daemon=True,
+                                        args=(timelapse_tmp_path, timelapse_generated_path, sorted(self._known_folders),
+                                              conf, self._stop_event, log_config))
+
+    def start(self):
+        self._process.start()
+
+    def finish(self):
+        """
+        Notify the capture stopped; the last chunk is rendered and the segments joined in the background
+        """
+        self._stop_event.set()
+
+    def owns(self, timelapse_folder):
+        """
+        Return True if the timelapse folder may be rendered by this live render, which owns every folder
+        created since the capture started until its render process ends
+        timelapse_folder: path to the timelapse frames folder
+        """
+        return self._process.is_alive() and os.path.basename(timelapse_folder) not in self._known_folders
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+    def join(self, timeout=None):
+        self._process.join(timeout)
+
+    def stop(self, timeout=None):
+        """
+        Finish the render and wait for it, the render process is terminated if it does not end in time;
+        its result folder is then left unfinished and the timelapse is rendered again after the trip
+        timeout: maximum wait in seconds, None to wait forever
+        """
+        self.finish()
+        self._process.join(timeout)
+        if self._process.is_alive():
+            logging.warning("The live render did not end within " + str(timeout) + " seconds, terminate it")
+            self._process.terminate()
+            self._process.join()
+        self.close()
+
+    def close(self):
+        """
+        Release the finished render process
+        """
+        self._process.close()
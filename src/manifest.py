@@ -0,0 +1,148 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+class RenderManifest:
+    """
+    Checkpoint manifest of a timelapse render, stored as JSON in its result folder
+    It tracks the rendered segments (frame ranges and files), the GPS alignment and the frame selection so an
+    interrupted render resumes from the last finished segment
+    result_folder: result folder of the timelapse
+    frames: list of the frame names rendered
+    """
+    FILENAME = "manifest.json"
+    ALIGNMENT_FILENAME = "alignment.npz"
+    SELECTION_FILENAME = "selection.npy"
+
+    def __init__(self, result_folder, frames):
+        self.result_folder = result_folder
+        self.path = os.path.join(result_folder, self.FILENAME)
+        self.data = {"frames": len(frames), "frames_digest": self.digest(frames), "alignment": False,
+                     "segments": [], "done": False}
+
+    @staticmethod
+    def digest(frames):
+        return hashlib.sha1("\n".join(frames).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def load(cls, result_folder, frames):
+        """
+        Load the manifest of a previous render of the same frames, or start a new one
+        result_folder: result folder of the timelapse
+        frames: list of the frame names rendered
+        """
+        manifest = cls(result_folder, frames)
+        if os.path.exists(manifest.path):
+            try:
+                with open(manifest.path, "r") as file:
+                    data = json.load(file)
+                if data.get("frames_digest") == manifest.data["frames_digest"]:
+                    manifest.data = data
+            except ValueError:
+                pass  # Corrupted manifest, render again
+        return manifest
+
+    @classmethod
+    def is_unfinished(cls, result_folder):
+        """
+        Return True if the result folder holds an interrupted render
+        result_folder: result folder of the timelapse
+        """
+        path = os.path.join(result_folder, cls.FILENAME)
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, "r") as file:
+                return not json.load(file).get("done", False)
+        except ValueError:
+            return True
+
+    def save(self):
+        """
+        Write the manifest atomically so a power cut never leaves a partial file
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.data, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+    @property
+    def done(self):
+        return self.data["done"]
+
+    def mark_done(self):
+        self.data["done"] = True
+        self.save()
+
+    def save_alignment(self, latitudes, longitudes):
+        """
+        Checkpoint the GPS alignment of the frames
+        latitudes: latitude of each frame, None if the frames have no position
+        longitudes: longitude of each frame
+        """
+        if latitudes is not None:
+            np.savez(os.path.join(self.result_folder, self.ALIGNMENT_FILENAME), latitudes=latitudes, longitudes=longitudes)
+        self.data["alignment"] = True
+        self.data["aligned"] = latitudes is not None
+        self.save()
+
+    def load_alignment(self):
+        """
+        Return the checkpointed (latitudes, longitudes), (None, None) if the frames have no position
+        or False if the alignment was not checkpointed
+        """
+        if not self.data["alignment"]:
+            return False
+        if not self.data.get("aligned", False):
+            return None, None
+        path = os.path.join(self.result_folder, self.ALIGNMENT_FILENAME)
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as alignment:
+            return alignment["latitudes"], alignment["longitudes"]
+
+    def save_selection(self, selected):
+        """
+        Checkpoint the indices of the frames rendered, the segment frame ranges index this selection
+        selected: int array of the selected frame indices
+        """
+        np.save(os.path.join(self.result_folder, self.SELECTION_FILENAME), np.asarray(selected, dtype=np.int64))
+        self.data["selection"] = True
+        self.save()
+
+    def load_selection(self):
+        """
+        Return the checkpointed indices of the frames rendered, None if the selection was not checkpointed
+        """
+        path = os.path.join(self.result_folder, self.SELECTION_FILENAME)
+        if not self.data.get("selection", False) or not os.path.exists(path):
+            return None
+        return np.load(path)
+
+    def segment_done(self, start, stop):
+        """
+        Return True if the segment of the frame range is already rendered
+        start: first frame index
+        stop: frame index after the last one
+        """
+        for segment in self.data["segments"]:
+            if segment["start"] == start and segment["stop"] == stop:
+                return os.path.exists(os.path.join(self.result_folder, segment["path"]))
+        return False
+
+    def mark_segment(self, start, stop, segment_path):
+        """
+        Record a rendered segment
+        start: first frame index
+        stop: frame index after the last one
+        segment_path: path to the segment file
+        """
+        self.data["segments"] = [segment for segment in self.data["segments"]
+                                 if segment["start"] != start or segment["stop"] != stop]
+        self.data["segments"].append({"start": start, "stop": stop,
+                                      "path": os.path.relpath(segment_path, self.result_folder)})
+        self.save()
@@ -0,0 +1,263 @@
+import math
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+BLANK_TILE_COLOR = 224  # Light gray
+
+
+def project(longitude, latitude):
+    """
+    Project the longitude/latitude coordinates to the unit square of the web mercator projection
+    longitude: longitude in degrees
+    latitude: latitude in degrees
+    return the (x, y) coordinates between 0 and 1
+    """
+    x = (longitude + 180.0) / 360.0
+    lat_rad = math.radians(latitude)
+    y = (1.0 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad)) / math.pi) / 2.0
+    return x, y
+
+
+def square_extent(lat, lon, degree_range):
+    """
+    Compute the square web mercator extent centered on the position, same as
+    tilemapbase.Extent.from_lonlat(...).to_aspect(1.0)
+    lat: latitude
+    lon: longitude
+    degree_range: half size of the extent in degrees
+    return (xmin, xmax, ymin, ymax) in the unit square
+    """
+    xmin, ymax = project(lon - degree_range, lat - degree_range)
+    xmax, ymin = project(lon + degree_range, lat + degree_range)
+    side = min(xmax - xmin, ymax - ymin)
+    xmid, ymid = (xmin + xmax) / 2, (ymin + ymax) / 2
+    return xmid - side / 2, xmid + side / 2, ymid - side / 2, ymid + side / 2
+
+
+def plan_degree_ranges(speeds, min_range=0.005, max_range=0.1, max_speed_kmh=130, window=30):
+    """
+    Plan the map extent of every frame from the speed of the car, zooming out as it drives faster
+    The speeds are smoothed with a centered moving average so the map does not pump at each speed change
+    speeds: speed of each frame in km/h
+    min_range: half size of the extent in degrees when the car is stopped
+    max_range: half size of the extent in degrees at max_speed_kmh and above
+    max_speed_kmh: speed of the widest extent
+    window: number of frames of the moving average
+    return a float64 array of the half size of the extent of each frame in degrees
+    """
+    speeds = np.nan_to_num(np.asarray(speeds, dtype=np.float64), posinf=max_speed_kmh)
+    if len(speeds) == 0:
+        return np.zeros(0)
+    window = max(1, min(window, len(speeds)))
+    padded = np.pad(speeds, (window // 2, window - 1 - window // 2), mode="edge")
+    smoothed = np.convolve(padded, np.full(window, 1 / window), mode="valid")
+    ratio = np.clip(smoothed / max_speed_kmh, 0, 1)
+    return min_range + ratio * (max_range - min_range)
+
+
+class InsetCache:
+    """
+    Least recently used cache of the rendered map insets, bounded in memory
+    The insets are keyed by their position snapped to a pixel grid, their scale snapped to relative steps,
+    their zoom level, their style and the version of the route drawn over them
+    max_mb: maximum memory used by the cached insets in megabytes
+    grid_px: step in map pixels of the grid the inset centers are snapped to
+    scale_step: relative step the inset extents are snapped to
+    """
+    def __init__(self, max_mb=64, grid_px=4, scale_step=0.01):
+        self.max_size = int(max_mb * 1024 * 1024)
+        self.grid_px = grid_px
+        self.scale_step = scale_step
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._insets = OrderedDict()
+
+    def __len__(self):
+        return len(self._insets)
+
+    def get(self, key):
+        """
+        Return the cached inset or None
+        key: inset key
+        """
+        image = self._insets.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._insets.move_to_end(key)
+        return image
+
+    def put(self, key, image):
+        """
+        Cache an inset, made read-only since it is shared by the frames, and evict the least recently used ones
+        key: inset key
+        image: rendered inset
+        """
+        image.flags.writeable = False
+        self._insets[key] = image
+        self._size += image.nbytes
+        while self._size > self.max_size and len(self._insets) > 1:
+            _, evicted = self._insets.popitem(last=False)
+            self._size -= evicted.nbytes
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Return the hit/miss counters and the current size of the cache
+        """
+        requests_count = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "insets": len(self._insets),
+                "size_bytes": self._size, "hit_ratio": self.hits / requests_count if requests_count else 0.0}
+
+
+class MapRenderer:
+    """
+    Render the map insets by stitching the tiles under an extent directly into a BGR ndarray
+    The decoded tiles are kept in memory so the consecutive frames do not decode them again
+    tiles: tile provider (tilemapbase.tiles.Tiles or StoredTiles)
+    width: width and height in pixels of the rendered map
+    degree_range: default half size of the map extent in degrees
+    max_decoded_tiles: number of decoded tiles kept in memory
+    route: optional RouteLayer drawn over the maps
+    inset_cache: optional InsetCache reusing the insets of the same viewport, e.g. while stopped; the inset
+    positions and scales are then snapped to the cache grid
+    """
+    def __init__(self, tiles, width=500, degree_range=0.005, max_decoded_tiles=64, route=None, inset_cache=None):
+        self.tiles = tiles
+        self.route = route
+        self.width = width
+        self.degree_range = degree_range
+        self.max_decoded_tiles = max_decoded_tiles
+        self.inset_cache = inset_cache
+        self.style = (getattr(tiles, "name", None), width,
+                      None if route is None else (route.color, route.thickness))
+        self._decoded = OrderedDict()
+
+    def zoom_for(self, extent_width):
+        """
+        Return the zoom level needed to render an extent at the map width, same as tilemapbase.Plotter
+        extent_width: width of the extent in the unit square
+        """
+        zoom = math.log2(self.width / (self.tiles.tilesize * extent_width))
+        return min(max(0, math.ceil(zoom)), self.tiles.maxzoom)
+
+    def tile(self, x, y, zoom):
+        """
+        Return the decoded BGR tile, decoding it only once
+        x: x tile coordinate
+        y: y tile coordinate
+        zoom: zoom level
+        """
+        key = (x, y, zoom)
+        image = self._decoded.get(key)
+        if image is not None:
+            self._decoded.move_to_end(key)
+            return image
+        if hasattr(self.tiles, "get_tile_bytes"):
+            data = self.tiles.get_tile_bytes(x, y, zoom)
+            if data is None:
+                # Tile not prefetched, left blank rather than waiting for the network
+                image = np.full((self.tiles.tilesize, self.tiles.tilesize, 3), BLANK_TILE_COLOR, np.uint8)
+            else:
+                image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        else:
+            image = cv2.cvtColor(np.asarray(self.tiles.get_tile(x, y, zoom).convert("RGB")), cv2.COLOR_RGB2BGR)
+        self._decoded[key] = image
+        if len(self._decoded) > self.max_decoded_tiles:
+            self._decoded.popitem(last=False)
+        return image
+
+    def render(self, lat, lon, degree_range=None):
+        """
+        Render the map centered on the position
+        lat: latitude
+        lon: longitude
+        degree_range: half size of the map extent in degrees, the default one if None
+        return a width x width BGR ndarray
+        """
+        extent, zoom, key = self.extent_for(lat, lon, degree_range)
+        if self.inset_cache is None:
+            return self.render_extent(*extent, zoom)
+        key += (None if self.route is None else self.route.version,)
+        image = self.inset_cache.get(key)
+        if image is None:
+            image = self.render_extent(*extent, zoom)
+            self.inset_cache.put(key, image)
+        return image
+
+    def extent_for(self, lat, lon, degree_range=None):
+        """
+        Return the extent rendered for the position, snapped to the inset cache grid if any
+        lat: latitude
+        lon: longitude
+        degree_range: half size of the map extent in degrees, the default one if None
+        return ((xmin, xmax, ymin, ymax), zoom, key of the snapped extent or None)
+        """
+        xmin, xmax, ymin, ymax = square_extent(lat, lon, degree_range or self.degree_range)
+        zoom = self.zoom_for(xmax - xmin)
+        if self.inset_cache is None:
+            return (xmin, xmax, ymin, ymax), zoom, None
+        # Snap the center to the pixel grid and the side to the scale steps so close viewports share an inset
+        grid = self.inset_cache.grid_px / ((2 ** zoom) * self.tiles.tilesize)
+        qx, qy = round((xmin + xmax) / 2 / grid), round((ymin + ymax) / 2 / grid)
+        step = math.log1p(self.inset_cache.scale_step)
+        qside = round(math.log(xmax - xmin) / step)
+        half = math.exp(qside * step) / 2
+        extent = (qx * grid - half, qx * grid + half, qy * grid - half, qy * grid + half)
+        return extent, zoom, (self.style, zoom, qx, qy, qside)
+
+    def _tile_bounds(self, xmin, xmax, ymin, ymax, zoom):
+        """
+        Return the pixel bounds (px0, px1, py0, py1) of the extent and the tile bounds (tx0, tx1, ty0, ty1) under it
+        """
+        size = self.tiles.tilesize
+        scale = (2 ** zoom) * size
+        px0, px1 = int(math.floor(xmin * scale)), int(math.ceil(xmax * scale))
+        py0, py1 = int(math.floor(ymin * scale)), int(math.ceil(ymax * scale))
+        return px0, px1, py0, py1, px0 // size, (px1 - 1) // size, py0 // size, (py1 - 1) // size
+
+    def plan_tiles(self, latitudes, longitudes, degree_ranges=None):
+        """
+        List every tile the maps of a trip need, to prefetch them before the render
+        latitudes: latitude of each frame
+        longitudes: longitude of each frame
+        degree_ranges: half size of the extent of each frame in degrees, the default one if None
+        return the sorted list of the (x, y, zoom) tiles
+        """
+        tiles = set()
+        for idx in range(len(latitudes)):
+            degree_range = self.degree_range if degree_ranges is None else degree_ranges[idx]
+            # Same extent as render, the renderers drawing a planned trip do not download the unplanned tiles
+            extent, zoom, _ = self.extent_for(latitudes[idx], longitudes[idx], degree_range)
+            _, _, _, _, tx0, tx1, ty0, ty1 = self._tile_bounds(*extent, zoom)
+            for ty in range(max(ty0, 0), min(ty1, 2 ** zoom - 1) + 1):
+                for tx in range(tx0, tx1 + 1):
+                    tiles.add((tx % 2 ** zoom, ty, zoom))
+        return sorted(tiles)
+
+    def render_extent(self, xmin, xmax, ymin, ymax, zoom):
+        """
+        Stitch the tiles under the extent and crop them to the map size
+        xmin, xmax, ymin, ymax: extent in the unit square
+        zoom: zoom level of the tiles
+        return a width x width BGR ndarray
+        """
+        size = self.tiles.tilesize
+        px0, px1, py0, py1, tx0, tx1, ty0, ty1 = self._tile_bounds(xmin, xmax, ymin, ymax, zoom)
+
+        mosaic = np.zeros(((ty1 - ty0 + 1) * size, (tx1 - tx0 + 1) * size, 3), np.uint8)
+        for ty in range(max(ty0, 0), min(ty1, 2 ** zoom - 1) + 1):
+            for tx in range(tx0, tx1 + 1):
+                yo, xo = (ty - ty0) * size, (tx - tx0) * size
+                mosaic[yo:yo + size, xo:xo + size] = self.tile(tx % 2 ** zoom, ty, zoom)
+
+        crop = mosaic[py0 - ty0 * size:py1 - ty0 * size, px0 - tx0 * size:px1 - tx0 * size]
+        if self.route is not None:
+            self.route.overlay(crop, px0, py0, zoom)
+        if crop.shape[0] == self.width and crop.shape[1] == self.width:
+            return crop.copy()
+        return cv2.resize(crop, (self.width, self.width), interpolation=cv2.INTER_AREA)
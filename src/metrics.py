@@ -0,0 +1,226 @@
+import time
+import resource
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident memory of this process and of its finished children in megabytes, over their whole life
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+def current_rss_mb():
+    """
+    Return the current resident memory of this process in megabytes, its peak when /proc is not available
+    """
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except (OSError, IndexError, ValueError):
+        return peak_rss_mb()[0]
+
+
+class RssSampler:
+    """
+    Sample the resident memory of this process in a background thread between start and stop (or over a with block),
+    so the peak of a job is measured rather than the peak over the life of the process
+    period: sampling period in seconds
+    """
+    def __init__(self, period=0.5):
+        self.period = period
+        self.peak_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss_sampler", daemon=True)
+
+    def _run(self):
+        while True:
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+            if self._stop.wait(self.period):
+                break
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the sampling, return the peak resident memory in megabytes
+        """
+        self._stop.set()
+        self._thread.join()
+        self.peak_mb = max(self.peak_mb, current_rss_mb())
+        return self.peak_mb
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class Metrics:
+    """
+    Thread safe registry of the per-stage latency histograms, counters and gauges
+    The summary is a JSON serializable dict that can be merged into another registry, e.g. from a worker process
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}  # stage: {"buckets": [...], "count", "sum", "max"}
+        self.counters = {}
+        self.gauges = {}  # gauge: {"last", "max", "sum", "count"}
+
+    def observe(self, stage, seconds):
+        """
+        Record the duration of a stage
+        stage: name of the stage
+        seconds: duration in seconds
+        """
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = {"buckets": [0] * (len(BUCKETS) + 1), "count": 0, "sum": 0.0, "max": 0.0}
+            idx = 0
+            while idx < len(BUCKETS) and seconds > BUCKETS[idx]:
+                idx += 1
+            histogram["buckets"][idx] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+
+    @contextmanager
+    def time(self, stage):
+        """
+        Context manager recording the duration of its block as a stage
+        stage: name of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def add(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Record a sample of a gauge, its last, max and mean values are kept
+        name: name of the gauge
+        value: sampled value
+        """
+        with self._lock:
+            gauge = self.gauges.get(name)
+            if gauge is None:
+                gauge = self.gauges[name] = {"last": value, "max": value, "sum": 0, "count": 0}
+            gauge["last"] = value
+            gauge["max"] = max(gauge["max"], value)
+            gauge["sum"] += value
+            gauge["count"] += 1
+
+    def summary(self):
+        """
+        Return the metrics as a JSON serializable dict
+        """
+        with self._lock:
+            stages = {stage: dict(histogram, buckets=list(histogram["buckets"]),
+                                  mean=histogram["sum"] / histogram["count"] if histogram["count"] else 0.0)
+                      for stage, histogram in self.stages.items()}
+            gauges = {name: dict(gauge, mean=gauge["sum"] / gauge["count"] if gauge["count"] else 0.0)
+                      for name, gauge in self.gauges.items()}
+            return {"stages": stages, "counters": dict(self.counters), "gauges": gauges}
+
+    def merge(self, summary):
+        """
+        Add the metrics of a summary to this registry
+        summary: dict returned by Metrics.summary
+        """
+        with self._lock:
+            for stage, other in summary.get("stages", {}).items():
+                histogram = self.stages.get(stage)
+                if histogram is None:
+                    histogram = self.stages[stage] = {"buckets": [0] * (len(BUCKETS) + 1), "count": 0, "sum": 0.0, "max": 0.0}
+                histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+                histogram["count"] += other["count"]
+                histogram["sum"] += other["sum"]
+                histogram["max"] = max(histogram["max"], other["max"])
+            for counter, value in summary.get("counters", {}).items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+            for name, other in summary.get("gauges", {}).items():
+                gauge = self.gauges.get(name)
+                if gauge is None:
+                    gauge = self.gauges[name] = {"last": other["last"], "max": other["max"], "sum": 0, "count": 0}
+                gauge["last"] = other["last"]
+                gauge["max"] = max(gauge["max"], other["max"])
+                gauge["sum"] += other["sum"]
+                gauge["count"] += other["count"]
+
+    def prometheus(self, prefix="timelapse_trip"):
+        """
+        Return the metrics in the Prometheus text exposition format
+        prefix: prefix of the metric names
+        """
+        summary = self.summary()
+        lines = ["# TYPE " + prefix + "_stage_seconds histogram"]
+        for stage, histogram in sorted(summary["stages"].items()):
+            cumulated = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram["buckets"]):
+                cumulated += count
+                lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(prefix, stage, bound, cumulated))
+            lines.append('{}_stage_seconds_sum{{stage="{}"}} {}'.format(prefix, stage, histogram["sum"]))
+            lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, stage, histogram["count"]))
+        for counter, value in sorted(summary["counters"].items()):
+            lines.append("# TYPE {}_{}_total counter".format(prefix, counter))
+            lines.append("{}_{}_total {}".format(prefix, counter, value))
+        for name, gauge in sorted(summary["gauges"].items()):
+            lines.append("# TYPE {}_{} gauge".format(prefix, name))
+            lines.append("{}_{} {}".format(prefix, name, gauge["last"]))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Local HTTP endpoint serving the metrics in the Prometheus text format on /metrics
+    metrics: Metrics registry to serve
+    host: listening address
+    port: listening port
+    before_scrape: optional callable called before each scrape, e.g. to sample the gauges
+    """
+    def __init__(self, metrics, host="127.0.0.1", port=9105, before_scrape=None):
+        registry = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                if before_scrape:
+                    before_scrape()
+                body = registry.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Do not fill the log with the scrapes
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,147 @@
+import time
+import logging
+import threading
+from collections import deque
+from enums import Motion
+
+
+class MotionStateMachine:
+    """
+    Thread safe motion state of the car driven by the MQTT events
+    The capture thread blocks on wait_for_start/wait_for_stop and is woken as soon as a transition
+    requires it; the delay between the triggering event and the capture start/stop is recorded
+    idle_timeout_s: idling duration after which the capture stops
+    listener: optional callable called after every event, e.g. to wake the main loop
+    history: number of latency samples kept
+    """
+    def __init__(self, idle_timeout_s=10, listener=None, history=100):
+        self.idle_timeout = idle_timeout_s
+        self.listener = listener
+        self.state = Motion.IDLE  # By default
+        self.since = time.monotonic()
+        self.ignition = False
+        self.moving = False
+        self.stop_command = True
+        self.start_latencies = deque(maxlen=history)
+        self.stop_latencies = deque(maxlen=history)
+        self._condition = threading.Condition()
+        self._start_trigger = None
+        self._stop_trigger = None
+
+    def update(self, ignition=None, moving=None, stop_command=None):
+        """
+        Apply an MQTT event and transition to the resulting state
+        ignition: True if the ignition is on, None if unchanged
+        moving: True if the car is moving, None if unchanged
+        stop_command: True if the user stopped the capture, None if unchanged
+        """
+        with self._condition:
+            now = time.monotonic()
+            if ignition is not None:
+                self.ignition = ignition
+            if moving is not None:
+                self.moving = moving
+            if stop_command is not None:
+                self.stop_command = stop_command
+            state = self.state
+            if self.ignition and self.moving:
+                state = Motion.DRIVE
+            elif not self.ignition and not self.moving:
+                state = Motion.STOP
+            elif self.ignition and not self.moving:
+                state = Motion.IDLE  # The car is on but not moving
+            if state != self.state:
+                logging.info("Change app state from " + repr(self.state) + " to " + repr(state))
+                self.state = state
+                self.since = now
+            if self._should_capture():
+                self._start_trigger = self._start_trigger or now
+            else:
+                self._start_trigger = None
+            if self._stop_reason(now) is not None:
+                self._stop_trigger = self._stop_trigger or now
+            self._condition.notify_all()
+        if self.listener:
+            self.listener()
+
+    def _should_capture(self):
+        return self.state == Motion.DRIVE and not self.stop_command
+
+    def _stop_reason(self, now):
+        if self.state == Motion.STOP:
+            return "Motion Stop"
+        if self.stop_command:
+            return "stop command by user"
+        if self.state == Motion.IDLE and now - self.since > self.idle_timeout:
+            return "Idling for too long"
+        return None
+
+    def should_capture(self):
+        with self._condition:
+            return self._should_capture()
+
+    def wait_for_start(self, timeout=None):
+        """
+        Wait until the capture must start
+        timeout: maximum wait in seconds, None to wait forever
+        return True if the capture must start
+        """
+        with self._condition:
+            return self._condition.wait_for(self._should_capture, timeout)
+
+    def wait_for_stop(self, timeout=None):
+        """
+        Wait until the capture must stop, including the idling timeout
+        timeout: maximum wait in seconds, None to wait forever
+        return the reason to stop the capture, None on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                reason = self._stop_reason(now)
+                if reason is not None:
+                    if self._stop_trigger is None:
+                        # Idling timeout, triggered by the time and not by an event
+                        self._stop_trigger = self.since + self.idle_timeout
+                    return reason
+                wait = None if deadline is None else deadline - now
+                if self.state == Motion.IDLE:
+                    idle_left = self.since + self.idle_timeout - now
+                    wait = idle_left if wait is None else min(wait, idle_left)
+                if wait is not None and wait <= 0:
+                    if deadline is not None and now >= deadline:
+                        return None
+                    continue
+                self._condition.wait(wait)
+
+    def mark_started(self):
+        """
+        Record the latency between the start event and the capture start
+        """
+        with self._condition:
+            if self._start_trigger is not None:
+                self.start_latencies.append(time.monotonic() - self._start_trigger)
+            self._start_trigger = None
+            self._stop_trigger = None
+
+    def mark_stopped(self):
+        """
+        Record the latency between the stop event and the end of the capture process
+        """
+        with self._condition:
+            if self._stop_trigger is not None:
+                self.stop_latencies.append(time.monotonic() - self._stop_trigger)
+            self._stop_trigger = None
+
+    def latency_stats(self):
+        """
+        Return the last, mean and max start/stop latencies in seconds
+        """
+        stats = {}
+        with self._condition:
+            for name, latencies in (("start", self.start_latencies), ("stop", self.stop_latencies)):
+                if latencies:
+                    stats[name] = {"last": latencies[-1], "mean": sum(latencies) / len(latencies),
+                                   "max": max(latencies), "count": len(latencies)}
+        return stats
@@ -1,5 +1,8 @@
 path_to_app = "/etc/capsule/timelapse_trip"
 path_to_timelapse_tmp = "/tmp/timelapse_trip"
 path_to_current_results = "/mnt/data/shares/data/timelapses"
+path_to_tile_store = "/etc/capsule/timelapse_trip/tile_store.sqlite"
+path_to_gps_tracks = "/etc/capsule/timelapse_trip/gps_tracks"
+path_to_job_queue = "/etc/capsule/timelapse_trip/jobs.sqlite"
 path_to_conf = "/etc/capsule/timelapse_trip/config.yaml"
 path_to_services = "/etc/systemd/system/timelapse_trip.service"
\ No newline at end of file
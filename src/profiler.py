@@ -0,0 +1,138 @@
+import io
+import os
+import sys
+import time
+import pstats
+import logging
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+
+CPROFILE = "cprofile"
+SAMPLING = "sampling"
+
+# cProfile and tracemalloc are process-wide, only one job at a time is profiled in the cprofile mode
+_cprofile_lock = threading.Lock()
+
+
+class JobProfiler:
+    """
+    Profile the render job running in the current thread and write the results in the result folder
+    "cprofile" mode: deterministic cProfile of the job thread plus tracemalloc allocation snapshot,
+    written as profile.pstats/profile.txt and allocations.tracemalloc/allocations.txt
+    "sampling" mode: the job thread stack is sampled periodically from a background thread, cheap enough
+    to be left on; written as profile.folded (one "frame;frame;frame count" line per stack, for flame graphs)
+    The render worker processes are not profiled; use a single render worker to profile the whole render
+    Only one job at a time is profiled in the "cprofile" mode, the jobs overlapping it are sampled instead
+    output_folder: folder the results are written to, created if needed
+    mode: "cprofile" or "sampling"
+    sample_interval_s: sampling period of the sampling mode
+    tracemalloc_frames: number of frames stored per allocation traceback
+    """
+    def __init__(self, output_folder, mode=CPROFILE, sample_interval_s=0.01, tracemalloc_frames=10):
+        if mode not in (CPROFILE, SAMPLING):
+            raise ValueError("Unknown profiling mode " + repr(mode))
+        self.output_folder = output_folder
+        self.mode = mode
+        self.sample_interval = sample_interval_s
+        self.tracemalloc_frames = tracemalloc_frames
+        self.samples = Counter()
+        self._profile = None
+        self._started_tracemalloc = False
+        self._thread_id = None
+        self._sampler = None
+        self._stop = threading.Event()
+        self._start_time = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self._start_time = time.perf_counter()
+        if self.mode == CPROFILE and not _cprofile_lock.acquire(blocking=False):
+            logging.warning("Another job is profiled with cProfile, sample the profile of this job instead")
+            self.mode = SAMPLING
+        if self.mode == CPROFILE:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.tracemalloc_frames)
+                self._started_tracemalloc = True
+            tracemalloc.reset_peak()
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._thread_id = threading.get_ident()
+            self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+            self._sampler.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(os.path.basename(code.co_filename) + ":" + code.co_name + ":" + str(frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """
+        Stop profiling and write the results
+        return the list of the written files
+        """
+        duration = time.perf_counter() - self._start_time
+        os.makedirs(self.output_folder, exist_ok=True)
+        written = []
+        if self.mode == CPROFILE:
+            try:
+                written = self._write_cprofile(duration)
+            finally:
+                _cprofile_lock.release()
+        else:
+            self._stop.set()
+            self._sampler.join()
+            path = os.path.join(self.output_folder, "profile.folded")
+            with open(path, "w") as file:
+                for stack, count in self.samples.most_common():
+                    file.write(stack + " " + str(count) + "\n")
+            written.append(path)
+        logging.info("Profile of the render written to " + ", ".join(written) + " ({:.1f} s)".format(duration))
+        return written
+
+    def _write_cprofile(self, duration):
+        """
+        Stop the cProfile and tracemalloc profiling and write their results
+        duration: profiled duration in seconds
+        """
+        written = []
+        self._profile.disable()
+        path = os.path.join(self.output_folder, "profile.pstats")
+        self._profile.dump_stats(path)
+        written.append(path)
+        text = io.StringIO()
+        pstats.Stats(self._profile, stream=text).sort_stats("cumulative").print_stats(50)
+        path = os.path.join(self.output_folder, "profile.txt")
+        with open(path, "w") as file:
+            file.write("Duration: {:.3f} s\n".format(duration))
+            file.write(text.getvalue())
+        written.append(path)
+
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+        path = os.path.join(self.output_folder, "allocations.tracemalloc")
+        snapshot.dump(path)
+        written.append(path)
+        path = os.path.join(self.output_folder, "allocations.txt")
+        with open(path, "w") as file:
+            file.write("Traced memory: current {:.1f} MB, peak {:.1f} MB\n".format(current / 2 ** 20, peak / 2 ** 20))
+            for stat in snapshot.statistics("lineno")[:30]:
+                file.write(str(stat) + "\n")
+        written.append(path)
+        return written
@@ -0,0 +1,243 @@
+import os
+import shutil
+import logging
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from common import combine, open_tile_store, build_map_renderer, prefetches_tiles, configure_logging, log_config
+import cv2
+from PIL import Image
+from frame_source import PrefetchFrameSource, reduced_read_flags
+from encoder import build_encoder, build_output_encoder, FanOutEncoder, merge_contact_sheets
+from metrics import Metrics, RssSampler
+
+
+def split_shards(count, shards):
+    """
+    Split the frames into contiguous shards of the same size
+    count: number of frames
+    shards: number of shards wanted
+    return the list of (start, stop) frame ranges
+    """
+    shards = max(1, min(shards, count))
+    bounds = np.linspace(0, count, shards + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+def output_path_of(video_path, output, segment=False):
+    """
+    Return the path of an extra output rendered next to a video or to a video segment
+    video_path: path to the main video or to the segment
+    output: output configuration
+    segment: True for the output of a segment, the segment contact sheets are lossless so they can be merged
+    """
+    if not segment:
+        return os.path.join(os.path.dirname(video_path), output["name"])
+    path = os.path.splitext(video_path)[0] + "." + output["name"]
+    if output.get("type", "video") == "contact_sheet":
+        path += ".png"
+    return path
+
+def render_segment(output_path, frames, timestamps, latitudes, longitudes, maps, conf, frame_size, fps, progress=None,
+                   history=None, outputs=(), frame_offset=0, frame_total=None, degree_ranges=None):
+    """
+    Combine the frames with their map and encode them into one video file
+    output_path: path to the video file to write
+    frames: list of frame paths
+    timestamps: list of the frame timestamps to display
+    latitudes: latitude of each frame, None to encode the frames without the map
+    longitudes: longitude of each frame
+    maps: list of the map paths of each frame, None to render the maps in memory
+    conf: app configuration
+    frame_size: (width, height) of the video
+    fps: video frame rate
+    progress: optional callback called with (done, total) frames
+    history: optional (latitudes, longitudes) driven before the first frame, drawn in the route
+    outputs: list of the (output configuration, path) extra outputs the composited frames are also written to
+    frame_offset: index of the first frame in the whole video
+    frame_total: number of frames of the whole video, len(frames) if None
+    degree_ranges: optional half size of the map extent of each frame in degrees, planned from the speed; when the tiles
+    of the planned maps are prefetched (local tile server) the missing ones are left blank instead of downloaded
+    return the segment stats: {"tiles": tile store stats, "metrics": Metrics summary of the stages}
+    """
+    metrics = Metrics()
+    tile_store = map_renderer = None
+    if latitudes is not None and maps is None:
+        # Every worker opens its own connection to the tile store
+        tile_store = open_tile_store(conf)
+        map_renderer = build_map_renderer(conf, tile_store, offline=degree_ranges is not None and prefetches_tiles(conf))
+        if map_renderer.route is not None and history is not None:
+            map_renderer.route.extend(*history)
+    stats = {}
+    # Every composited frame is fanned out to the main video and the extra outputs
+    sinks = [build_encoder(conf, output_path, frame_size, fps)]
+    sinks += [build_output_encoder(conf, output, path, fps, frame_total or len(frames), frame_offset) for output, path in outputs]
+    video_out = FanOutEncoder(sinks)
+    # Decode the JPEG frames scaled down if every output is smaller than them, the map inset is composited
+    # at the camera resolution so only the frames encoded without the map are decoded scaled down
+    flags = cv2.IMREAD_COLOR
+    if frames and latitudes is None:
+        try:
+            flags = reduced_read_flags(Image.open(frames[0]).size[0], max(sink.frame_size[0] for sink in sinks))
+        except OSError:
+            pass  # Unreadable first frame, decode the frames at full size
+    render_conf = conf.get("render", {})
+    frame_source = PrefetchFrameSource(frames, render_conf.get("prefetch_depth", 8), render_conf.get("prefetch_memory_mb", 256),
+                                       render_conf.get("prefetch_threads", 2), flags)
+    frame_iterator = iter(frame_source)
+    # Peak memory of this segment, the peak over the life of the worker process would cover its previous segments
+    rss = RssSampler(conf.get("metrics", {}).get("rss_period_s", 0.5)).start()
+    try:
+        for idx in range(len(frames)):
+            # Time spent waiting for the decoded frames
+            with metrics.time("read"):
+                frame = next(frame_iterator)
+            metrics.gauge("prefetch_queue_depth", frame_source.queue_depth)
+            if progress:
+                progress(idx, len(frames))
+            if latitudes is None:
+                video_frame = frame
+            elif frame is None:
+                continue  # Skip if the frame is empty
+            else:
+                with metrics.time("map"):
+                    if maps is None:
+                        if map_renderer.route is not None:
+                            map_renderer.route.add_point(latitudes[idx], longitudes[idx])
+                        map_image = map_renderer.render(latitudes[idx], longitudes[idx],
+                                                        None if degree_ranges is None else degree_ranges[idx])
+                    else:
+                        map_image = maps[idx]
+                with metrics.time("combine"):
+                    video_frame = combine(map_image, frame, timestamps[idx], latitudes[idx], longitudes[idx])
+            if video_frame is not None:
+                with metrics.time("encode"):
+                    video_out.write(video_frame, idx)
+                metrics.add("frames")
+    finally:
+        with metrics.time("encode_release"):
+            video_out.release()
+        frame_iterator.close()
+        if tile_store:
+            stats = tile_store.stats()
+            tile_store.close()
+        if map_renderer is not None and map_renderer.inset_cache is not None:
+            inset_stats = map_renderer.inset_cache.stats()
+            metrics.add("inset_cache_hits", inset_stats["hits"])
+            metrics.add("inset_cache_misses", inset_stats["misses"])
+        metrics.gauge("segment_peak_rss_mb", rss.stop())
+    return {"tiles": stats, "metrics": metrics.summary()}
+
+def concat_segments(segment_paths, output_path):
+    """
+    Join the video segments in order into one video file without re-encoding them
+    segment_paths: ordered list of the segment paths
+    output_path: path to the video file to write
+    """
+    list_path = os.path.join(os.path.dirname(segment_paths[0]), "segments.txt")
+    with open(list_path, "w") as file:
+        for segment_path in segment_paths:
+            file.write("file '" + os.path.abspath(segment_path) + "'\n")
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+                    "-c", "copy", output_path], check=True)
+
+def render_video(output_path, frames, timestamps, latitudes, longitudes, maps, conf, frame_size, fps=10, workers=1,
+                 progress=None, manifest=None, segment_frames=0, metrics=None, degree_ranges=None):
+    """
+    Render the timelapse video in contiguous segments, over a process pool if several workers are requested
+    Each worker encodes its own segments and the segments are joined in order with ffmpeg; without ffmpeg
+    the video is rendered in one segment by this process and can not be resumed
+    output_path: path to the video file to write
+    frames, timestamps, latitudes, longitudes, maps, conf, frame_size, fps: see render_segment
+    workers: number of worker processes, 0 to use one per CPU core
+    progress: optional callback called with (done, total) frames
+    manifest: optional RenderManifest checkpointing the rendered segments, which are skipped when resuming
+    segment_frames: maximum number of frames per segment, 0 for one segment per worker
+    metrics: optional Metrics registry the stage metrics of the segments are merged into
+    degree_ranges: see render_segment
+    return the list of the tile store stats of each rendered segment
+    """
+    outputs = conf.get("outputs", [])
+    workers = workers or os.cpu_count()
+    shard_count = workers
+    if segment_frames:
+        shard_count = max(workers, -(-len(frames) // segment_frames))
+    if shard_count > 1 and not shutil.which("ffmpeg"):
+        logging.warning("ffmpeg is not installed to join the segments, render the video in one segment without checkpoints")
+        shard_count = 1
+    shards = split_shards(len(frames), shard_count)
+    if len(shards) <= 1:
+        segment_stats = render_segment(output_path, frames, timestamps, latitudes, longitudes, maps, conf, frame_size, fps,
+                                       progress, None, [(output, output_path_of(output_path, output)) for output in outputs],
+                                       degree_ranges=degree_ranges)
+        if metrics is not None:
+            metrics.merge(segment_stats["metrics"])
+        return [segment_stats["tiles"]]
+
+    def shard(values, start, stop):
+        return None if values is None else values[start:stop]
+
+    def shard_args(start, stop):
+        return (frames[start:stop], timestamps[start:stop], shard(latitudes, start, stop), shard(longitudes, start, stop),
+                shard(maps, start, stop), conf, frame_size, fps)
+
+    def shard_history(start):
+        return None if latitudes is None else (latitudes[:start], longitudes[:start])
+
+    def shard_outputs(segment_path):
+        return [(output, output_path_of(segment_path, output, segment=True)) for output in outputs]
+
+    def shard_done(segment_path, start, stop):
+        return (manifest is not None and manifest.segment_done(start, stop)
+                and all(os.path.exists(path) for _, path in shard_outputs(segment_path)))
+
+    segment_folder = os.path.join(os.path.dirname(output_path), "segments")
+    os.makedirs(segment_folder, exist_ok=True)
+    segment_paths = [os.path.join(segment_folder, "segment_{:04d}.mp4".format(idx)) for idx in range(len(shards))]
+    todo = [(segment_path, start, stop) for segment_path, (start, stop) in zip(segment_paths, shards)
+            if not shard_done(segment_path, start, stop)]
+    if len(todo) < len(shards):
+        logging.info("Resume the render: " + str(len(shards) - len(todo)) + " of " + str(len(shards)) + " segments already rendered")
+    logging.info("Render " + str(len(frames)) + " frames in " + str(len(shards)) + " segments")
+    done_frames = len(frames) - sum(stop - start for _, start, stop in todo)
+    stats = []
+
+    def finished(segment_path, start, stop, segment_stats):
+        nonlocal done_frames
+        stats.append(segment_stats["tiles"])
+        if metrics is not None:
+            metrics.merge(segment_stats["metrics"])
+        done_frames += stop - start
+        if manifest is not None:
+            manifest.mark_segment(start, stop, segment_path)
+        if progress:
+            progress(done_frames, len(frames))
+
+    if workers <= 1:
+        for segment_path, start, stop in todo:
+            segment_progress = None
+            if progress:
+                segment_progress = lambda done, total, offset=done_frames: progress(offset + done, len(frames))
+            finished(segment_path, start, stop, render_segment(segment_path, *shard_args(start, stop), segment_progress,
+                                                               shard_history(start), shard_outputs(segment_path),
+                                                               start, len(frames),
+                                                               shard(degree_ranges, start, stop)))
+    elif todo:
+        # Started from the forkserver: a fork of this multi-threaded process could inherit a lock held by another
+        # thread (logging, tile store) and deadlock
+        with ProcessPoolExecutor(max_workers=min(workers, len(todo)), mp_context=multiprocessing.get_context("forkserver"),
+                                 initializer=configure_logging, initargs=(log_config,)) as executor:
+            futures = {executor.submit(render_segment, segment_path, *shard_args(start, stop), None, shard_history(start),
+                                       shard_outputs(segment_path), start, len(frames), shard(degree_ranges, start, stop)):
+                       (segment_path, start, stop) for segment_path, start, stop in todo}
+            for future in as_completed(futures):
+                finished(*futures[future], future.result())
+    concat_segments(segment_paths, output_path)
+    for output in outputs:
+        output_segments = [output_path_of(segment_path, output, segment=True) for segment_path in segment_paths]
+        if output.get("type", "video") == "contact_sheet":
+            merge_contact_sheets(output_segments, output_path_of(output_path, output))
+        else:
+            concat_segments(output_segments, output_path_of(output_path, output))
+    shutil.rmtree(segment_folder)
+    return stats
@@ -0,0 +1,108 @@
+import numpy as np
+import cv2
+from map_render import project
+
+# Sub-pixel precision of the drawn polyline (cv2 shift parameter)
+_SHIFT = 4
+
+
+class RouteLayer:
+    """
+    Driven route overlay kept as a rasterized polyline canvas in map-pixel space
+    Each new position only draws its segment; the canvas is reprojected (redrawn) only when
+    the viewport moves out of its tiles or the zoom level changes
+    tilesize: size of the map tiles in pixels
+    color: BGR color of the route
+    thickness: thickness of the route in map pixels
+    margin_tiles: number of tiles kept around the viewport so small moves do not reproject the canvas
+    version_px: distance in map pixels the route tip must move to change the route version, which keys the
+    cached insets, so the GPS jitter while stopped does not invalidate them
+    """
+    def __init__(self, tilesize=256, color=(0, 0, 255), thickness=3, margin_tiles=1, version_px=4):
+        self.tilesize = tilesize
+        self.color = tuple(color)
+        self.thickness = thickness
+        self.margin_tiles = margin_tiles
+        self.version_px = version_px
+        self.version = 0
+        self.reprojections = 0
+        self._version_tip = None
+        self._xs = []
+        self._ys = []
+        self._zoom = None
+        self._origin = (0, 0)
+        self._canvas = None
+
+    def __len__(self):
+        return len(self._xs)
+
+    def add_point(self, lat, lon):
+        """
+        Append a position to the route and draw its segment
+        lat: latitude
+        lon: longitude
+        """
+        x, y = project(lon, lat)
+        self._xs.append(x)
+        self._ys.append(y)
+        if (self._version_tip is None or self._zoom is None or (2 ** self._zoom) * self.tilesize
+                * max(abs(x - self._version_tip[0]), abs(y - self._version_tip[1])) >= self.version_px):
+            self.version += 1
+            self._version_tip = (x, y)
+        if self._canvas is not None and len(self._xs) > 1:
+            points = self._to_canvas(np.array(self._xs[-2:]), np.array(self._ys[-2:]))
+            cv2.line(self._canvas, tuple(points[0]), tuple(points[1]), 255, self.thickness, cv2.LINE_8, _SHIFT)
+
+    def extend(self, lats, lons):
+        """
+        Append several positions to the route, drawn at the next reprojection
+        lats: latitudes
+        lons: longitudes
+        """
+        for lat, lon in zip(lats, lons):
+            x, y = project(lon, lat)
+            self._xs.append(x)
+            self._ys.append(y)
+        self.version += 1
+        self._version_tip = None
+        self._canvas = None
+
+    def overlay(self, image, px0, py0, zoom):
+        """
+        Draw the route onto a map image, in place
+        image: BGR map image in map-pixel space
+        px0: global x pixel of the image left border at the zoom level
+        py0: global y pixel of the image top border at the zoom level
+        zoom: zoom level of the map image
+        """
+        height, width = image.shape[:2]
+        ox, oy = self._origin
+        if (self._canvas is None or zoom != self._zoom or px0 < ox or py0 < oy
+                or px0 + width > ox + self._canvas.shape[1] or py0 + height > oy + self._canvas.shape[0]):
+            self._reproject(px0, py0, width, height, zoom)
+            ox, oy = self._origin
+        mask = self._canvas[py0 - oy:py0 - oy + height, px0 - ox:px0 - ox + width]
+        image[mask > 0] = self.color
+
+    def _to_canvas(self, xs, ys):
+        scale = (2 ** self._zoom) * self.tilesize * (1 << _SHIFT)
+        points = np.empty((len(xs), 2), dtype=np.float64)
+        points[:, 0] = xs * scale - self._origin[0] * (1 << _SHIFT)
+        points[:, 1] = ys * scale - self._origin[1] * (1 << _SHIFT)
+        # Far away positions are clipped so they fit in the int32 cv2 coordinates
+        return np.clip(np.round(points), -2 ** 30, 2 ** 30).astype(np.int32)
+
+    def _reproject(self, px0, py0, width, height, zoom):
+        """
+        Allocate a tile aligned canvas around the viewport and redraw the whole route in it
+        """
+        size = self.tilesize
+        tx0, ty0 = px0 // size - self.margin_tiles, py0 // size - self.margin_tiles
+        tx1, ty1 = (px0 + width - 1) // size + self.margin_tiles, (py0 + height - 1) // size + self.margin_tiles
+        self._zoom = zoom
+        self._origin = (tx0 * size, ty0 * size)
+        self._canvas = np.zeros(((ty1 - ty0 + 1) * size, (tx1 - tx0 + 1) * size), dtype=np.uint8)
+        self.reprojections += 1
+        if len(self._xs) > 1:
+            points = self._to_canvas(np.asarray(self._xs), np.asarray(self._ys))
+            cv2.polylines(self._canvas, [points], False, 255, self.thickness, cv2.LINE_8, _SHIFT)
@@ -0,0 +1,105 @@
+import time
+import threading
+
+_MISSING = object()
+
+
+class Telemetry:
+    """
+    Coalescing MQTT publisher keeping the latest value of each topic
+    A value is published by a background thread only when it changed, at most once per
+    min_interval_s per topic, and every value is published again at each heartbeat
+    client: connected paho MQTT client
+    heartbeat_s: period in seconds at which the latest values are published again
+    min_interval_s: minimum delay in seconds between two publications of a topic
+    retained: topics published as retained messages
+    qos: quality of service of the messages
+    """
+    def __init__(self, client, heartbeat_s=30, min_interval_s=1, retained=(), qos=0):
+        self.client = client
+        self.heartbeat = heartbeat_s
+        self.min_interval = min_interval_s
+        self.retained = set(retained)
+        self.qos = qos
+        self.published = 0
+        self.coalesced = 0
+        self._values = {}
+        self._sent = {}  # topic: (value, monotonic time of the publication)
+        self._dirty = set()
+        self._changed = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+        self._thread.start()
+
+    def publish(self, topic, value):
+        """
+        Update the value of a topic, published later by the background thread
+        topic: MQTT topic
+        value: payload (str, bytes, int, float or bool)
+        """
+        with self._condition:
+            self._values[topic] = value
+            if self._sent.get(topic, (_MISSING,))[0] == value and topic not in self._dirty:
+                self.coalesced += 1
+                return
+            if topic in self._dirty:
+                self.coalesced += 1
+            self._dirty.add(topic)
+            self._changed = True
+            self._condition.notify()
+
+    def _due(self, now, force=False):
+        """
+        Return the (topic, value) messages to publish and the delay until the next one is due
+        """
+        messages = []
+        next_due = self.heartbeat
+        for topic, value in self._values.items():
+            sent = self._sent.get(topic)
+            if topic in self._dirty:
+                due = 0 if sent is None or force else sent[1] + self.min_interval - now
+            else:
+                due = sent[1] + self.heartbeat - now
+            if due <= 0:
+                messages.append((topic, value))
+                self._dirty.discard(topic)
+                self._sent[topic] = (value, now)
+            else:
+                next_due = min(next_due, due)
+        return messages, next_due
+
+    def _send(self, messages):
+        for topic, value in messages:
+            self.client.publish(topic, value, self.qos, topic in self.retained)
+        self.published += len(messages)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._closed:
+                    return
+                messages, next_due = self._due(time.monotonic())
+                self._changed = False
+            # Publish out of the lock so the callers never wait for the broker
+            self._send(messages)
+            with self._condition:
+                self._condition.wait_for(lambda: self._changed or self._closed, next_due)
+
+    def flush(self):
+        """
+        Publish the pending values now, ignoring the rate limit
+        """
+        with self._condition:
+            messages, _ = self._due(time.monotonic(), force=True)
+        self._send(messages)
+
+    def close(self):
+        """
+        Publish the pending values and stop the background thread
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
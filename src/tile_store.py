@@ -0,0 +1,211 @@
+import io
+import os
+import time
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+
+class TileStore:
+    """
+    Persistent tile store backed by a single SQLite file
+    Tiles are keyed by (source, zoom, x, y) and evicted in least recently used order
+    once the stored tiles exceed the maximum size
+    path: path to the SQLite file, created if it does not exist
+    max_size_mb: maximum size of the stored tiles in megabytes
+    """
+    def __init__(self, path, max_size_mb=512):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS tiles (source TEXT NOT NULL, zoom INTEGER NOT NULL,\
+             x INTEGER NOT NULL, y INTEGER NOT NULL, data BLOB NOT NULL, size INTEGER NOT NULL,\
+             last_access REAL NOT NULL, PRIMARY KEY (source, zoom, x, y))")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles (last_access)")
+        self._connection.commit()
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+
+    def get(self, source, zoom, x, y):
+        """
+        Return the encoded tile or None if it is not stored
+        source: tile source name
+        zoom: zoom level
+        x: x tile coordinate
+        y: y tile coordinate
+        """
+        key = (source, zoom, x, y)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data FROM tiles WHERE source = ? AND zoom = ? AND x = ? AND y = ?", key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute(
+                "UPDATE tiles SET last_access = ? WHERE source = ? AND zoom = ? AND x = ? AND y = ?", (time.time(),) + key)
+            self._connection.commit()
+            return row[0]
+
+    def put(self, source, zoom, x, y, data):
+        """
+        Store an encoded tile and evict the least recently used tiles if the store is full
+        source: tile source name
+        zoom: zoom level
+        x: x tile coordinate
+        y: y tile coordinate
+        data: encoded tile (PNG or JPEG bytes)
+        """
+        key = (source, zoom, x, y)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT size FROM tiles WHERE source = ? AND zoom = ? AND x = ? AND y = ?", key).fetchone()
+            if row is not None:
+                self._size -= row[0]
+            self._connection.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                     key + (sqlite3.Binary(data), len(data), time.time()))
+            self._size += len(data)
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        """
+        Remove the least recently used tiles until the store fits in its maximum size
+        Must be called with the lock held
+        """
+        while self._size > self.max_size:
+            rows = self._connection.execute(
+                "SELECT rowid, size FROM tiles ORDER BY last_access, rowid LIMIT 64").fetchall()
+            if not rows:
+                self._size = 0
+                return
+            for rowid, size in rows:
+                if self._size <= self.max_size:
+                    break
+                self._connection.execute("DELETE FROM tiles WHERE rowid = ?", (rowid,))
+                self._size -= size
+                self.evictions += 1
+
+    def missing(self, source, keys):
+        """
+        Return the tiles that are not stored, without counting hits or misses
+        source: tile source name
+        keys: list of the (x, y, zoom) tiles
+        """
+        with self._lock:
+            return [(x, y, zoom) for x, y, zoom in keys if self._connection.execute(
+                "SELECT 1 FROM tiles WHERE source = ? AND zoom = ? AND x = ? AND y = ?", (source, zoom, x, y)).fetchone() is None]
+
+    def stats(self):
+        """
+        Return the hit/miss counters and the current size of the store
+        """
+        with self._lock:
+            count = self._connection.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+            requests_count = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "tiles": count,
+                    "size_bytes": self._size, "hit_ratio": self.hits / requests_count if requests_count else 0.0}
+
+    def close(self):
+        """
+        Close the connection to the SQLite file
+        """
+        with self._lock:
+            self._connection.close()
+
+
+class StoredTiles:
+    """
+    Tile provider reading through a TileStore; exposes the same interface as tilemapbase.tiles.Tiles
+    so it can be given to the map generation in place of it
+    tiles: tilemapbase.tiles.Tiles describing the tile server (url, name, tile size, headers)
+    store: TileStore to read through
+    offline: if True the missing tiles are not downloaded, get_tile_bytes returns None (tiles prefetched beforehand)
+    max_connections: size of the pool of the HTTP connections kept open to the tile server
+    """
+    def __init__(self, tiles, store: TileStore, offline=False, max_connections=4):
+        self.tiles = tiles
+        self.store = store
+        self.name = tiles.name
+        self.headers = tiles.headers
+        self.offline = offline
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    @property
+    def maxzoom(self):
+        return self.tiles.maxzoom
+
+    @property
+    def tilesize(self):
+        return self.tiles.tilesize
+
+    def get_tile_bytes(self, x, y, zoom):
+        """
+        Return the encoded tile, from the store if possible or else from the tile server
+        x: x tile coordinate
+        y: y tile coordinate
+        zoom: zoom level
+        """
+        data = self.store.get(self.name, zoom, x, y)
+        if data is None and not self.offline:
+            data = self._download(x, y, zoom)
+            self.store.put(self.name, zoom, x, y, data)
+        return data
+
+    def prefetch(self, keys, concurrency=4):
+        """
+        Download the tiles missing from the store in parallel over the pooled connections
+        A tile that fails to download is logged and skipped
+        keys: list of the (x, y, zoom) tiles
+        concurrency: maximum number of concurrent downloads
+        return the number of tiles (requested, downloaded, failed)
+        """
+        missing = self.store.missing(self.name, keys)
+        downloaded = failed = 0
+
+        def fetch(key):
+            x, y, zoom = key
+            self.store.put(self.name, zoom, x, y, self._download(x, y, zoom))
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="tile_prefetch") as executor:
+            futures = {executor.submit(fetch, key): key for key in missing}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    downloaded += 1
+                except IOError as e:
+                    failed += 1
+                    logging.warning("Failed to prefetch the tile " + repr(futures[future]) + ": " + str(e))
+        return len(keys), downloaded, failed
+
+    def get_tile(self, x, y, zoom):
+        """
+        Return the tile as a PIL image
+        x: x tile coordinate
+        y: y tile coordinate
+        zoom: zoom level
+        """
+        return Image.open(io.BytesIO(self.get_tile_bytes(x, y, zoom)))
+
+    def _download(self, x, y, zoom):
+        url = self.tiles.request.format(x=x, y=y, zoom=zoom)
+        logging.debug("Download tile " + url)
+        response = self._session.get(url, headers=self.headers, timeout=10)
+        if not response.ok:
+            raise IOError("Failed to download {}. Got {}".format(url, response))
+        return response.content
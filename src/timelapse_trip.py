@@ -6,281 +6,473 @@ import sys
 import time
 import logging
 import datetime as dt
+import signal
+import json
 import paho.mqtt.client as mqtt
 from subprocess import Popen, PIPE, TimeoutExpired
-from influxdb import DataFrameClient
+from concurrent.futures import ThreadPoolExecutor
 from enums import *
 from common import *
 from path_files import *
-from moviepy.editor import *
-
-
-# ----------------------------------------------------------------------------------------------------------------------
-# Read script parameters
-# ----------------------------------------------------------------------------------------------------------------------
-path_to_conf = os.path.join("/etc/capsule/timelapse_trip/config.yaml")
-# If the default configuration is not install, then configure w/ the default one
-if not os.path.exists(path_to_conf):
-    sys.exit("Configuration file %s does not exists. Please reinstall the app" % path_to_conf)
-# load configuration
-with open(path_to_conf, "r") as file:
-    conf = yaml.load(file, Loader=yaml.FullLoader)
-
-# ----------------------------------------------------------------------------------------------------------------------
-# Initiate variables
-# ----------------------------------------------------------------------------------------------------------------------
-connected = False
-logging.basicConfig(
-    filename="/var/log/capsule/timelapse_trip.log",
-    filemode="a",
-    level=logging.DEBUG if conf["debug"] else logging.INFO,
-    format="%(asctime)s %(levelname)s:%(message)s",
-    datefmt='%m/%d/%Y %I:%M:%S %p')
-
-# Dump configuration
-logging.debug("Dump configuration: " + repr(conf))
-
-# ----------------------------------------------------------------------------------------------------------------------
-# Initiate MQTT variables
-# ----------------------------------------------------------------------------------------------------------------------
-motion_state = Motion.IDLE # By default
-time_since_idle = None
-stop_command = True
-ignition = False
-car_moving = False
-# MQTT methods
-def on_connect(client, userdata, flags, rc):  # The callback for when the client connects to the broker
-    logging.info("Connected with result code {0}".format(str(rc)))  # Print result of connection attempt
-
-    for topic in ["router/car/moving", "router/car/running", "timelapse_trip/stop_command", "router/gps/latitude", "router/gps/longitude"]:
-        r=client.subscribe(topic)
-        tries = 10
-        while r[0]!=0:
-            logging.info("Waiting to subscribe to " + topic + " / Will exit the process after " + tries + " tries")
-            time.sleep(0.5)
-            if tries <= 0:
-                logging.info("Stop script")
-                client.publish("process/timelapse_trip/alive", False)
-                client.loop_stop()
-                client.disconnect()
-                sys.exit(1)
-
-def on_message(client, userdata, msg):  # The callback for when a PUBLISH message is received from the server.
-    global ignition, car_moving, stop_command, motion_state, time_since_idle
-
-    def update_state(state: Motion):
-        global time_since_idle, motion_state
-        if isinstance(state, Motion):
-            if state != motion_state:
-                logging.info("Change app state from " + repr(state) + " to " + repr(motion_state) + " succeeded")
-                motion_state = state
-                if state == Motion.IDLE:
-                    time_since_idle = dt.datetime.now()
-                else:
-                    time_since_idle = None
+from render import render_video
+from encoder import write_preview
+from live_render import LiveRenderer
+from gps_track import GpsTrackRecorder
+from alignment import parse_frame_timestamps
+from frame_selection import frame_signatures, difference_scores, frame_speeds, select_frames
+from job_queue import JobQueue
+from folder_watcher import FolderWatcher
+from motion import MotionStateMachine
+from telemetry import Telemetry
+from metrics import Metrics, MetricsServer, RssSampler, peak_rss_mb
+from profiler import JobProfiler, CPROFILE, SAMPLING
+
+
+# The render workers are started from the forkserver, which imports this script again: only run the daemon
+# when started as a script
+if __name__ == "__main__":
+    # ------------------------------------------------------------------------------------------------------------------
+    # Read script parameters
+    # ------------------------------------------------------------------------------------------------------------------
+    path_to_conf = os.path.join("/etc/capsule/timelapse_trip/config.yaml")
+    # If the default configuration is not install, then configure w/ the default one
+    if not os.path.exists(path_to_conf):
+        sys.exit("Configuration file %s does not exists. Please reinstall the app" % path_to_conf)
+    # load configuration
+    with open(path_to_conf, "r") as file:
+        conf = yaml.load(file, Loader=yaml.FullLoader)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Initiate variables
+    # ------------------------------------------------------------------------------------------------------------------
+    connected = False
+    configure_logging(dict(
+        filename="/var/log/capsule/timelapse_trip.log",
+        filemode="a",
+        level=logging.DEBUG if conf["debug"] else logging.INFO,
+        format="%(asctime)s %(levelname)s:%(message)s",
+        datefmt='%m/%d/%Y %I:%M:%S %p'))
+
+    # Dump configuration
+    logging.debug("Dump configuration: " + repr(conf))
+
+    # Open the persistent tile store shared by every map generation
+    tile_store = open_tile_store(conf)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Initiate MQTT variables
+    # ------------------------------------------------------------------------------------------------------------------
+    # Wake the main loop on the new trip folders and frames instead of polling the folders
+    folder_watcher = FolderWatcher(path_to_timelapse_tmp, poll_period=conf.get("watch", {}).get("poll_period_s", 1))
+    logging.info("Watch " + path_to_timelapse_tmp + (" with inotify" if folder_watcher.uses_inotify else " by polling"))
+    # Motion state updated by the MQTT events, every event wakes the main loop
+    motion = MotionStateMachine(conf.get("motion", {}).get("idle_timeout_s", 10), folder_watcher.wake)
+    # Profiling mode requested over MQTT for the next render job
+    profile_request = None
+    # Record the GPS fixes of the trips locally so the render does not depend on the database
+    gps_track_recorder = GpsTrackRecorder(conf.get("gps_track", {}).get("path", path_to_gps_tracks),
+                                          max_age_days=conf.get("gps_track", {}).get("max_age_days", 30))
+    # MQTT methods
+    def on_connect(client, userdata, flags, rc):  # The callback for when the client connects to the broker
+        logging.info("Connected with result code {0}".format(str(rc)))  # Print result of connection attempt
+
+        for topic in ["router/car/moving", "router/car/running", "timelapse_trip/stop_command", "timelapse_trip/profile_command",
+                      "router/gps/latitude", "router/gps/longitude"]:
+            r=client.subscribe(topic)
+            tries = 10
+            while r[0]!=0:
+                logging.info("Waiting to subscribe to " + topic + " / Will exit the process after " + tries + " tries")
+                time.sleep(0.5)
+                if tries <= 0:
+                    logging.info("Stop script")
+                    client.publish("process/timelapse_trip/alive", False)
+                    client.loop_stop()
+                    client.disconnect()
+                    sys.exit(1)
+
+    def on_message(client, userdata, msg):  # The callback for when a PUBLISH message is received from the server.
+        global profile_request
+        data = msg.payload.decode("utf-8")
+        if msg.topic == "timelapse_trip/profile_command":
+            # Profile the next render job: "cprofile", "sampling" or "False" to cancel
+            profile_request = data if data in (CPROFILE, SAMPLING) else None
+            logging.info("Profile the next render job: " + repr(profile_request))
+        if msg.topic == "timelapse_trip/stop_command":
+            motion.update(stop_command=data == "True")
+        if msg.topic == "router/car/running":
+            motion.update(ignition=data == "1")
+        if msg.topic == "router/car/moving":
+            motion.update(moving=data == "1")
+        if msg.topic == "router/gps/latitude" or msg.topic == "router/gps/longitude":
+            try:
+                gps_track_recorder.update(msg.topic.split("/")[-1], float(data))
+            except ValueError:
+                logging.warning("Invalid GPS value on " + msg.topic + ": " + data)
+
+
+
+    def wait_for(client,msgType,period=0.25):
+     if msgType=="SUBACK":
+      if client.on_subscribe:
+        while not client.suback_flag:
+          logging.info("waiting suback")
+          client.loop()  #check for messages
+          time.sleep(period)
+
+    client = mqtt.Client()
+    logging.info("Connect to localhost broker")
+    client.username_pw_set(conf["mqtt"]["user"], conf["mqtt"]["pass"])
+    client.on_connect = on_connect  # Define callback function for successful connection
+    client.on_message = on_message
+    # Reset the retained alive status if the daemon dies
+    client.will_set("process/timelapse_trip/alive", False, retain=True)
+    client.connect(conf["mqtt"]["host"], conf["mqtt"]["port"])
+    client.loop_start()
+
+    while not client.is_connected():
+        logging.info("Waiting for the broker connection")
+        time.sleep(1)
+
+    # Publish the status on change or at the heartbeat only
+    telemetry_conf = conf.get("telemetry", {})
+    telemetry = Telemetry(client, telemetry_conf.get("heartbeat_s", 30), telemetry_conf.get("min_interval_s", 1),
+                          telemetry_conf.get("retained", ["process/timelapse_trip/alive", "process/timelapse_trip/last_status"]))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Main loop
+    # ------------------------------------------------------------------------------------------------------------------
+    def stop_script(process, why):
+        """
+        Stop the capture process, within a bounded delay
+        process: capture process
+        why: reason of the stop
+        """
+        if not process:
+            return
+        logging.info("Process killed: " + why)
+        gps_track_recorder.stop()
+        stop_timeout = conf.get("motion", {}).get("stop_timeout_s", 5)
+        try:
+            # Send the quit key unless the capture was already asked to stop
+            process.communicate(None if process.stdin.closed else "q", timeout=stop_timeout)
+        except TimeoutExpired:
+            logging.warning("The capture did not stop within " + str(stop_timeout) + " seconds, terminate it")
+            for sig in (signal.SIGTERM, signal.SIGKILL):
+                try:
+                    os.killpg(process.pid, sig)
+                    process.communicate(timeout=2)
+                    break
+                except ProcessLookupError:
+                    break
+                except TimeoutExpired:
+                    pass
+        motion.mark_stopped()
+        logging.info("Capture latency: " + repr(motion.latency_stats()))
+
+
+    def process_timelapse(timelapse_to_process, rss=None):
+        """
+        Render the timelapse video of a trip, run by the render threads
+        timelapse_to_process: path to the timelapse frames folder
+        rss: optional RssSampler sampling the memory of the daemon during the job
+        """
+        logging.info("Start process the timelapse:" + timelapse_to_process)
+        telemetry.publish("process/timelapse_trip/timelapse_process_progress", 0)
+        # Retrieve the timestamps
+        images_sorted = sorted(os.listdir(timelapse_to_process))
+        # Generate video for at least 5 minutes of images (300 images)
+        if len(images_sorted) < 300:
+            logging.warning("The timelapse is too short (" + str(len(images_sorted)) + " images). The timelapse is not generated")
+            #shutil.rmtree(timelapse_to_process)
+            shutil.move(timelapse_to_process, f"/home/rudloff/timelapse_backup/{dt.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}/photo")
+            return
+
+        job_metrics = Metrics()
+        job_start = time.perf_counter()
+        # Keep only jpg files
+        images_sorted = [image for image in images_sorted if image.endswith(".jpg")]
+        frame_timestamps = parse_frame_timestamps(images_sorted)
+        telemetry.publish("process/timelapse_trip/timelapse_process_progress", 10)
+
+        # Resume the checkpointed render of these frames if any
+        result_folder = path_to_current_results + "/" + os.path.basename(timelapse_to_process)
+        os.makedirs(result_folder, 0o740, exist_ok=True)
+        manifest = RenderManifest.load(result_folder, images_sorted)
+
+        # Get the position of every frame from the local GPS tracks, or else from the influxdb database
+        alignment = manifest.load_alignment()
+        if alignment:
+            latitudes, longitudes = alignment
         else:
-            logging.warning("Change app state from " + repr(state) + " to " + repr(motion_state) + " failed")
-
-    data = msg.payload.decode("utf-8")
-    if msg.topic == "timelapse_trip/stop_command":
-        stop_command = True if data == "True" else False
-    if msg.topic == "router/car/running":
-        ignition = True if data == "1" else False
-    if msg.topic == "router/car/moving":
-        car_moving = True if data == "1" else False
-
-    if msg.topic == "router/car/running" or msg.topic == "router/car/moving":
-        if ignition and car_moving:
-            # The ignition is on and the car is moving
-            update_state(Motion.DRIVE)
-        if not ignition and not car_moving:
-            update_state(Motion.STOP)
-        if ignition and not car_moving:
-            # The car is on but not moving
-            update_state(Motion.IDLE)
-
-
-
-def wait_for(client,msgType,period=0.25):
- if msgType=="SUBACK":
-  if client.on_subscribe:
-    while not client.suback_flag:
-      logging.info("waiting suback")
-      client.loop()  #check for messages
-      time.sleep(period)
-
-client = mqtt.Client()
-logging.info("Connect to localhost broker")
-client.username_pw_set(conf["mqtt"]["user"], conf["mqtt"]["pass"])
-client.on_connect = on_connect  # Define callback function for successful connection
-client.on_message = on_message
-client.connect(conf["mqtt"]["host"], conf["mqtt"]["port"])
-client.loop_start()
-
-while not client.is_connected():
-    logging.info("Waiting for the broker connection")
-    time.sleep(1)
-
-# ----------------------------------------------------------------------------------------------------------------------
-# Main loop
-# ----------------------------------------------------------------------------------------------------------------------
-def stop_script(process, why):
-    if not process:
-        return
-    logging.info("Process killed: " + why)
-    process.stdin.write("q")
-    process.communicate()[0]
-    process.stdin.close()
-    logging.info("Wait 5 seconds for the subprocess to be correctly killed")
-    time.sleep(5)
-
-
-process = None
-try:
-    while True:
-        client.publish("process/timelapse_trip/alive", True)
-        client.publish("process/timelapse_trip/last_status", "Waiting for action")
-        if motion_state == Motion.DRIVE and not stop_command:
-            args = ["/home/rudloff/sources/CapsuleScripts/timelapse_geolocate/src/ffmpeg_timelapse_thread.sh", str(conf["rtsp"]["framerate"])]
-            process = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True, encoding='utf8')
+            with job_metrics.time("gps"):
+                latitudes, longitudes = retrieve_frame_positions(frame_timestamps, conf)
+            manifest.save_alignment(latitudes, longitudes)
+
+        # Thin out the redundant frames captured while the car is stopped before the expensive stages
+        selection_conf = conf.get("frame_selection", {})
+        if selection_conf.get("enabled", True):
+            selected = manifest.load_selection()
+            if selected is None:
+                with job_metrics.time("frame_selection"):
+                    scores = difference_scores(frame_signatures(
+                        [os.path.join(timelapse_to_process, image) for image in images_sorted],
+                        selection_conf.get("width", 32), selection_conf.get("threads", 2)))
+                    speeds = None if latitudes is None else frame_speeds(frame_timestamps, latitudes, longitudes)
+                    selected = select_frames(scores, speeds, selection_conf.get("threshold", 0.005),
+                                             selection_conf.get("min_speed_kmh", 3), selection_conf.get("keep_every", 10))
+                manifest.save_selection(selected)
+            job_metrics.add("frames_dropped", len(images_sorted) - len(selected))
+            logging.info("Render " + str(len(selected)) + " frames out of " + str(len(images_sorted)))
+            images_sorted = [images_sorted[idx] for idx in selected]
+            frame_timestamps = frame_timestamps[selected]
+            if latitudes is not None:
+                latitudes, longitudes = latitudes[selected], longitudes[selected]
+        continue_without_map = latitudes is None
+
+        degree_ranges = None
+        if not continue_without_map:
+            # Zoom out as the car drives faster
+            degree_ranges = plan_map_zoom(conf, frame_timestamps, latitudes, longitudes)
+            if prefetches_tiles(conf):
+                # Download every tile of the trip from the local tile server before the render
+                with job_metrics.time("tile_prefetch"):
+                    requested, downloaded, failed = prefetch_map_tiles(conf, tile_store, latitudes, longitudes, degree_ranges)
+                logging.info("Prefetched the map tiles: " + str(requested) + " needed, " + str(downloaded) + " downloaded, "
+                             + str(failed) + " failed")
+
+        # Construct the map, the prefetched tiles are never downloaded again
+        map_renderer = build_map_renderer(conf, tile_store, offline=degree_ranges is not None and prefetches_tiles(conf))
+
+        # In streaming mode the maps are rendered in memory and handed to the compositor
+        streaming_maps = conf["map_generation"].get("streaming", True)
+
+        # Create the map folder
+        path_to_maps = os.path.join(timelapse_to_process, "maps")
+        if not streaming_maps:
+            if os.path.exists(path_to_maps):
+                #shutil.rmtree(path_to_maps)
+                shutil.move(timelapse_to_process, f"/home/rudloff/timelapse_backup/{dt.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}maps")
+            os.makedirs(path_to_maps, 0o740)
+            os.chown(path_to_maps, 1000, 1000) # Rudloff id and group Root
+            os.chmod(path_to_maps, 0o775) # Give all read access but Rudloff write access
+        lat_list = []
+        lon_list = []
+        frames = [os.path.join(timelapse_to_process, image_path) for image_path in images_sorted]
+        timestamps_date = [os.path.splitext(image_path)[0] for image_path in images_sorted]
+        if not continue_without_map and not streaming_maps:
+            for idx, timestamp_date in enumerate(timestamps_date):
+                telemetry.publish("process/timelapse_trip/timelapse_process_progress", 10+round(50*idx/len(timestamps_date)))
+                lat_list.append(latitudes[idx])
+                lon_list.append(longitudes[idx])
+                # Retrieve the maps and save it
+                with job_metrics.time("map_file"):
+                    retrieve_save_map(lat_list, lon_list, map_renderer, timestamp_date, path_to_maps, degree_ranges[idx])
+
+        # Combine the map and the frame and generate the mp4 timelapse
+        frameSize = (conf.get("encoder", {}).get("width", 2304), conf.get("encoder", {}).get("height", 1296))
+        maps = None
+        if continue_without_map:
+            latitudes = longitudes = None
+        elif not streaming_maps:
+            maps = [os.path.join(path_to_maps, timestamp_date)+".png" for timestamp_date in timestamps_date]
+        render_start = time.perf_counter()
+        render_stats = render_video(result_folder + "/video.mp4", frames, timestamps_date, latitudes, longitudes, maps,
+            conf, frameSize, conf.get("encoder", {}).get("fps", 10), conf.get("render", {}).get("workers", 1),
+            lambda done, total: telemetry.publish("process/timelapse_trip/timelapse_process_progress", 10+50+round(20*done/total)),
+            manifest, conf.get("render", {}).get("segment_frames", 600), job_metrics, degree_ranges)
+        render_duration = time.perf_counter() - render_start
+        job_metrics.observe("render", render_duration)
+        manifest.mark_done()
+        logging.info("Timelapse saved: " + result_folder + "/video.mp4")
+        logging.info("Tile store stats: " + repr(tile_store.stats()) + ", render: " + repr(render_stats))
+
+        # Write a small preview that can be sent from the Pi, streamed one frame at a time
+        preview_conf = conf.get("preview", {})
+        if preview_conf.get("enabled", True):
+            preview_path = os.path.join(result_folder, "preview." + preview_conf.get("format", "gif"))
             try:
-                logging.info("Start timelapse")
-
-                logging.info("Start camera if not ON")
-                os.system("curl http://192.168.10.1/cgi-bin/io_state\?username\=rudloff\&password\=pam1249CS1110ragot\&pin\=dout2\&state\=on")
-                pic = 0
-                while True:
-                    pic = pic + 1
-                    client.publish("process/timelapse_trip/alive", True)
-                    client.publish("process/timelapse_trip/last_status", "Take picture")
-                    client.publish("process/timelapse_trip/timelapse_process_progress", pic)
-                    if motion_state == Motion.STOP or stop_command:
-                        stop_script(process, "Motion Stop" if motion_state == Motion.STOP else "stop command by user")
-                        break
-                    # OR if idling for too long
-                    if time_since_idle:
-                        if motion_state == Motion.IDLE and dt.datetime.now() - time_since_idle > dt.timedelta(seconds=10):
-                            stop_script(process, "Idling for too long")
+                with job_metrics.time("preview"):
+                    write_preview(result_folder + "/video.mp4", preview_path, preview_conf.get("width", 480),
+                                  preview_conf.get("fps", 10), preview_conf.get("frame_step", 5),
+                                  preview_conf.get("palette_samples", 16), preview_conf.get("quality", 75))
+                logging.info("Timelapse preview saved: " + preview_path)
+            except (IOError, RuntimeError) as e:
+                logging.warning("Failed to write the timelapse preview: " + repr(e))
+        telemetry.publish("process/timelapse_trip/timelapse_process_progress", 90)
+
+        # Keep the metrics of the job next to the video and in the daemon registry
+        job_metrics.observe("job", time.perf_counter() - job_start)
+        rendered_frames = job_metrics.summary()["counters"].get("frames", 0)
+        job_metrics.gauge("fps", rendered_frames / render_duration if render_duration > 0 else 0.0)
+        if rss is not None:
+            job_metrics.gauge("job_peak_rss_mb", rss.peak_mb)
+        metrics.merge(job_metrics.summary())
+        with open(os.path.join(result_folder, "metrics.json"), "w") as file:
+            json.dump(dict(job_metrics.summary(), frames=len(frames), jobs=job_queue.counts()), file, indent=2)
+        logging.info("Render metrics: " + str(rendered_frames) + " frames at " + "{:.2f}".format(
+            job_metrics.summary()["gauges"]["fps"]["last"]) + " fps")
+
+        # Move the frames and the maps folder if any to the backup folder
+        if os.path.exists(timelapse_to_process):
+            #shutil.rmtree(path_to_maps)
+            shutil.move(timelapse_to_process, f"/home/rudloff/timelapse_backup/{dt.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}/map")
+            logging.info("Move the timelapse frames to the backup folder")
+        telemetry.publish("process/timelapse_trip/timelapse_process_progress", 100)
+
+
+    def run_job(timelapse_to_process, profile_mode):
+        """
+        Render a queued timelapse, profiled if requested; the profile is written in the result folder
+        timelapse_to_process: path to the timelapse frames folder
+        profile_mode: "cprofile", "sampling" or None
+        """
+        # Memory of the daemon during the job, its peak over the daemon life would cover the previous jobs
+        with RssSampler(conf.get("metrics", {}).get("rss_period_s", 0.5)) as rss:
+            if not profile_mode:
+                return process_timelapse(timelapse_to_process, rss)
+            profiling_conf = conf.get("profiling", {})
+            with JobProfiler(os.path.join(path_to_current_results, os.path.basename(timelapse_to_process)), profile_mode,
+                             profiling_conf.get("sample_interval_ms", 10) / 1000, profiling_conf.get("tracemalloc_frames", 10)):
+                process_timelapse(timelapse_to_process, rss)
+
+
+    process = None
+    live_renderers = []
+    # Render the queued timelapses in background threads
+    job_queue = JobQueue(conf.get("jobs", {}).get("path", path_to_job_queue), conf.get("jobs", {}).get("max_attempts", 3),
+                         conf.get("jobs", {}).get("backoff_s", 60))
+    logging.info("Recover " + str(job_queue.recover()) + " interrupted jobs, queue: " + repr(job_queue.counts()))
+    render_concurrency = conf.get("jobs", {}).get("concurrency", 1)
+    render_executor = ThreadPoolExecutor(max_workers=render_concurrency, thread_name_prefix="render")
+    running_jobs = {}
+    # Metrics of the rendered jobs, served to Prometheus on the local endpoint
+    metrics = Metrics()
+    def sample_daemon_metrics():
+        for state, count in job_queue.counts().items():
+            metrics.gauge("jobs_" + state, count)
+        metrics.gauge("running_jobs", len(running_jobs))
+        metrics.gauge("daemon_peak_rss_mb", peak_rss_mb()[0])
+        # Delay between the motion events and the capture start/stop
+        for name, latency in motion.latency_stats().items():
+            metrics.gauge("capture_" + name + "_latency_seconds", latency["last"])
+            metrics.gauge("capture_" + name + "_latency_max_seconds", latency["max"])
+    metrics_server = None
+    if conf.get("metrics", {}).get("port", 9105):
+        try:
+            metrics_server = MetricsServer(metrics, conf.get("metrics", {}).get("host", "127.0.0.1"),
+                                           conf.get("metrics", {}).get("port", 9105), sample_daemon_metrics)
+            metrics_server.start()
+        except OSError as e:
+            logging.warning("Cannot start the metrics endpoint: " + repr(e))
+    class ShutdownRequested(Exception):
+        """
+        Raised in the main loop when systemd stops the daemon, unlike a user interrupt it also ends a capture
+        """
+    def on_sigterm(signum, frame):
+        raise ShutdownRequested
+    signal.signal(signal.SIGTERM, on_sigterm)
+    try:
+        while True:
+            telemetry.publish("process/timelapse_trip/alive", True)
+            telemetry.publish("process/timelapse_trip/last_status", "Waiting for action")
+            if motion.should_capture():
+                args = ["/home/rudloff/sources/CapsuleScripts/timelapse_geolocate/src/ffmpeg_timelapse_thread.sh", str(conf["rtsp"]["framerate"])]
+                # In its own process group so a stuck capture can be killed with its children
+                process = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True, encoding='utf8', start_new_session=True)
+                motion.mark_started()
+                gps_track_recorder.start(dt.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+                # Render the timelapse while driving
+                live_renderer = None
+                if conf.get("live_render", {}).get("enabled", False):
+                    live_renderer = LiveRenderer(path_to_timelapse_tmp, path_to_current_results, conf)
+                    live_renderer.start()
+                    live_renderers.append(live_renderer)
+                try:
+                    logging.info("Start timelapse")
+
+                    logging.info("Start camera if not ON")
+                    os.system("curl http://192.168.10.1/cgi-bin/io_state\?username\=rudloff\&password\=pam1249CS1110ragot\&pin\=dout2\&state\=on")
+                    pic = 0
+                    while True:
+                        pic = pic + 1
+                        telemetry.publish("process/timelapse_trip/alive", True)
+                        telemetry.publish("process/timelapse_trip/last_status", "Take picture")
+                        telemetry.publish("process/timelapse_trip/timelapse_process_progress", pic)
+                        # Woken as soon as the car stops, the stop command is received or the idling times out
+                        why = motion.wait_for_stop(conf.get("motion", {}).get("heartbeat_s", 1))
+                        if why is not None:
+                            stop_script(process, why)
                             break
-                    time.sleep(1/conf["rtsp"]["framerate"])
-            except TimeoutExpired as e:
-                stop_script(process, 'Timelapse process as been killed outside of the script: {}'.format(e))
-            except KeyboardInterrupt:
-                stop_script(process, "Timelapse process as been killed by the user")
-                pass
-        # Get the non empty timelapses that need to be processed
-        timelapses_to_process = get_timelapse_to_process(path_to_timelapse_tmp, path_to_current_results)
-        if timelapses_to_process: # If the list is not empty
-            client.publish("process/timelapse_trip/last_status", "Generate timelapse")
-            for timelapse_to_process in timelapses_to_process:
-                logging.info("Start process the timelapse:" + timelapse_to_process)
-                client.publish("process/timelapse_trip/timelapse_process_progress", 0)
-                # Retrieve the timestamps
-                images_sorted = sorted(os.listdir(timelapse_to_process))
-                # Generate video for at least 5 minutes of images (300 images)
-                if len(images_sorted) < 300:
-                    logging.warning("The timelapse is too short (" + str(len(images_sorted)) + " images). The timelapse is not generated")
-                    #shutil.rmtree(timelapse_to_process)
-                    shutil.move(timelapse_to_process, f"/home/rudloff/timelapse_backup/{dt.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}/photo")
+                except TimeoutExpired as e:
+                    stop_script(process, 'Timelapse process as been killed outside of the script: {}'.format(e))
+                except KeyboardInterrupt:
+                    stop_script(process, "Timelapse process as been killed by the user")
+                    pass
+                except ShutdownRequested:
+                    stop_script(process, "Timelapse process as been stopped by the system")
+                    process = None
+                    raise
+                if live_renderer:
+                    live_renderer.finish()
+            # Forget the live renders that are done
+            for live_renderer in [live_renderer for live_renderer in live_renderers if not live_renderer.is_alive()]:
+                live_renderer.close()
+                live_renderers.remove(live_renderer)
+            # Queue the new timelapses, the interrupted renders first
+            for timelapse_to_process in get_timelapse_to_process(path_to_timelapse_tmp, path_to_current_results):
+                # Left to the live render of the trip while it runs, its unfinished manifest queues the trip if it fails
+                if any(live_renderer.owns(timelapse_to_process) for live_renderer in live_renderers):
+                    continue
+                resumed = os.path.exists(os.path.join(path_to_current_results, os.path.basename(timelapse_to_process)))
+                if job_queue.enqueue(timelapse_to_process, 1 if resumed else 0):
+                    logging.info("Queue the timelapse: " + timelapse_to_process)
+            # Record the finished renders
+            for future in [future for future in running_jobs if future.done()]:
+                job = running_jobs.pop(future)
+                if future.exception() is None:
+                    job_queue.complete(job["id"])
+                else:
+                    state = job_queue.fail(job["id"], repr(future.exception()))
+                    logging.error("Render of " + job["folder"] + " failed (attempt " + str(job["attempts"]) + ", " + state + "): "
+                                  + repr(future.exception()))
+            # Start the queued renders up to the concurrency
+            while len(running_jobs) < render_concurrency:
+                job = job_queue.claim()
+                if job is None:
                     break
+                if not os.path.exists(job["folder"]):
+                    logging.warning("The timelapse " + job["folder"] + " does not exist anymore")
+                    job_queue.complete(job["id"])
+                    continue
+                telemetry.publish("process/timelapse_trip/last_status", "Generate timelapse")
+                # Profile every job if enabled in the configuration, or else the next job after a profile command
+                profile_mode = conf.get("profiling", {}).get("mode", SAMPLING) if conf.get("profiling", {}).get("enabled", False) else None
+                if profile_request and not profile_mode:
+                    profile_mode, profile_request = profile_request, None
+                future = render_executor.submit(run_job, job["folder"], profile_mode)
+                future.add_done_callback(lambda future: folder_watcher.wake())
+                running_jobs[future] = job
+            # Clear empty tmp folder or already generated timelapses
+            # TODO for now the timelapses are not removed
+            #clear_timelapse_to_process(path_to_timelapse_tmp, path_to_current_results)
+            # Sleep until a trip folder changes, the motion state changes or a render ends
+            folder_watcher.wait(conf.get("watch", {}).get("max_wait_s", 30))
+    except (KeyboardInterrupt, ShutdownRequested):
+        if process is not None:
+            stop_script(process, "Timelapse process as been killed by the user")
 
-                # Keep only jpg files
-                images_sorted = [image for image in images_sorted if image.endswith(".jpg")]
-                timestamps = [datetime.strptime(timestamp_dirty.strip(".jpg"), '%Y-%m-%d_%H-%M-%S').isoformat()\
-                     for timestamp_dirty in images_sorted]
-                client.publish("process/timelapse_trip/timelapse_process_progress", 10)
-
-                # Connect to influxdb client
-                #client = DataFrameClient("localhost", "8086", "rudloff", "y4uv3jpc", "telegraf")
-                influxdb_client =  DataFrameClient(conf["influxdb"]["url"], conf["influxdb"]["port"], conf["influxdb"]["user"], conf["influxdb"]["pass"], conf["influxdb"]["database"])
-                # Get the list of gps coordinates from the influxdb database
-                gps_coords = pd.DataFrame(retrieve_lat_lon(timestamps, influxdb_client))
-                # fill the N/A values with previous values
-                gps_coords.fillna(method='ffill', inplace=True)
-                gps_coords.fillna(method='bfill', inplace=True) # Fill in the first value
-                continue_without_map = False
-                if gps_coords.empty:
-                    logging.warning("The gps coordinates corresponding are not retrieved in the influxdb database. The timelapse generate continues without the map")
-                    continue_without_map = True
-                if gps_coords.isnull().values.any(): # Still got NaN values
-                    logging.warning("The gps coordinates corresponding are still null. The timelapse generation continues frames without the map")
-                    continue_without_map = True
-                continue_without_map = True
-
-                # Construct the map
-                if conf["map_generation_mean"] == "local":
-                    tiles = tilemapbase.tiles.Tiles(conf["map_generation"]["url"], conf["map_generation"]["tile_name"], headers={"User-Agent":"TileMapBase"})
-                else:
-                    tiles = tilemapbase.tiles.build_OSM()
-
-                # Create the map folder
-                path_to_maps = os.path.join(timelapse_to_process, "maps")
-                if os.path.exists(path_to_maps):
-                    #shutil.rmtree(path_to_maps)
-                    shutil.move(timelapse_to_process, f"/home/rudloff/timelapse_backup/{dt.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}maps")
-                os.makedirs(path_to_maps, 0o740)
-                os.chown(path_to_maps, 1000, 1000) # Rudloff id and group Root
-                os.chmod(path_to_maps, 0o775) # Give all read access but Rudloff write access
-                lat_list = []
-                lon_list = []
-                if not continue_without_map:
-                    for lat, lon, timestamp in zip(gps_coords["latitude"].tolist(), gps_coords["longitude"].tolist(), gps_coords.index) :
-                        client.publish("process/timelapse_trip/timelapse_process_progress", 10+round(50*len(lat_list)/len(gps_coords["latitude"].tolist())))
-                        lat_list.append(lat)
-                        lon_list.append(lon)
-                        # Retrieve the maps and save it
-                        retrieve_save_map(lat_list, lon_list, tiles, datetime.strftime(timestamp, '%Y-%m-%d_%H-%M-%S'), path_to_maps)
-                        time.sleep(0.01)
-
-                # Combine the map and the frame and generate the mp4 timelapse
-                frameSize = (2304, 1296)
-                result_folder = path_to_current_results + "/" + os.path.basename(timelapse_to_process)
-                os.makedirs(result_folder, 0o740)
-                video_out = cv2.VideoWriter(result_folder + "/video.mp4",
-                cv2.VideoWriter_fourcc(*'mp4v'), 10, frameSize)
-                if not continue_without_map:
-                    for idx, timestamp in enumerate(gps_coords.index):
-                        timestamp_date = datetime.strftime(timestamp, '%Y-%m-%d_%H-%M-%S')
-                        client.publish("process/timelapse_trip/timelapse_process_progress", 10+50+round(20*idx/len(images_sorted)))
-                        video_frame = combine(os.path.join(path_to_maps,timestamp_date)+".png", os.path.join(timelapse_to_process, timestamp_date)+".jpg",
-                                            timestamp_date, gps_coords["latitude"].values[idx], gps_coords["longitude"].values[idx])
-                        if video_frame is not None:
-                            video_out.write(video_frame)
-                        time.sleep(0.01)
-                else:
-                    for idx, image_path in enumerate(images_sorted):
-                        video_frame = cv2.imread(os.path.join(timelapse_to_process, image_path))
-                        if video_frame is not None:
-                            video_out.write(video_frame)
-                video_out.release()
-                logging.info("Timelapse saved: " + result_folder + "/video.mp4")
-
-                # Remove the maps folder
-                if os.path.exists(path_to_maps):
-                    #shutil.rmtree(path_to_maps)
-                    shutil.move(timelapse_to_process, f"/home/rudloff/timelapse_backup/{dt.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}/map")
-                    logging.info("Remove maps folder")
-                client.publish("process/timelapse_trip/timelapse_process_progress", 100)
-
-                break
-                # TODO convert in GIF (but for now its generation is heavy in terms off ram and memory)
-                # Combine the map and the frame and generate the gif timelapse
-                clip = (VideoFileClip(result_folder + "/video.mp4"))
-                clip.write_gif(result_folder + "/video.gif")
-                clip.write_gif()
-                client.publish("process/timelapse_trip/timelapse_process_progress", 100)
-                logging.info("Timelapse saved: " + result_folder + "/video.gif")
-                time.sleep(0.1)
-        # Clear empty tmp folder or already generated timelapses
-        # TODO for now the timelapses are not removed
-        #clear_timelapse_to_process(path_to_timelapse_tmp, path_to_current_results)
-        time.sleep(1)
-except KeyboardInterrupt:
-    stop_script(process, "Timelapse process as been killed by the user")
-    pass
-
-logging.info("Stop script")
-client.publish("process/timelapse_trip/alive", False)
-client.loop_stop()
-client.disconnect()
-sys.exit(0)
+    logging.info("Stop script")
+    # Let the live renders join their segments rather than being killed with the daemon
+    for live_renderer in live_renderers:
+        live_renderer.stop(conf.get("live_render", {}).get("stop_timeout_s", 120))
+    render_executor.shutdown(wait=True, cancel_futures=True)
+    job_queue.close()
+    folder_watcher.close()
+    if metrics_server:
+        metrics_server.close()
+    telemetry.publish("process/timelapse_trip/alive", False)
+    telemetry.close()
+    client.loop_stop()
+    client.disconnect()
+    tile_store.close()
+    sys.exit(0)
@@ -0,0 +1,311 @@
+"""
+Offline benchmark of the timelapse render on a synthetic trip
+The trip frames, its GPS track, the InfluxDB database and the tile server are generated locally so the
+benchmark runs without network; the results are saved as JSON to compare the runs
+Usage: python tests/benchmark/benchmark_render.py --frames 300 --output benchmark.json [--baseline previous.json]
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import numpy as np
+import cv2
+import requests
+from influxdb import InfluxDBClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+from gps_track import TRACK_DTYPE, TRACK_EXTENSION
+from alignment import parse_frame_timestamps, align_track
+from map_render import project
+from frame_source import PrefetchFrameSource
+from encoder import build_encoder
+from metrics import Metrics, peak_rss_mb
+from common import retrieve_gps_track, retrieve_frame_positions, open_tile_store, build_map_renderer, combine
+from render import render_video
+
+FRAME_SIZE = (2304, 1296)
+START = datetime(2021, 5, 3, 10, 0, 0, tzinfo=timezone.utc)
+ORIGIN = (48.8566, 2.3522)  # Latitude, longitude of the synthetic trip start
+
+
+def make_track(frames, speed_mps=15.0):
+    """
+    Generate a winding GPS track with one fix per second
+    frames: number of fixes
+    speed_mps: speed of the vehicle in meters per second
+    return a TRACK_DTYPE array
+    """
+    seconds = np.arange(frames)
+    heading = 0.3 * np.sin(seconds / 60.0)
+    step = speed_mps / 111320.0  # Degrees of latitude per second
+    track = np.zeros(frames, dtype=TRACK_DTYPE)
+    track["timestamp"] = (int(START.timestamp()) + seconds) * 1000
+    track["latitude"] = ORIGIN[0] + np.cumsum(step * np.cos(heading))
+    track["longitude"] = ORIGIN[1] + np.cumsum(step * np.sin(heading) / math.cos(math.radians(ORIGIN[0])))
+    return track
+
+
+def make_trip(folder, frames, seed=0):
+    """
+    Write the synthetic frames of a trip, named after their capture date, one per second
+    folder: trip folder
+    frames: number of frames
+    seed: seed of the frame noise
+    return the list of the frame paths
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    width, height = FRAME_SIZE
+    # A road like gradient with noise so the JPEG size is close to the camera ones
+    base = np.zeros((height, width, 3), np.uint8)
+    base[:] = np.linspace(40, 200, height, dtype=np.uint8)[:, None, None]
+    noise = rng.integers(0, 40, (height // 4, width // 4, 3), dtype=np.uint8)
+    noise = cv2.resize(noise, FRAME_SIZE, interpolation=cv2.INTER_LINEAR)
+    paths = []
+    for idx in range(frames):
+        name = datetime.fromtimestamp(START.timestamp() + idx, timezone.utc).strftime("%Y-%m-%d_%H-%M-%S") + ".jpg"
+        frame = cv2.add(base, np.roll(noise, idx * 16, axis=1))
+        cv2.putText(frame, str(idx), (100, 200), cv2.FONT_HERSHEY_SIMPLEX, 5, (255, 255, 255), 8)
+        path = os.path.join(folder, name)
+        cv2.imwrite(path, frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        paths.append(path)
+    return paths
+
+
+def make_tiles(folder, track, zoom, margin_deg=0.01):
+    """
+    Write a static directory of PNG tiles covering the track, laid out as {zoom}/{x}/{y}.png
+    folder: tile directory
+    track: TRACK_DTYPE array
+    zoom: zoom level of the tiles
+    margin_deg: margin around the track in degrees
+    return the number of tiles written
+    """
+    x0, y1 = project(track["longitude"].min() - margin_deg, track["latitude"].min() - margin_deg)
+    x1, y0 = project(track["longitude"].max() + margin_deg, track["latitude"].max() + margin_deg)
+    count = 0
+    for x in range(int(x0 * 2 ** zoom), int(x1 * 2 ** zoom) + 1):
+        os.makedirs(os.path.join(folder, str(zoom), str(x)), exist_ok=True)
+        for y in range(int(y0 * 2 ** zoom), int(y1 * 2 ** zoom) + 1):
+            tile = np.full((256, 256, 3), 235, np.uint8)
+            cv2.line(tile, (0, 128), (255, 128), (180, 180, 250), 12)
+            cv2.line(tile, (128, 0), (128, 255), (255, 255, 255), 6)
+            cv2.putText(tile, "{}/{}".format(x % 1000, y % 1000), (20, 60), cv2.FONT_HERSHEY_SIMPLEX, 1, (90, 90, 90), 2)
+            cv2.imwrite(os.path.join(folder, str(zoom), str(x), str(y) + ".png"), tile)
+            count += 1
+    return count
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_tiles(folder):
+    """
+    Serve the tile directory on a local HTTP server in place of the tile server
+    folder: tile directory
+    return the running server
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=folder))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StubInfluxClient(InfluxDBClient):
+    """
+    InfluxDB client answering the GPS track query from an in-memory track, streamed in chunks
+    Only the HTTP session is stubbed, the query and its result are handled by the real client
+    track: TRACK_DTYPE array
+    """
+    def __init__(self, track):
+        super().__init__("localhost", 8086, "benchmark", "benchmark", "benchmark")
+        self.track = track
+        self.queries = 0
+        self._session.request = self._respond
+
+    def _respond(self, method, url, params=None, **kwargs):
+        self.queries += 1
+        start, end = [np.datetime64(value.rstrip("Z"), "ms").astype(np.int64)
+                      for value in re.findall(r"time [<>]= '([^']+)'", params["q"])]
+        track = self.track[(self.track["timestamp"] >= start) & (self.track["timestamp"] <= end)]
+        chunk_size = int(params.get("chunk_size") or len(track) or 1)
+        chunks = []
+        for field in ("latitude", "longitude"):
+            for offset in range(0, len(track), chunk_size):
+                values = [[int(time), float(value)] for time, value in
+                          zip(track["timestamp"][offset:offset + chunk_size], track[field][offset:offset + chunk_size])]
+                series = {"name": "mqtt_consumer", "tags": {"topic": "router/gps/" + field},
+                          "columns": ["time", "value"], "values": values}
+                chunks.append(json.dumps({"results": [{"statement_id": 0, "series": [series]}]}))
+        response = requests.Response()
+        response.status_code = 200
+        response.headers["Content-Type"] = "application/json"
+        response._content = "\n".join(chunks).encode("utf-8")
+        response._content_consumed = True
+        return response
+
+
+def measure(results, stage, function, frames=0, size_bytes=0):
+    """
+    Run a benchmark stage and record its duration, frame rate and throughput
+    results: dict of the stage results
+    stage: name of the stage
+    function: callable running the stage, its result is returned
+    frames: number of frames processed by the stage
+    size_bytes: number of bytes processed by the stage
+    """
+    start = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start
+    results[stage] = {"seconds": seconds, "frames": frames,
+                      "fps": frames / seconds if frames and seconds else None,
+                      "mb_per_s": size_bytes / seconds / 1e6 if size_bytes and seconds else None}
+    print("{:<16} {:8.3f} s".format(stage, seconds) + ("  {:8.1f} fps".format(frames / seconds) if frames else "")
+          + ("  {:8.1f} MB/s".format(size_bytes / seconds / 1e6) if size_bytes else ""))
+    return value
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="timelapse_benchmark_")
+    try:
+        print("Generate a synthetic trip of " + str(args.frames) + " frames in " + workdir)
+        track = make_track(args.frames)
+        frames = make_trip(os.path.join(workdir, "trip"), args.frames)
+        names = [os.path.basename(path) for path in frames]
+        input_bytes = sum(os.path.getsize(path) for path in frames)
+        os.makedirs(os.path.join(workdir, "gps_tracks"))
+        track.tofile(os.path.join(workdir, "gps_tracks", "trip" + TRACK_EXTENSION))
+        tile_count = make_tiles(os.path.join(workdir, "tiles"), track, args.zoom)
+        server = serve_tiles(os.path.join(workdir, "tiles"))
+        conf = {
+            "map_generation_mean": "local",
+            "map_generation": {"url": "http://127.0.0.1:" + str(server.server_address[1]) + "/{zoom}/{x}/{y}.png",
+                               "tile_name": "benchmark", "route": not args.no_route, "streaming": True},
+            "tile_store": {"path": os.path.join(workdir, "tile_store.sqlite")},
+            "gps_track": {"path": os.path.join(workdir, "gps_tracks")},
+            "render": {"workers": args.workers, "segment_frames": args.segment_frames},
+            "encoder": {"backend": args.encoder, "width": FRAME_SIZE[0], "height": FRAME_SIZE[1], "fps": 10},
+        }
+        results = {}
+
+        # GPS positions of the frames
+        frame_timestamps = measure(results, "parse_names", lambda: parse_frame_timestamps(names), args.frames)
+        influx = StubInfluxClient(track)
+        start_ms, end_ms = (int(frame_timestamps[0]) - 5) * 1000, (int(frame_timestamps[-1]) + 5) * 1000
+        queried = measure(results, "gps_query", lambda: retrieve_gps_track(start_ms, end_ms, influx, args.chunk_size),
+                          args.frames)
+        measure(results, "alignment", lambda: align_track(frame_timestamps * 1000, queried["timestamp"],
+                                                          queried["latitude"], queried["longitude"]), args.frames)
+        latitudes, longitudes = measure(results, "gps_local", lambda: retrieve_frame_positions(
+            frame_timestamps, conf, use_database=False), args.frames)
+
+        # Frame decoding
+        def read_all():
+            return [frame is not None for frame in PrefetchFrameSource(frames, threads=2)]
+        measure(results, "imread", read_all, args.frames, input_bytes)
+
+        # Map rendering, with the tiles downloaded then read from the tile store
+        def render_maps():
+            tile_store = open_tile_store(conf)
+            renderer = build_map_renderer(conf, tile_store)
+            maps = []
+            for lat, lon in zip(latitudes, longitudes):
+                if renderer.route is not None:
+                    renderer.route.add_point(lat, lon)
+                maps.append(renderer.render(lat, lon))
+            tile_store.close()
+            return maps
+        maps = measure(results, "map_cold", render_maps, args.frames)
+        measure(results, "map_warm", render_maps, args.frames)
+
+        # Compositing and encoding of in-memory frames
+        sample = [cv2.imread(path) for path in frames[:min(10, len(frames))]]
+        def combine_all():
+            return [combine(maps[idx], sample[idx % len(sample)].copy(), names[idx][:-4], latitudes[idx], longitudes[idx])
+                    for idx in range(args.frames)]
+        composed = measure(results, "combine", combine_all, args.frames)
+        def encode_all():
+            with build_encoder(conf, os.path.join(workdir, "encode.mp4"), FRAME_SIZE, 10) as encoder:
+                for frame in composed:
+                    encoder.write(frame)
+        measure(results, "encode", encode_all, args.frames, args.frames * FRAME_SIZE[0] * FRAME_SIZE[1] * 3)
+        del composed, maps, sample
+
+        # End to end render of the trip loop
+        render_metrics = Metrics()
+        measure(results, "end_to_end", lambda: render_video(
+            os.path.join(workdir, "video.mp4"), frames, [name[:-4] for name in names], latitudes, longitudes, None,
+            conf, FRAME_SIZE, 10, args.workers, None, None, args.segment_frames, render_metrics),
+            args.frames, input_bytes)
+        server.shutdown()
+        own_rss, children_rss = peak_rss_mb()
+        return {
+            "benchmark": {"frames": args.frames, "frame_size": FRAME_SIZE, "workers": args.workers,
+                          "segment_frames": args.segment_frames, "chunk_size": args.chunk_size, "encoder": args.encoder,
+                          "route": not args.no_route, "zoom": args.zoom, "tiles": tile_count, "input_mb": input_bytes / 1e6,
+                          "date": datetime.now(timezone.utc).isoformat(), "revision": git_revision(),
+                          "python": platform.python_version(), "opencv": cv2.__version__,
+                          "machine": platform.machine(), "cpu_count": os.cpu_count()},
+            "stages": results,
+            "render_metrics": render_metrics.summary(),
+            "peak_rss_mb": {"benchmark": own_rss, "children": children_rss},
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results, baseline):
+    """
+    Print the speedup of each stage against a previous run
+    """
+    print("Compared to the baseline " + str(baseline["benchmark"].get("revision")) + ":")
+    for stage, result in results["stages"].items():
+        previous = baseline["stages"].get(stage)
+        if previous and result["seconds"]:
+            print("{:<16} x{:.2f}".format(stage, previous["seconds"] / result["seconds"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the timelapse render on a synthetic trip")
+    parser.add_argument("--frames", type=int, default=300, help="number of frames of the synthetic trip")
+    parser.add_argument("--workers", type=int, default=1, help="number of render processes, 0 for one per CPU core")
+    parser.add_argument("--segment-frames", type=int, default=600, help="frames per rendered segment")
+    parser.add_argument("--encoder", default="ffmpeg", choices=["ffmpeg", "opencv"], help="video encoder backend")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="GPS points per chunk of the InfluxDB response")
+    parser.add_argument("--zoom", type=int, default=17, help="zoom level of the generated tiles")
+    parser.add_argument("--no-route", action="store_true", help="do not draw the route over the maps")
+    parser.add_argument("--output", default="benchmark.json", help="path to the JSON results")
+    parser.add_argument("--baseline", help="path to the JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print("Results saved to " + args.output)
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import unittest
+from datetime import datetime, timezone
+from unittest import TestCase
+import numpy as np
+from alignment import parse_frame_timestamps, align_track
+
+
+class TestAlignment(TestCase):
+    def test_parse_frame_timestamps(self):
+        names = ["2021-05-03_10-00-00.jpg", "2021-05-03_10-00-01.jpg", "2024-02-29_23-59-59.jpg", "1999-12-31_00-00-00"]
+        expected = [int(datetime.strptime(name[:19], '%Y-%m-%d_%H-%M-%S').replace(tzinfo=timezone.utc).timestamp())
+                    for name in names]
+        timestamps = parse_frame_timestamps(names)
+        self.assertEqual(timestamps.dtype, np.int64)
+        self.assertEqual(timestamps.tolist(), expected)
+        self.assertEqual(len(parse_frame_timestamps([])), 0)
+        with self.assertRaises(ValueError):
+            parse_frame_timestamps(["2021-05-03_10-00-00.jpg", "maps"])
+
+    def test_align_track(self):
+        track_timestamps = np.array([10, 20, 40])
+        latitudes, longitudes = align_track(np.array([0, 10, 15, 30, 40, 50]), track_timestamps,
+                                            [1.0, 2.0, 4.0], [10.0, 20.0, 40.0])
+        self.assertTrue(np.allclose(latitudes, [1.0, 1.0, 1.5, 3.0, 4.0, 4.0]))
+        self.assertTrue(np.allclose(longitudes, [10.0, 10.0, 15.0, 30.0, 40.0, 40.0]))
+        self.assertTrue(latitudes.flags["C_CONTIGUOUS"])
+
+    def test_align_track_single_fix(self):
+        latitudes, longitudes = align_track(np.array([0, 10]), np.array([5]), [1.0], [2.0])
+        self.assertEqual(latitudes.tolist(), [1.0, 1.0])
+        self.assertEqual(longitudes.tolist(), [2.0, 2.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
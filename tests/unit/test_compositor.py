@@ -0,0 +1,48 @@
+import unittest
+from unittest import TestCase
+import numpy as np
+import cv2
+from compositor import Compositor
+
+
+def full_frame_combine(map_image, frame, offset=20):
+    """
+    Previous full frame implementation of the map incrustation, used as reference
+    """
+    mask = np.zeros(frame.shape[:2], dtype="uint8")
+    circle_radius = int(min(frame.shape[0], frame.shape[1])*0.2)
+    circle_center = (frame.shape[1] - circle_radius - offset, frame.shape[0] - circle_radius - offset)
+    cv2.circle(mask, circle_center, circle_radius, 255, -1)
+    frame_masked = cv2.bitwise_and(frame, frame, mask=cv2.bitwise_not(mask))
+    min_shape = circle_radius*2
+    if min(map_image.shape[0:2]) == map_image.shape[0]:
+        resize = (int(min_shape), int(min_shape * map_image.shape[0]/map_image.shape[1]))
+    else:
+        resize = (int(min_shape), int(min_shape))
+    map_image = cv2.resize(map_image, resize)
+    frame[frame.shape[0] - map_image.shape[0] - offset : frame.shape[0] - offset,
+          frame.shape[1] - map_image.shape[1] - offset : frame.shape[1] - offset] = map_image
+    map_masked = cv2.bitwise_and(frame, frame, mask=mask)
+    return cv2.add(frame_masked, map_masked)
+
+
+class TestCompositor(TestCase):
+    def test_same_as_full_frame(self):
+        rng = np.random.default_rng(0)
+        compositor = Compositor()
+        for frame_shape, map_shape in [((1296, 2304, 3), (500, 500, 3)), ((720, 1280, 3), (300, 400, 3)),
+                                       ((720, 1280, 3), (400, 300, 3))]:
+            frame = rng.integers(0, 256, frame_shape, dtype=np.uint8)
+            map_image = rng.integers(0, 256, map_shape, dtype=np.uint8)
+            expected = full_frame_combine(map_image, frame.copy())
+            result = compositor.apply(frame, map_image)
+            self.assertTrue(np.array_equal(result, expected))
+
+    def test_layout_cached(self):
+        compositor = Compositor()
+        layout = compositor.layout((1296, 2304, 3), (500, 500, 3))
+        self.assertIs(compositor.layout((1296, 2304, 3), (500, 500, 3)), layout)
+
+
+if __name__ == '__main__':
+    unittest.main()
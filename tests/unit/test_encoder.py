@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+import numpy as np
+import cv2
+from PIL import Image
+from encoder import OpenCVEncoder, FFmpegEncoder, GifEncoder, ContactSheetEncoder, FanOutEncoder, Encoder, sample_palette, \
+    write_preview, merge_contact_sheets
+
+
+def make_frame(idx, size=(64, 48)):
+    frame = np.zeros((size[1], size[0], 3), np.uint8)
+    frame[:, :size[0] // 2] = (255, 0, 0)
+    frame[:, size[0] // 2:] = (0, idx * 20 % 256, 255)
+    return frame
+
+
+class TestGifEncoder(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_shared_palette(self):
+        path = os.path.join(self.folder.name, "preview.gif")
+        frames = [make_frame(idx) for idx in range(5)]
+        with GifEncoder(path, (64, 48), 10, sample_palette(frames[::2])) as encoder:
+            for frame in frames:
+                encoder.write(frame)
+            encoder.write(make_frame(0, (32, 32)))  # Wrong size, skipped
+        image = Image.open(path)
+        self.assertEqual(image.n_frames, 5)
+        self.assertEqual(image.info["duration"], 100)
+        self.assertEqual(image.info["loop"], 0)
+        image.seek(4)
+        rgb = np.asarray(image.convert("RGB"))
+        self.assertEqual(rgb[0, 0].tolist(), [0, 0, 255])
+        self.assertEqual(rgb[0, -1].tolist(), [255, 80, 0])
+
+    def test_write_preview(self):
+        video_path = os.path.join(self.folder.name, "video.avi")
+        with OpenCVEncoder(video_path, (64, 48), 10, "MJPG") as encoder:
+            for idx in range(10):
+                encoder.write(make_frame(idx))
+        path = os.path.join(self.folder.name, "preview.gif")
+        self.assertEqual(write_preview(video_path, path, width=32, frame_step=3), 4)
+        image = Image.open(path)
+        self.assertEqual(image.size, (32, 24))
+        self.assertEqual(image.n_frames, 4)
+
+
+class RecordingEncoder(Encoder):
+    def __init__(self, frame_size):
+        super().__init__("", frame_size, 10)
+        self.frames = []
+        self.released = False
+
+    def write(self, frame):
+        self.frames.append(frame)
+
+    def release(self):
+        self.released = True
+
+
+class TestFanOutEncoder(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_resize_once_per_size(self):
+        sinks = [RecordingEncoder((64, 48)), RecordingEncoder((32, 24)), RecordingEncoder((32, 24))]
+        with FanOutEncoder(sinks) as encoder:
+            encoder.write(make_frame(1))
+        self.assertTrue(all(sink.released for sink in sinks))
+        self.assertEqual(sinks[0].frames[0].shape, (48, 64, 3))
+        self.assertEqual(sinks[1].frames[0].shape, (24, 32, 3))
+        self.assertIs(sinks[1].frames[0], sinks[2].frames[0])
+
+    @unittest.skipUnless(shutil.which("ffmpeg"), "ffmpeg is not installed")
+    def test_ffmpeg_died(self):
+        # ffmpeg exits at once on the unknown codec, the writes then fail with a broken pipe
+        dead = FFmpegEncoder(os.path.join(self.folder.name, "dead.mp4"), (32, 24), 10, codec="unknown")
+        other = RecordingEncoder((32, 24))
+        encoder = FanOutEncoder([dead, other])
+        with self.assertRaises(OSError):
+            # Frames smaller than the pipe buffer, some are still buffered when the pipe breaks
+            for idx in range(1000):
+                encoder.write(make_frame(idx, (32, 24)))
+        with self.assertRaises(RuntimeError):
+            encoder.release()
+        self.assertTrue(other.released)
+        self.assertIsNotNone(dead._process.returncode)
+        dead.release()  # Released only once
+
+    def test_contact_sheet(self):
+        path = os.path.join(self.folder.name, "sheet.png")
+        with ContactSheetEncoder(path, (8, 6), 10, 10, columns=2, rows=2) as encoder:
+            for idx in range(10):
+                encoder.write(np.full((48, 64, 3), idx, np.uint8))
+        sheet = cv2.imread(path)
+        self.assertEqual(sheet.shape, (12, 16, 3))
+        # Frames 0, 3, 6 and 9 are picked
+        self.assertEqual(sheet[::6, ::8, 0].tolist(), [[0, 3], [6, 9]])
+
+    def test_contact_sheet_skipped_frames(self):
+        path = os.path.join(self.folder.name, "sheet.png")
+        with FanOutEncoder([RecordingEncoder((64, 48)), ContactSheetEncoder(path, (8, 6), 10, 10, 2, 2)]) as encoder:
+            for idx in range(10):
+                if idx != 2:  # Unreadable frame skipped by the render
+                    encoder.write(np.full((48, 64, 3), idx, np.uint8), idx)
+        self.assertEqual(cv2.imread(path)[::6, ::8, 0].tolist(), [[0, 3], [6, 9]])
+
+    def test_merge_contact_sheets(self):
+        paths = []
+        for start, stop in ((0, 4), (4, 10)):
+            paths.append(os.path.join(self.folder.name, "sheet_{}.png".format(start)))
+            with ContactSheetEncoder(paths[-1], (8, 6), 10, 10, columns=2, rows=2, frame_offset=start) as encoder:
+                for idx in range(start, stop):
+                    encoder.write(np.full((48, 64, 3), idx + 1, np.uint8))
+        path = os.path.join(self.folder.name, "sheet.png")
+        merge_contact_sheets(paths, path)
+        self.assertEqual(cv2.imread(path)[::6, ::8, 0].tolist(), [[1, 4], [7, 10]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+from folder_watcher import FolderWatcher, FOLDER, FRAME, REMOVED
+
+
+class TestFolderWatcher(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def collect(self, watcher, count):
+        events = []
+        for _ in range(10):
+            events += watcher.wait(1)
+            if len(events) >= count:
+                break
+        return events
+
+    def check_events(self, watcher):
+        trip = os.path.join(self.folder.name, "2021-05-03_10-00-00")
+        os.mkdir(trip)
+        self.assertEqual(self.collect(watcher, 1), [(FOLDER, trip)])
+        for name in ["a.jpg", "b.jpg", "c.txt"]:
+            with open(os.path.join(trip, name), "wb") as file:
+                file.write(b"frame")
+        self.assertEqual(self.collect(watcher, 2), [(FRAME, os.path.join(trip, "a.jpg")), (FRAME, os.path.join(trip, "b.jpg"))])
+        for name in os.listdir(trip):
+            os.remove(os.path.join(trip, name))
+        os.rmdir(trip)
+        self.assertEqual(self.collect(watcher, 1), [(REMOVED, trip)])
+        watcher.wake()
+        self.assertEqual(watcher.wait(5), [])
+        self.assertEqual(watcher.wait(0.01), [])
+        watcher.close()
+
+    def test_inotify(self):
+        watcher = FolderWatcher(self.folder.name)
+        if not watcher.uses_inotify:
+            self.skipTest("inotify is not available")
+        self.check_events(watcher)
+
+    def test_polling(self):
+        watcher = FolderWatcher(self.folder.name, poll_period=0.05, use_inotify=False)
+        self.assertFalse(watcher.uses_inotify)
+        self.check_events(watcher)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+import numpy as np
+import cv2
+from frame_selection import frame_signatures, difference_scores, frame_speeds, select_frames
+
+
+class TestFrameSelection(TestCase):
+    def test_signatures_and_scores(self):
+        with tempfile.TemporaryDirectory() as folder:
+            paths = []
+            for idx, value in enumerate((0, 0, 255, 255)):
+                paths.append(os.path.join(folder, "{}.jpg".format(idx)))
+                cv2.imwrite(paths[-1], np.full((288, 512, 3), value, np.uint8))
+            paths.append(os.path.join(folder, "missing.jpg"))
+            signatures = frame_signatures(paths, width=16)
+        self.assertEqual(signatures.shape, (5, 16 * 9))
+        self.assertTrue(np.isnan(signatures[4]).all())
+        scores = difference_scores(signatures)
+        self.assertEqual(scores[0], np.inf)
+        self.assertLess(scores[1], 0.01)
+        self.assertGreater(scores[2], 0.9)
+        self.assertLess(scores[3], 0.01)
+        self.assertEqual(scores[4], np.inf)
+
+    def test_frame_speeds(self):
+        # 0.01 degree of latitude (about 1.11 km) every 60 seconds
+        speeds = frame_speeds(np.array([0, 60, 120, 180]), np.array([45.0, 45.01, 45.02, 45.02]), np.zeros(4))
+        np.testing.assert_allclose(speeds[:3], 66.7, atol=0.1)
+        self.assertEqual(speeds[3], 0)
+
+    def test_select_frames(self):
+        scores = np.array([np.inf] + [0.0] * 24 + [1.0])
+        np.testing.assert_array_equal(select_frames(scores, keep_every=10), [0, 10, 20, 25])
+        np.testing.assert_array_equal(select_frames(scores, keep_every=0), [0, 25])
+        # The moving frames are kept even if they look the same
+        speeds = np.full(26, 50.0)
+        speeds[5:10] = 0
+        np.testing.assert_array_equal(select_frames(scores, speeds, keep_every=0),
+                                      [idx for idx in range(26) if not 5 <= idx < 10])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+import numpy as np
+import cv2
+from frame_source import PrefetchFrameSource, reduced_read_flags
+
+
+class TestReducedRead(TestCase):
+    def test_reduced_read_flags(self):
+        self.assertEqual(reduced_read_flags(2304, 288), cv2.IMREAD_REDUCED_COLOR_8)
+        self.assertEqual(reduced_read_flags(2304, 320), cv2.IMREAD_REDUCED_COLOR_4)
+        self.assertEqual(reduced_read_flags(2304, 1280), cv2.IMREAD_COLOR)
+        self.assertEqual(reduced_read_flags(2304, 2304), cv2.IMREAD_COLOR)
+
+    def test_reduced_decode(self):
+        with tempfile.TemporaryDirectory() as folder:
+            paths = []
+            for idx in range(3):
+                paths.append(os.path.join(folder, "{}.jpg".format(idx)))
+                cv2.imwrite(paths[-1], np.full((96, 128, 3), idx * 50, np.uint8))
+            frames = list(PrefetchFrameSource(paths, flags=reduced_read_flags(128, 32)))
+        self.assertEqual([frame.shape for frame in frames], [(24, 32, 3)] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
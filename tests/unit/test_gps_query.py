@@ -0,0 +1,63 @@
+import json
+import unittest
+from unittest import TestCase, mock
+import numpy as np
+import requests
+from influxdb import InfluxDBClient
+from common import retrieve_gps_track
+
+
+def influxdb_response(chunks):
+    """
+    Build the chunked HTTP response of the influxdb server to a query, one JSON document per line
+    chunks: list of the chunks, each a list of the (topic, [(time, value), ...]) series
+    """
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["Content-Type"] = "application/json"
+    response._content = b"\n".join(json.dumps({"results": [{"statement_id": 0, "series": [
+        {"name": "mqtt_consumer", "tags": {"topic": topic}, "columns": ["time", "value"], "values": values}
+        for topic, values in series]}]}).encode("utf-8") for series in chunks)
+    response._content_consumed = True
+    return response
+
+
+class TestRetrieveGpsTrack(TestCase):
+    def setUp(self):
+        self.client = InfluxDBClient("localhost", 8086, "user", "pass", "db")
+
+    def test_query(self):
+        response = influxdb_response([[
+            ("router/gps/latitude", [[1620036000000, 45.0], [1620036002000, 45.2]]),
+            ("router/gps/longitude", [[1620036000000, 5.0], [1620036002000, 5.4]])]])
+        with mock.patch.object(requests.Session, "request", return_value=response) as request:
+            track = retrieve_gps_track(1620036000000, 1620036002000, self.client)
+        self.assertEqual(request.call_count, 1)
+        params = request.call_args.kwargs["params"]
+        self.assertIn("2021-05-03T10:00:00Z", params["q"])
+        self.assertEqual(params["chunked"], "true")
+        self.assertEqual(params["epoch"], "ms")
+        self.assertEqual(track["timestamp"].tolist(), [1620036000000, 1620036002000])
+        np.testing.assert_allclose(track["latitude"], [45.0, 45.2])
+        np.testing.assert_allclose(track["longitude"], [5.0, 5.4])
+
+    def test_chunks(self):
+        # The latitude series is split over the two chunks
+        response = influxdb_response([
+            [("router/gps/latitude", [[1620036000000, 45.0], [1620036001000, 45.1]])],
+            [("router/gps/latitude", [[1620036002000, 45.2]]),
+             ("router/gps/longitude", [[1620036000000, 5.0], [1620036002000, 5.4]])]])
+        with mock.patch.object(requests.Session, "request", return_value=response) as request:
+            track = retrieve_gps_track(1620036000000, 1620036002000, self.client, chunk_size=2)
+        self.assertEqual(request.call_args.kwargs["params"]["chunk_size"], 2)
+        self.assertEqual(track["timestamp"].tolist(), [1620036000000, 1620036001000, 1620036002000])
+        np.testing.assert_allclose(track["latitude"], [45.0, 45.1, 45.2])
+        np.testing.assert_allclose(track["longitude"], [5.0, 5.2, 5.4])
+
+    def test_empty(self):
+        with mock.patch.object(requests.Session, "request", return_value=influxdb_response([[]])):
+            self.assertEqual(len(retrieve_gps_track(1620036000000, 1620036002000, self.client)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import time
+import unittest
+import tempfile
+from unittest import TestCase
+import numpy as np
+from gps_track import GpsTrackRecorder, TRACK_DTYPE, TRACK_EXTENSION, read_track, read_tracks, prune_tracks
+
+
+def write_track(folder, name, timestamps):
+    track = np.zeros(len(timestamps), dtype=TRACK_DTYPE)
+    track["timestamp"] = timestamps
+    track["latitude"] = np.arange(len(timestamps)) + 45.0
+    track["longitude"] = np.arange(len(timestamps)) + 5.0
+    path = os.path.join(folder, name + TRACK_EXTENSION)
+    track.tofile(path)
+    return path
+
+
+class TestGpsTrackRecorder(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "tracks")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_record(self):
+        recorder = GpsTrackRecorder(self.path, flush_every=2)
+        recorder.update("latitude", 1.0, 100)  # Not recording yet
+        recorder.start("trip")
+        self.assertTrue(recorder.recording)
+        recorder.update("latitude", 45.0, 100)
+        recorder.update("longitude", 5.0, 100)
+        recorder.update("longitude", 5.1, 101)  # A record needs both fields
+        recorder.update("latitude", 45.1, 101)
+        recorder.update("latitude", 45.2, 102)
+        recorder.stop()
+        self.assertFalse(recorder.recording)
+        track = read_track(os.path.join(self.path, "trip" + TRACK_EXTENSION))
+        self.assertEqual(track["timestamp"].tolist(), [100000, 101000])
+        self.assertEqual(track["latitude"].tolist(), [45.0, 45.1])
+        self.assertEqual(track["longitude"].tolist(), [5.0, 5.1])
+
+    def test_prune(self):
+        os.makedirs(self.path)
+        old = write_track(self.path, "old", [1000])
+        os.utime(old, (time.time() - 3 * 86400, time.time() - 3 * 86400))
+        write_track(self.path, "recent", [2000])
+        self.assertEqual(prune_tracks(self.path, 0), 0)
+        recorder = GpsTrackRecorder(self.path, max_age_days=2)
+        recorder.start("trip")
+        recorder.stop()
+        self.assertEqual(sorted(os.listdir(self.path)), ["recent" + TRACK_EXTENSION, "trip" + TRACK_EXTENSION])
+
+
+class TestReadTracks(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_read_tracks(self):
+        write_track(self.folder.name, "second", [5000, 6000, 7000])
+        write_track(self.folder.name, "first", [1000, 2000, 3000])
+        write_track(self.folder.name, "outside", [9000, 10000])
+        with open(os.path.join(self.folder.name, "first" + TRACK_EXTENSION), "ab") as file:
+            file.write(b"\0" * 5)  # Partially written last record
+        track = read_tracks(self.folder.name, 2000, 6000)
+        self.assertEqual(track.dtype, TRACK_DTYPE)
+        self.assertEqual(track["timestamp"].tolist(), [2000, 3000, 5000, 6000])
+        self.assertEqual(len(read_tracks(self.folder.name, 3500, 4500)), 0)
+        self.assertEqual(len(read_tracks(os.path.join(self.folder.name, "missing"), 0, 10000)), 0)
+
+    def test_skip_old_tracks(self):
+        # A track last written before the start is not opened
+        path = write_track(self.folder.name, "trip", [1000, 2000])
+        os.utime(path, (1, 1))
+        self.assertEqual(len(read_tracks(self.folder.name, 1500, 3000)), 0)
+        os.utime(path, (10, 10))
+        self.assertEqual(read_tracks(self.folder.name, 1500, 3000)["timestamp"].tolist(), [2000])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+from job_queue import JobQueue, PENDING, RUNNING, DONE, FAILED
+
+
+class TestJobQueue(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "jobs.sqlite")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_priority_order(self):
+        queue = JobQueue(self.path)
+        self.assertTrue(queue.enqueue("/tmp/a"))
+        self.assertTrue(queue.enqueue("/tmp/b"))
+        self.assertTrue(queue.enqueue("/tmp/c", priority=1))
+        self.assertFalse(queue.enqueue("/tmp/a", priority=5))
+        self.assertEqual([queue.claim()["folder"] for _ in range(3)], ["/tmp/c", "/tmp/a", "/tmp/b"])
+        self.assertIsNone(queue.claim())
+        self.assertEqual(queue.counts()[RUNNING], 3)
+        queue.close()
+
+    def test_retry_backoff(self):
+        queue = JobQueue(self.path, max_attempts=2, backoff_s=0)
+        queue.enqueue("/tmp/a")
+        job = queue.claim()
+        self.assertEqual(queue.fail(job["id"], "error"), PENDING)
+        job = queue.claim()
+        self.assertEqual(job["attempts"], 2)
+        self.assertEqual(queue.fail(job["id"], "error"), FAILED)
+        self.assertIsNone(queue.claim())
+        queue.close()
+
+        queue = JobQueue(self.path, backoff_s=3600)
+        queue.enqueue("/tmp/b")
+        queue.fail(queue.claim()["id"], "error")
+        self.assertIsNone(queue.claim())  # The retry waits for the backoff
+        queue.close()
+
+    def test_recover(self):
+        queue = JobQueue(self.path)
+        queue.enqueue("/tmp/a")
+        queue.enqueue("/tmp/b")
+        queue.complete(queue.claim()["id"])
+        queue.claim()
+        queue.close()
+        queue = JobQueue(self.path)
+        self.assertEqual(queue.recover(), 1)
+        self.assertEqual(queue.counts(), {PENDING: 1, RUNNING: 0, DONE: 1, FAILED: 0})
+        self.assertEqual(queue.claim()["folder"], "/tmp/b")
+        queue.close()
+
+    def test_recover_out_of_attempts(self):
+        queue = JobQueue(self.path, max_attempts=2)
+        queue.enqueue("/tmp/a")
+        for _ in range(2):
+            # The job kills the process at every attempt
+            self.assertEqual(queue.claim()["folder"], "/tmp/a")
+            queue.close()
+            queue = JobQueue(self.path, max_attempts=2)
+            queue.recover()
+        self.assertEqual(queue.counts(), {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 1})
+        self.assertIsNone(queue.claim())
+        queue.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
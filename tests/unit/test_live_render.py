@@ -0,0 +1,74 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+import numpy as np
+import cv2
+from common import get_timelapse_to_process
+from manifest import RenderManifest
+from live_render import LiveRenderer
+
+
+@unittest.skipUnless(shutil.which("ffmpeg"), "ffmpeg is not installed")
+class TestLiveRenderer(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.tmp_path = os.path.join(self.folder.name, "tmp")
+        self.results_path = os.path.join(self.folder.name, "results")
+        os.makedirs(self.results_path)
+        self.conf = {"encoder": {"backend": "ffmpeg", "width": 64, "height": 48},
+                     "live_render": {"chunk_frames": 4, "min_frames": 5, "poll_period_s": 60},
+                     "gps_track": {"path": os.path.join(self.folder.name, "gps_tracks")}}
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def capture(self, frames):
+        trip = os.path.join(self.tmp_path, "2021-05-03_10-00-00")
+        os.makedirs(trip, exist_ok=True)
+        for idx in range(frames):
+            cv2.imwrite(os.path.join(trip, "2021-05-03_10-00-{:02d}.jpg".format(idx)), np.full((48, 64, 3), idx * 20, np.uint8))
+        return trip
+
+    def test_render_while_capturing(self):
+        os.makedirs(os.path.join(self.tmp_path, "previous_trip"))
+        renderer = LiveRenderer(self.tmp_path, self.results_path, self.conf)
+        renderer.start()
+        trip = self.capture(9)
+        result_folder = os.path.join(self.results_path, os.path.basename(trip))
+        deadline = time.time() + 30
+        while not os.path.exists(os.path.join(result_folder, "live_segments", "segment_0001.mp4")) and time.time() < deadline:
+            time.sleep(0.1)
+        # The trip is unfinished but owned by the live render, it must not be queued for a post-trip render
+        self.assertEqual(get_timelapse_to_process(self.tmp_path, self.results_path), [trip])
+        self.assertTrue(renderer.owns(trip))
+        self.assertFalse(renderer.owns(os.path.join(self.tmp_path, "previous_trip")))
+        renderer.finish()
+        renderer.join(30)
+        self.assertFalse(renderer.is_alive())
+        self.assertFalse(renderer.owns(trip))
+        renderer.close()
+        self.assertFalse(RenderManifest.is_unfinished(result_folder))
+        self.assertEqual(sorted(os.listdir(result_folder)), ["manifest.json", "video.mp4"])
+        self.assertEqual(int(cv2.VideoCapture(os.path.join(result_folder, "video.mp4")).get(cv2.CAP_PROP_FRAME_COUNT)), 9)
+        self.assertEqual(get_timelapse_to_process(self.tmp_path, self.results_path), [])
+
+    def test_stop_short_capture(self):
+        self.conf["live_render"]["chunk_frames"] = 1000
+        renderer = LiveRenderer(self.tmp_path, self.results_path, self.conf)
+        renderer.start()
+        trip = self.capture(3)
+        result_folder = os.path.join(self.results_path, os.path.basename(trip))
+        deadline = time.time() + 30
+        while not os.path.exists(os.path.join(result_folder, RenderManifest.FILENAME)) and time.time() < deadline:
+            time.sleep(0.1)
+        # Too short, the live render drops its result folder
+        renderer.stop(30)
+        self.assertFalse(os.path.exists(result_folder))
+        self.assertEqual(get_timelapse_to_process(self.tmp_path, self.results_path), [trip])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+import numpy as np
+from manifest import RenderManifest
+
+FRAMES = ["2021-05-03_10-00-0{}.jpg".format(idx) for idx in range(6)]
+
+
+class TestRenderManifest(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = self.folder.name
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_resume(self):
+        self.assertFalse(RenderManifest.is_unfinished(self.path))
+        manifest = RenderManifest.load(self.path, FRAMES)
+        segment_path = os.path.join(self.path, "segments", "segment_0000.mp4")
+        manifest.mark_segment(0, 3, segment_path)
+        self.assertTrue(RenderManifest.is_unfinished(self.path))
+        # The segment is done only if its file exists
+        self.assertFalse(RenderManifest.load(self.path, FRAMES).segment_done(0, 3))
+        os.makedirs(os.path.dirname(segment_path))
+        open(segment_path, "wb").close()
+        manifest = RenderManifest.load(self.path, FRAMES)
+        self.assertTrue(manifest.segment_done(0, 3))
+        self.assertFalse(manifest.segment_done(0, 2))
+        self.assertFalse(manifest.segment_done(3, 6))
+        # Marking a segment again replaces it
+        manifest.mark_segment(0, 3, segment_path)
+        self.assertEqual(manifest.data["segments"], [{"start": 0, "stop": 3, "path": "segments/segment_0000.mp4"}])
+        # Other frames start a new render
+        self.assertFalse(RenderManifest.load(self.path, FRAMES[1:]).segment_done(0, 3))
+        manifest.mark_done()
+        self.assertTrue(RenderManifest.load(self.path, FRAMES).done)
+        self.assertFalse(RenderManifest.is_unfinished(self.path))
+
+    def test_corrupted(self):
+        with open(os.path.join(self.path, RenderManifest.FILENAME), "w") as file:
+            file.write('{"frames": 6, "segm')  # Partial file
+        self.assertTrue(RenderManifest.is_unfinished(self.path))
+        manifest = RenderManifest.load(self.path, FRAMES)
+        self.assertEqual(manifest.data["segments"], [])
+        self.assertFalse(manifest.done)
+
+    def test_alignment(self):
+        manifest = RenderManifest.load(self.path, FRAMES)
+        self.assertIs(manifest.load_alignment(), False)
+        manifest.save_alignment(None, None)
+        self.assertEqual(RenderManifest.load(self.path, FRAMES).load_alignment(), (None, None))
+        manifest.save_alignment(np.arange(6) + 45.0, np.arange(6) + 5.0)
+        latitudes, longitudes = RenderManifest.load(self.path, FRAMES).load_alignment()
+        self.assertEqual(latitudes.tolist(), [45.0, 46.0, 47.0, 48.0, 49.0, 50.0])
+        self.assertEqual(longitudes.tolist(), [5.0, 6.0, 7.0, 8.0, 9.0, 10.0])
+        os.remove(os.path.join(self.path, RenderManifest.ALIGNMENT_FILENAME))
+        self.assertIs(RenderManifest.load(self.path, FRAMES).load_alignment(), False)
+
+    def test_selection(self):
+        manifest = RenderManifest.load(self.path, FRAMES)
+        self.assertIsNone(manifest.load_selection())
+        manifest.save_selection([0, 2, 5])
+        selection = RenderManifest.load(self.path, FRAMES).load_selection()
+        self.assertEqual(selection.dtype, np.int64)
+        self.assertEqual(selection.tolist(), [0, 2, 5])
+        self.assertIsNone(RenderManifest.load(self.path, FRAMES[:3]).load_selection())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+from unittest import TestCase
+import numpy as np
+import cv2
+import tilemapbase
+from map_render import MapRenderer, InsetCache, project, square_extent, plan_degree_ranges, BLANK_TILE_COLOR
+
+
+class FakeTiles:
+    """
+    Tile provider drawing each tile with a color depending on its coordinates
+    """
+    tilesize = 256
+    maxzoom = 19
+    name = "fake"
+
+    def __init__(self):
+        self.requests = 0
+
+    def get_tile_bytes(self, x, y, zoom):
+        self.requests += 1
+        tile = np.full((256, 256, 3), ((x * 37) % 256, (y * 59) % 256, zoom * 10), np.uint8)
+        return cv2.imencode(".png", tile)[1].tobytes()
+
+
+class TestMapRender(TestCase):
+    def test_project(self):
+        for lon, lat in [(2.35, 48.85), (-122.4, 37.7), (0.0, 0.0)]:
+            expected = tilemapbase.project(lon, lat)
+            self.assertAlmostEqual(project(lon, lat)[0], expected[0])
+            self.assertAlmostEqual(project(lon, lat)[1], expected[1])
+
+    def test_square_extent(self):
+        extent = tilemapbase.Extent.from_lonlat(2.35 - 0.005, 2.35 + 0.005, 48.85 - 0.005, 48.85 + 0.005).to_aspect(1.0)
+        xmin, xmax, ymin, ymax = square_extent(48.85, 2.35, 0.005)
+        self.assertAlmostEqual(xmin, extent.xmin)
+        self.assertAlmostEqual(xmax, extent.xmax)
+        self.assertAlmostEqual(ymin, extent.ymin)
+        self.assertAlmostEqual(ymax, extent.ymax)
+
+    def test_render(self):
+        tiles = FakeTiles()
+        renderer = MapRenderer(tiles, width=500)
+        map_image = renderer.render(48.85, 2.35)
+        self.assertEqual(map_image.shape, (500, 500, 3))
+        self.assertEqual(map_image.dtype, np.uint8)
+        # Zoom level chosen as the tilemapbase Plotter would
+        extent = tilemapbase.Extent.from_lonlat(2.35 - 0.005, 2.35 + 0.005, 48.85 - 0.005, 48.85 + 0.005).to_aspect(1.0)
+        zoom = tilemapbase.Plotter(extent, tiles, width=500).zoom
+        self.assertEqual(renderer.zoom_for(extent.width), zoom)
+        self.assertTrue((map_image[..., 2] == zoom * 10).all())
+        # The tiles are decoded only once
+        requests = tiles.requests
+        renderer.render(48.85, 2.35)
+        self.assertEqual(tiles.requests, requests)
+
+    def test_plan_tiles(self):
+        tiles = FakeTiles()
+        renderer = MapRenderer(tiles, width=500, max_decoded_tiles=1000)
+        latitudes, longitudes = np.linspace(48.85, 48.9, 20), np.full(20, 2.35)
+        degree_ranges = np.linspace(0.005, 0.05, 20)
+        planned = renderer.plan_tiles(latitudes, longitudes, degree_ranges)
+        self.assertEqual(len(planned), len(set(planned)))
+        for idx in range(20):
+            renderer.render(latitudes[idx], longitudes[idx], degree_ranges[idx])
+        self.assertEqual(sorted(renderer._decoded), planned)
+
+    def test_plan_tiles_inset_cache(self):
+        renderer = MapRenderer(FakeTiles(), width=500, max_decoded_tiles=100000, inset_cache=InsetCache(max_mb=1))
+        rng = np.random.default_rng(0)
+        latitudes, longitudes = rng.uniform(48.8, 48.9, 300), rng.uniform(2.3, 2.4, 300)
+        degree_ranges = rng.uniform(0.005, 0.1, 300)
+        planned = renderer.plan_tiles(latitudes, longitudes, degree_ranges)
+        for idx in range(300):
+            renderer.render(latitudes[idx], longitudes[idx], degree_ranges[idx])
+        self.assertEqual(sorted(renderer._decoded), planned)
+
+    def test_missing_tile(self):
+        class OfflineTiles(FakeTiles):
+            def get_tile_bytes(self, x, y, zoom):
+                return None
+        map_image = MapRenderer(OfflineTiles(), width=500).render(48.85, 2.35)
+        self.assertTrue((map_image == BLANK_TILE_COLOR).all())
+
+    def test_plan_degree_ranges(self):
+        speeds = np.array([0.0] * 10 + [200.0] * 10)
+        degree_ranges = plan_degree_ranges(speeds, 0.005, 0.1, 130, window=4)
+        self.assertEqual(degree_ranges[0], 0.005)
+        self.assertEqual(degree_ranges[-1], 0.1)
+        # Smoothed transition
+        self.assertTrue((np.diff(degree_ranges) >= 0).all())
+        self.assertTrue(0.005 < degree_ranges[10] < 0.1)
+        self.assertEqual(plan_degree_ranges(np.array([np.inf, 0.0]), window=1)[0], 0.1)
+
+    def test_inset_cache(self):
+        tiles = FakeTiles()
+        renderer = MapRenderer(tiles, width=500, inset_cache=InsetCache(max_mb=1, grid_px=4))
+        map_image = renderer.render(48.85, 2.35)
+        self.assertEqual(map_image.shape, (500, 500, 3))
+        self.assertFalse(map_image.flags.writeable)
+        # GPS jitter of less than the grid reuses the inset
+        self.assertIs(renderer.render(48.850001, 2.350001), map_image)
+        self.assertIsNot(renderer.render(48.86, 2.35), map_image)
+        self.assertIsNot(renderer.render(48.85, 2.35, 0.01), map_image)
+        stats = renderer.inset_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 3))
+        # 750 kB insets in a 1 MB cache
+        self.assertEqual((len(renderer.inset_cache), stats["evictions"]), (1, 2))
+
+    def test_inset_cache_route_version(self):
+        class Route:
+            color, thickness, version = (0, 0, 255), 3, 0
+
+            def overlay(self, image, px0, py0, zoom):
+                pass
+        route = Route()
+        renderer = MapRenderer(FakeTiles(), width=500, route=route, inset_cache=InsetCache())
+        map_image = renderer.render(48.85, 2.35)
+        self.assertIs(renderer.render(48.85, 2.35), map_image)
+        route.version += 1
+        self.assertIsNot(renderer.render(48.85, 2.35), map_image)
+
+
+if __name__ == '__main__':
+    unittest.main()
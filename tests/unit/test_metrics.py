@@ -0,0 +1,70 @@
+import time
+import unittest
+import urllib.request
+from unittest import TestCase
+from metrics import Metrics, MetricsServer, RssSampler, current_rss_mb, BUCKETS
+
+
+class TestMetrics(TestCase):
+    def test_histogram(self):
+        metrics = Metrics()
+        metrics.observe("read", 0.002)
+        metrics.observe("read", 0.2)
+        metrics.observe("read", 100)
+        with metrics.time("encode"):
+            pass
+        stage = metrics.summary()["stages"]["read"]
+        self.assertEqual(stage["count"], 3)
+        self.assertEqual(stage["max"], 100)
+        self.assertEqual(stage["buckets"][BUCKETS.index(0.0025)], 1)
+        self.assertEqual(stage["buckets"][BUCKETS.index(0.25)], 1)
+        self.assertEqual(stage["buckets"][-1], 1)
+        self.assertEqual(metrics.summary()["stages"]["encode"]["count"], 1)
+
+    def test_merge(self):
+        worker = Metrics()
+        worker.observe("read", 0.01)
+        worker.add("frames", 10)
+        worker.gauge("queue_depth", 4)
+        metrics = Metrics()
+        metrics.add("frames", 5)
+        metrics.gauge("queue_depth", 8)
+        metrics.merge(worker.summary())
+        metrics.merge(worker.summary())
+        summary = metrics.summary()
+        self.assertEqual(summary["stages"]["read"]["count"], 2)
+        self.assertEqual(summary["counters"]["frames"], 25)
+        self.assertEqual(summary["gauges"]["queue_depth"]["max"], 8)
+        self.assertAlmostEqual(summary["gauges"]["queue_depth"]["mean"], 16 / 3)
+
+    def test_prometheus_endpoint(self):
+        metrics = Metrics()
+        metrics.observe("combine", 0.003)
+        metrics.add("frames")
+        server = MetricsServer(metrics, port=0, before_scrape=lambda: metrics.gauge("running_jobs", 1))
+        server.start()
+        try:
+            text = urllib.request.urlopen("http://127.0.0.1:" + str(server.port) + "/metrics", timeout=5).read().decode()
+        finally:
+            server.close()
+        self.assertIn('timelapse_trip_stage_seconds_bucket{stage="combine",le="0.005"} 1', text)
+        self.assertIn('timelapse_trip_stage_seconds_bucket{stage="combine",le="+Inf"} 1', text)
+        self.assertIn("timelapse_trip_frames_total 1", text)
+        self.assertIn("timelapse_trip_running_jobs 1", text)
+
+
+class TestRssSampler(TestCase):
+    def test_peak(self):
+        with RssSampler(0.01) as rss:
+            block = bytearray(64 * 1024 * 1024)
+            block[::4096] = b"\1" * len(block[::4096])  # Touch the pages so they are resident
+            before_release = current_rss_mb()
+            time.sleep(0.1)  # Sampled by the background thread
+            del block
+        # The peak is the one of the block, although its memory was released
+        self.assertGreaterEqual(rss.peak_mb, before_release)
+        self.assertGreater(rss.peak_mb, current_rss_mb() + 32)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import time
+import threading
+import unittest
+from unittest import TestCase
+from enums import Motion
+from motion import MotionStateMachine
+
+
+class TestMotionStateMachine(TestCase):
+    def test_transitions(self):
+        events = []
+        motion = MotionStateMachine(listener=lambda: events.append(motion.state))
+        motion.update(ignition=True, moving=True)
+        self.assertEqual(motion.state, Motion.DRIVE)
+        self.assertFalse(motion.should_capture())  # Stopped by the user until the stop command is cleared
+        motion.update(stop_command=False)
+        self.assertTrue(motion.should_capture())
+        motion.update(moving=False)
+        self.assertEqual(motion.state, Motion.IDLE)
+        self.assertFalse(motion.should_capture())
+        motion.update(ignition=False)
+        self.assertEqual(motion.state, Motion.STOP)
+        self.assertEqual(events, [Motion.DRIVE, Motion.DRIVE, Motion.IDLE, Motion.STOP])
+
+    def test_wait_for_stop(self):
+        motion = MotionStateMachine(idle_timeout_s=0.2)
+        motion.update(ignition=True, moving=True, stop_command=False)
+        self.assertIsNone(motion.wait_for_stop(0.05))
+        motion.update(moving=False)
+        start = time.monotonic()
+        self.assertEqual(motion.wait_for_stop(5), "Idling for too long")
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        motion.update(moving=True)
+        threading.Timer(0.05, motion.update, kwargs={"stop_command": True}).start()
+        self.assertEqual(motion.wait_for_stop(5), "stop command by user")
+        motion.update(ignition=False, moving=False)
+        self.assertEqual(motion.wait_for_stop(0), "Motion Stop")
+
+    def test_latencies(self):
+        motion = MotionStateMachine()
+        threading.Timer(0.05, motion.update, kwargs={"ignition": True, "moving": True, "stop_command": False}).start()
+        self.assertTrue(motion.wait_for_start(5))
+        motion.mark_started()
+        threading.Timer(0.05, motion.update, kwargs={"ignition": False, "moving": False}).start()
+        self.assertEqual(motion.wait_for_stop(5), "Motion Stop")
+        time.sleep(0.05)
+        motion.mark_stopped()
+        stats = motion.latency_stats()
+        self.assertEqual((stats["start"]["count"], stats["stop"]["count"]), (1, 1))
+        self.assertLess(stats["start"]["last"], 0.05)
+        self.assertGreaterEqual(stats["stop"]["last"], 0.05)
+        self.assertLess(stats["stop"]["max"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
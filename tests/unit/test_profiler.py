@@ -0,0 +1,80 @@
+import os
+import time
+import pstats
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from unittest import TestCase
+from profiler import JobProfiler
+
+
+def busy_job():
+    data = [bytearray(1024) for _ in range(1000)]
+    end = time.perf_counter() + 0.1
+    while time.perf_counter() < end:
+        sum(range(1000))
+    return data
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_cprofile(self):
+        output = os.path.join(self.folder.name, "result")
+        with JobProfiler(output) as profiler:
+            busy_job()
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual(sorted(os.listdir(output)),
+                         ["allocations.tracemalloc", "allocations.txt", "profile.pstats", "profile.txt"])
+        stats = pstats.Stats(os.path.join(output, "profile.pstats"))
+        self.assertTrue(any(function[2] == "busy_job" for function in stats.stats))
+        snapshot = tracemalloc.Snapshot.load(os.path.join(output, "allocations.tracemalloc"))
+        self.assertGreater(len(snapshot.traces), 0)
+
+    def test_sampling(self):
+        with JobProfiler(self.folder.name, "sampling", sample_interval_s=0.005) as profiler:
+            busy_job()
+        self.assertGreater(sum(profiler.samples.values()), 5)
+        with open(os.path.join(self.folder.name, "profile.folded")) as file:
+            self.assertIn("busy_job", file.read())
+
+    def test_overlapping_jobs(self):
+        outputs = [os.path.join(self.folder.name, str(idx)) for idx in range(2)]
+        profilers = [JobProfiler(output) for output in outputs]
+        started = threading.Event()
+        second_job_done = threading.Event()
+
+        def second_job():
+            started.wait()
+            with profilers[1]:
+                busy_job()
+            second_job_done.set()
+        thread = threading.Thread(target=second_job)
+        thread.start()
+        with profilers[0]:
+            started.set()
+            second_job_done.wait()
+            busy_job()
+        thread.join()
+        # The job overlapping the cProfile one is sampled, both profiles are written
+        self.assertEqual((profilers[0].mode, profilers[1].mode), ("cprofile", "sampling"))
+        self.assertIn("profile.pstats", os.listdir(outputs[0]))
+        self.assertEqual(os.listdir(outputs[1]), ["profile.folded"])
+        self.assertFalse(tracemalloc.is_tracing())
+        # The next job is profiled with cProfile again
+        with JobProfiler(outputs[1]) as profiler:
+            busy_job()
+        self.assertEqual(profiler.mode, "cprofile")
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            JobProfiler(self.folder.name, "perf")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase, mock
+import numpy as np
+import cv2
+import render
+from manifest import RenderManifest
+from render import render_video, split_shards
+
+FRAME_SIZE = (64, 48)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def frame_count(path):
+    return int(cv2.VideoCapture(path).get(cv2.CAP_PROP_FRAME_COUNT))
+
+
+class TestSplitShards(TestCase):
+    def test_split_shards(self):
+        self.assertEqual(split_shards(10, 3), [(0, 3), (3, 6), (6, 10)])
+        self.assertEqual(split_shards(2, 4), [(0, 1), (1, 2)])
+        self.assertEqual(split_shards(5, 1), [(0, 5)])
+
+
+@unittest.skipUnless(shutil.which("ffmpeg"), "ffmpeg is not installed")
+class TestResumeRender(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.result_folder = os.path.join(self.folder.name, "result")
+        os.makedirs(self.result_folder)
+        self.names = ["2021-05-03_10-00-{:02d}.jpg".format(idx) for idx in range(12)]
+        self.frames = [os.path.join(self.folder.name, name) for name in self.names]
+        for idx, path in enumerate(self.frames):
+            cv2.imwrite(path, np.full((FRAME_SIZE[1], FRAME_SIZE[0], 3), idx * 20, np.uint8))
+        self.conf = {"encoder": {"backend": "ffmpeg"},
+                     "outputs": [{"name": "contact_sheet.png", "type": "contact_sheet", "width": 16, "height": 12,
+                                  "columns": 4, "rows": 3}]}
+        self.output_path = os.path.join(self.result_folder, "video.mp4")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def render(self, progress=None):
+        """
+        Render the video in segments of 4 frames, return the paths of the segments rendered by this process
+        """
+        manifest = RenderManifest.load(self.result_folder, self.names)
+        with mock.patch("render.render_segment", wraps=render.render_segment) as render_segment:
+            render_video(self.output_path, self.frames, [name[:-4] for name in self.names], None, None, None, self.conf,
+                         FRAME_SIZE, 10, 1, progress, manifest, 4)
+        manifest.mark_done()
+        return [call.args[0] for call in render_segment.call_args_list]
+
+    def interrupt(self, after_frames):
+        def progress(done, total):
+            if done >= after_frames:
+                raise Interrupted()
+        with self.assertRaises(Interrupted):
+            self.render(progress)
+
+    def assert_rendered(self):
+        self.assertEqual(frame_count(self.output_path), 12)
+        sheet = cv2.imread(os.path.join(self.result_folder, "contact_sheet.png"))
+        self.assertEqual(sheet.shape, (36, 64, 3))
+        self.assertEqual(sheet[::12, ::16, 0].ravel().tolist(), [idx * 20 for idx in range(12)])
+        self.assertFalse(os.path.exists(os.path.join(self.result_folder, "segments")))
+        self.assertFalse(RenderManifest.is_unfinished(self.result_folder))
+
+    def test_resume(self):
+        # Interrupted in the middle of the second segment
+        self.interrupt(6)
+        self.assertTrue(RenderManifest.is_unfinished(self.result_folder))
+        manifest = RenderManifest.load(self.result_folder, self.names)
+        self.assertEqual([(segment["start"], segment["stop"]) for segment in manifest.data["segments"]], [(0, 4)])
+        self.assertFalse(os.path.exists(self.output_path))
+        # Only the segments left are rendered
+        rendered = self.render()
+        self.assertEqual([os.path.basename(path) for path in rendered], ["segment_0001.mp4", "segment_0002.mp4"])
+        self.assert_rendered()
+
+    def test_resume_missing_output(self):
+        self.interrupt(10)
+        # The segment is rendered again if one of its extra outputs is missing
+        os.remove(os.path.join(self.result_folder, "segments", "segment_0000.contact_sheet.png.png"))
+        rendered = self.render()
+        self.assertEqual([os.path.basename(path) for path in rendered], ["segment_0000.mp4", "segment_0002.mp4"])
+        self.assert_rendered()
+
+    def test_workers(self):
+        self.interrupt(6)
+        # The segments left are rendered by the worker processes
+        with mock.patch.object(render, "ProcessPoolExecutor", wraps=render.ProcessPoolExecutor) as executor:
+            manifest = RenderManifest.load(self.result_folder, self.names)
+            render_video(self.output_path, self.frames, [name[:-4] for name in self.names], None, None, None, self.conf,
+                         FRAME_SIZE, 10, 2, None, manifest, 4)
+            manifest.mark_done()
+        self.assertEqual(executor.call_args.kwargs["max_workers"], 2)
+        self.assert_rendered()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+from unittest import TestCase
+import numpy as np
+from map_render import project
+from route_layer import RouteLayer
+
+ZOOM = 16
+COLOR = (0, 0, 255)
+
+
+def pixel(lat, lon, zoom=ZOOM, tilesize=256):
+    x, y = project(lon, lat)
+    return int(x * (2 ** zoom) * tilesize), int(y * (2 ** zoom) * tilesize)
+
+
+def route_pixels(image):
+    return np.argwhere((image == COLOR).all(axis=2))
+
+
+class TestRouteLayer(TestCase):
+    def setUp(self):
+        self.layer = RouteLayer(256, COLOR, thickness=3)
+        self.px0, self.py0 = pixel(45.0, 5.0)
+        self.px0 -= 100
+        self.py0 -= 100
+
+    def overlay(self, px0=None, py0=None, zoom=ZOOM):
+        image = np.zeros((200, 200, 3), np.uint8)
+        self.layer.overlay(image, self.px0 if px0 is None else px0, self.py0 if py0 is None else py0, zoom)
+        return image
+
+    def test_overlay(self):
+        self.assertEqual(len(route_pixels(self.overlay())), 0)
+        self.layer.add_point(45.0, 5.0)
+        self.layer.add_point(45.0, 5.001)  # About 47 pixels east
+        self.assertEqual(len(self.layer), 2)
+        image = self.overlay()
+        pixels = route_pixels(image)
+        self.assertTrue((image[100, 100] == COLOR).all())
+        self.assertTrue((image[100, 140] == COLOR).all())
+        self.assertTrue(np.abs(pixels[:, 0] - 100).max() <= 3)  # Horizontal line about 3 pixels thick
+        self.assertTrue((image[150, 100] == 0).all())
+
+    def test_incremental(self):
+        self.layer.add_point(45.0, 5.0)
+        self.layer.add_point(45.0, 5.001)
+        self.overlay()
+        self.assertEqual(self.layer.reprojections, 1)
+        # The new segment is drawn in the canvas, which is not redrawn while the viewport stays in its tiles
+        self.layer.add_point(44.9995, 5.001)  # About 33 pixels south
+        image = self.overlay()
+        self.assertTrue((image[130, 147] == COLOR).all())
+        self.overlay(self.px0 + 10, self.py0 + 10)
+        self.assertEqual(self.layer.reprojections, 1)
+        # A viewport out of the canvas tiles or another zoom redraws the route
+        self.overlay(self.px0 + 5 * 256)
+        self.assertEqual(self.layer.reprojections, 2)
+        px0, py0 = pixel(45.0, 5.0, ZOOM - 1)
+        image = self.overlay(px0 - 100, py0 - 100, ZOOM - 1)
+        self.assertEqual(self.layer.reprojections, 3)
+        self.assertTrue((image[100, 120] == COLOR).all())  # Half the length at the lower zoom
+
+    def test_version(self):
+        self.layer.add_point(45.0, 5.0)
+        self.layer.add_point(45.0, 5.001)
+        self.overlay()
+        version = self.layer.version
+        # The GPS jitter while stopped keeps the version, so the cached insets stay valid
+        self.layer.add_point(45.0, 5.0010001)
+        self.assertEqual(self.layer.version, version)
+        self.layer.add_point(45.0, 5.0012)
+        self.assertEqual(self.layer.version, version + 1)
+
+    def test_extend(self):
+        self.layer.extend([45.0, 45.0], [5.0, 5.001])
+        self.assertEqual(len(self.layer), 2)
+        self.assertEqual(self.layer.version, 1)
+        image = self.overlay()
+        self.assertEqual(self.layer.reprojections, 1)
+        self.assertTrue((image[100, 140] == COLOR).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import time
+import unittest
+from unittest import TestCase
+from telemetry import Telemetry
+
+
+class FakeClient:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.messages.append((topic, payload, retain))
+
+
+class TestTelemetry(TestCase):
+    def test_coalesce(self):
+        client = FakeClient()
+        telemetry = Telemetry(client, heartbeat_s=60, min_interval_s=60, retained=["status"])
+        telemetry.publish("status", "Waiting")
+        time.sleep(0.1)
+        for progress in range(100):
+            telemetry.publish("progress", progress)
+        telemetry.publish("status", "Waiting")
+        time.sleep(0.1)
+        telemetry.close()
+        self.assertEqual(client.messages[0], ("status", "Waiting", True))
+        self.assertEqual(client.messages[-1], ("progress", 99, False))
+        # The first progress may be published before the next ones are coalesced
+        self.assertLessEqual(len(client.messages), 3)
+        self.assertGreaterEqual(telemetry.coalesced, 98)
+
+    def test_rate_limit_and_heartbeat(self):
+        client = FakeClient()
+        telemetry = Telemetry(client, heartbeat_s=0.3, min_interval_s=0.1)
+        telemetry.publish("progress", 1)
+        time.sleep(0.05)
+        telemetry.publish("progress", 2)
+        time.sleep(0.02)
+        self.assertEqual(client.messages, [("progress", 1, False)])
+        time.sleep(0.1)
+        self.assertEqual(client.messages[-1], ("progress", 2, False))
+        time.sleep(0.4)
+        telemetry.close()
+        # Published again at the heartbeat
+        self.assertGreaterEqual(client.messages.count(("progress", 2, False)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
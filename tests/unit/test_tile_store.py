@@ -0,0 +1,104 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import TestCase
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from tile_store import TileStore, StoredTiles
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    """
+    Serve /zoom/x/y tiles as their path, except the tiles with x = 13
+    """
+    def do_GET(self):
+        if self.path.split("/")[2] == "13":
+            self.send_error(404)
+            return
+        body = self.path.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ServerTiles:
+    name = "test"
+    headers = {}
+    tilesize = 256
+    maxzoom = 19
+
+    def __init__(self, port):
+        self.request = "http://127.0.0.1:" + str(port) + "/{zoom}/{x}/{y}"
+
+
+class TestTileStore(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "tiles.sqlite")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_hit_miss(self):
+        store = TileStore(self.path)
+        self.assertIsNone(store.get("osm", 15, 1, 2))
+        store.put("osm", 15, 1, 2, b"tile")
+        self.assertEqual(store.get("osm", 15, 1, 2), b"tile")
+        self.assertIsNone(store.get("other", 15, 1, 2))
+        self.assertEqual((store.hits, store.misses), (1, 2))
+        store.close()
+
+    def test_persistent(self):
+        store = TileStore(self.path)
+        store.put("osm", 15, 1, 2, b"tile")
+        store.close()
+        store = TileStore(self.path)
+        self.assertEqual(store.get("osm", 15, 1, 2), b"tile")
+        self.assertEqual(store.stats()["size_bytes"], 4)
+        store.close()
+
+    def test_lru_eviction(self):
+        store = TileStore(self.path, max_size_mb=2500 / (1024 * 1024))
+        store.put("osm", 15, 0, 0, b"a" * 1000)
+        store.put("osm", 15, 1, 0, b"b" * 1000)
+        store.get("osm", 15, 0, 0)  # (0, 0) becomes the most recently used
+        store.put("osm", 15, 2, 0, b"c" * 1000)
+        self.assertIsNotNone(store.get("osm", 15, 0, 0))
+        self.assertIsNone(store.get("osm", 15, 1, 0))
+        self.assertIsNotNone(store.get("osm", 15, 2, 0))
+        self.assertEqual(store.evictions, 1)
+        store.close()
+
+
+class TestStoredTiles(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.store = TileStore(os.path.join(self.folder.name, "tiles.sqlite"))
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), TileHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.tiles = ServerTiles(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.store.close()
+        self.folder.cleanup()
+
+    def test_prefetch(self):
+        self.store.put("test", 15, 1, 1, b"stored")
+        keys = [(x, 1, 15) for x in range(1, 15)]
+        self.assertEqual(len(self.store.missing("test", keys)), 13)
+        self.assertEqual(StoredTiles(self.tiles, self.store).prefetch(keys, concurrency=4), (14, 12, 1))
+        self.assertEqual(self.store.missing("test", keys), [(13, 1, 15)])
+        self.assertEqual((self.store.hits, self.store.misses), (0, 0))
+        offline = StoredTiles(self.tiles, self.store, offline=True)
+        self.assertEqual(offline.get_tile_bytes(2, 1, 15), b"/15/2/1")
+        self.assertIsNone(offline.get_tile_bytes(13, 1, 15))
+
+
+if __name__ == '__main__':
+    unittest.main()